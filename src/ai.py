@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+'''Computer opponent that targets the cells most likely to hold a ship.
+
+For every ship length still afloat, the strategy counts the placements that
+fit around the misses and sunk ships, and how many of them cover each cell.
+The counts are updated after every outgoing result by removing the
+placements the result rules out, instead of being recounted every turn.
+'''
+
+import random, placement
+
+
+class ProbabilityStrategy:
+
+    def __init__(self, grid, fleet, rng=None):
+        self.grid = grid
+        self.rng = rng or random.Random()
+
+        # Ship length -> ships of that length still afloat
+        self.afloat = dict()
+        for length in fleet:
+            self.afloat[length] = self.afloat.get(length, 0) + 1
+
+        # Length -> the shared placement.PlacementTable of that length
+        self.tables = dict()
+        # Length -> whether each placement in the table still fits
+        self.valid = dict()
+        # Length -> cell -> valid placements of that length covering the cell
+        self.counts = dict()
+        # Cell -> weighted count of the valid placements covering it
+        self.density = dict()
+
+        cells = [(x, y) for x in range(grid[0]) for y in range(grid[1])]
+        for c in cells:
+            self.density[c] = 0
+
+        for length, afloat in self.afloat.items():
+            table = self.tables[length] = placement.placement_table(grid, length)
+            self.valid[length] = [True] * len(table.coordinates)
+            counts = self.counts[length] = dict.fromkeys(cells, 0)
+            for c, covering in table.covering.items():
+                counts[c] = len(covering)
+                self.density[c] += afloat * len(covering)
+
+        self.untried = set(cells)
+        self.hits = set() # hits on ships that are not sunk yet
+
+    def all_placements(self, length):
+        return self.tables[length].coordinates
+
+    def next_shot(self):
+        if self.hits:
+            scores = self.target_scores()
+        else:
+            scores = self.density
+
+        best = -1
+        choices = []
+        for c in self.untried:
+            score = scores.get(c, 0)
+            if score > best:
+                best = score
+                choices = [c]
+            elif score == best:
+                choices.append(c)
+        return self.rng.choice(choices)
+
+    # Scores the cells of the placements that cover the unsunk hits. A
+    # placement through more of them is more likely
+    def target_scores(self):
+        scores = dict()
+        for length, table in self.tables.items():
+            valid = self.valid[length]
+            counted = set()
+            for hit in self.hits:
+                for index in table.covering.get(hit, ()):
+                    if not valid[index] or index in counted:
+                        continue
+                    counted.add(index)
+                    cells = table.coordinates[index]
+                    weight = self.afloat[length]
+                    weight *= 10 ** sum(1 for c in cells if c in self.hits)
+                    for c in cells:
+                        if c in self.untried:
+                            scores[c] = scores.get(c, 0) + weight
+        return scores
+
+    # Called with the result of every outgoing shot
+    def record(self, coordinates, ship_hit, ship_sunk):
+        coordinates = tuple(coordinates)
+        self.untried.discard(coordinates)
+
+        if not ship_hit:
+            self.block(coordinates)
+        elif not ship_sunk:
+            self.hits.add(coordinates)
+        else:
+            length = len(ship_hit.coordinates)
+            for c in ship_hit.coordinates:
+                c = tuple(c)
+                self.hits.discard(c)
+                self.block(c)
+
+            # One ship fewer of that length
+            if self.afloat.get(length):
+                self.afloat[length] -= 1
+                for c, count in self.counts[length].items():
+                    if count:
+                        self.density[c] -= count
+
+    # No placement can go through the cell any more
+    def block(self, cell):
+        for length, table in self.tables.items():
+            valid = self.valid[length]
+            counts = self.counts[length]
+            weight = self.afloat[length]
+            for index in table.covering.get(cell, ()):
+                if not valid[index]:
+                    continue
+                valid[index] = False
+                for c in table.coordinates[index]:
+                    counts[c] -= 1
+                    self.density[c] -= weight
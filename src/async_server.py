@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+'''An asyncio game server that pushes events to its clients.
+
+It serves the operations of server.GameManager over TCP connections that
+stay open for the whole session, instead of an HTTP request per call.
+Every message is one line of JSON. A client sends requests like
+
+    {"id": 1, "method": "fire", "params": [{"name": "Ann", "online_id": 42}, [3, 4]]}
+
+and the server answers each one with {"id": 1, "result": ...} or
+{"id": 1, "error": {"type": "RepeatFireException", "message": "..."}}.
+Players and ships are sent as server.py sends them, {name, online_id} and
+{id, coordinates}.
+
+Rather than polling, clients wait for the events the server pushes to the
+latest connection each player made a call on:
+
+    opponent_found      {"opponent": player}
+    opponent_responded  {"accepted": true or false}
+    game_ready
+    incoming            {"result": [coordinates, ship, sunk]}
+    outgoing            {"result": [coordinates, ship, sunk]}
+    game_over           {"winner": online ID, or null for a draw}
+
+Once both players have fired the server calls incoming and outgoing for
+them and pushes the results, so clients only fire. Salvo games push
+incoming_salvo and outgoing_salvo, with lists of results. A player whose
+opponent deregisters mid-game gets game_over at once, as the winner.
+
+A connection that starts with the line wire.MAGIC speaks the binary
+protocol of wire.py instead of JSON, with the same calls and events.
+
+An idle connection costs the server a few kilobytes, so one process holds
+tens of thousands of them, as many as the open file limit (ulimit -n)
+allows.
+
+    $ python3 async_server.py --port 8001
+'''
+
+import argparse, asyncio, collections, functools, json, logging, socket
+import threading
+import metrics, wire
+from battleship import Player, Ship, OpponentLeftException
+from server import GameManager, OnlinePlayer, allowed_errors, sweep_every
+
+# The longest request line the server reads
+line_limit = 1 << 16
+
+log = logging.getLogger(__name__)
+
+
+class RemoteError(Exception):
+    '''An exception raised by the server that the client has no class for'''
+    pass
+
+# Players and ships are sent like server.dump_player and server.dump_ship
+# send them
+def dump_object(value):
+    if isinstance(value, Player):
+        return {'name': value.name, 'online_id': value.online_id}
+    if isinstance(value, Ship):
+        return {'id': value.id, 'coordinates': value.coordinates}
+    raise TypeError("Can't send a " + type(value).__name__)
+
+def dumps(message):
+    return json.dumps(message, default=dump_object, separators=(',', ':')).encode() + b"\n"
+
+def dump_error(e):
+    return {'type': type(e).__name__, 'message': str(e)}
+
+
+class JsonCodec:
+    '''The messages of one connection as lines of JSON, for either end of
+    it. See wire.Codec for the binary protocol. load_params turns the
+    decoded parameters into players and ships on the server.'''
+
+    greeting = b""
+
+    def __init__(self, load_params=None):
+        self.load_params = load_params
+
+    async def read_request(self, reader):
+        return await reader.readline()
+
+    def decode_request(self, line):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            return request_id, request['method'], self.load_params(request.get('params', []))
+        except Exception as e:
+            raise wire.RequestError(request_id, e)
+
+    def result(self, request_id, method, value):
+        return dumps({'id': request_id, 'result': value})
+
+    def error(self, request_id, e):
+        return dumps({'id': request_id, 'error': dump_error(e)})
+
+    def event(self, name, fields):
+        fields['event'] = name
+        return dumps(fields)
+
+    def request(self, request_id, method, params):
+        return dumps({'id': request_id, 'method': method, 'params': params})
+
+    def read_message(self, file):
+        line = file.readline()
+        if not line:
+            raise ConnectionError("The server closed the connection")
+        return json.loads(line)
+
+class Connection:
+
+    __slots__ = ('writer', 'codec')
+
+    def __init__(self, writer, codec):
+        self.writer = writer
+        self.codec = codec
+
+
+class PushServer:
+    '''Serves a GameManager over asyncio streams and pushes the game events
+    to the players' connections'''
+
+    def __init__(self, manager=None):
+        self.manager = manager or GameManager()
+        # Player ID -> the player's latest connection
+        self.connections = dict()
+        # Players wait for events rather than call, so they are kept for as
+        # long as they are connected
+        self.manager.keep_alive = self.connected
+
+    def connected(self, player):
+        return player.online_id in self.connections
+
+    def start(self, host, port, **kwargs):
+        return asyncio.start_server(self.serve, host, port, limit=line_limit, **kwargs)
+
+    async def serve(self, reader, writer):
+        players = set() # IDs of the players that made calls here
+        connection = None
+        try:
+            request = await reader.readline()
+            if request == wire.MAGIC:
+                codec = wire.Codec(self.manager.load_player)
+                request = await codec.read_request(reader)
+            else:
+                codec = JsonCodec(self.manager.load_params)
+            connection = Connection(writer, codec)
+
+            while request:
+                self.handle(request, connection, players)
+                await writer.drain()
+                request = await codec.read_request(reader)
+        except (ConnectionError, ValueError):
+            pass # Gone, or sent a request over the limit
+        except Exception:
+            log.exception("Dropped a connection")
+        finally:
+            for player_id in players:
+                if self.connections.get(player_id) is connection:
+                    del self.connections[player_id]
+            writer.close()
+
+    # Answers one request and pushes the events it caused
+    def handle(self, request, connection, players):
+        writer, codec = connection.writer, connection.codec
+        request_id = None
+        try:
+            request_id, method, params = codec.decode_request(request)
+            # They would block every connection
+            if method.startswith(('wait', 'take_turn')):
+                raise ValueError("Wait for the pushed events instead of " + method)
+            if method not in self.manager.rpc_methods:
+                raise ValueError('method "{0}" is not supported'.format(method))
+            f = getattr(self.manager, method)
+        except wire.RequestError as e:
+            writer.write(codec.error(e.request_id, e.error))
+            return
+        except Exception as e:
+            writer.write(codec.error(request_id, e))
+            return
+
+        player = next((p for p in params if isinstance(p, OnlinePlayer)), None)
+        if player is not None:
+            self.connections[player.online_id] = connection
+            players.add(player.online_id)
+        was_ready = method == 'add_ship' and self.game_ready(player)
+        proposed_game = game = None
+        if player is not None and method == 'deregister_player':
+            # Gone once the player deregisters
+            with self.manager.changed:
+                proposed_game = self.manager.proposed_games.get(player.online_id)
+                game = self.manager.online_games.get(player.online_id)
+
+        try:
+            result = self.manager.timed_call(method, f, params)
+            # Results the codec can't encode are errors too
+            reply = codec.result(request_id, method, result)
+        except Exception as e:
+            writer.write(codec.error(request_id, e))
+            return
+        writer.write(reply)
+
+        if player is not None:
+            # The call was answered, so a failure here is only logged. The
+            # sweeper may have evicted the game in the meantime
+            try:
+                self.push_events(method, player, was_ready, proposed_game, game)
+            except Exception:
+                log.exception("Pushing the events of %s failed", method)
+
+    def push(self, player, event, **fields):
+        connection = self.connections.get(player.online_id)
+        if connection is not None and not connection.writer.is_closing():
+            connection.writer.write(connection.codec.event(event, fields))
+
+    # The matchmaking dictionaries are read under the manager's lock, as
+    # the sweeper thread changes them, but the games are called without it
+    def push_events(self, method, player, was_ready, proposed_game=None, game=None):
+        manager = self.manager
+        player_id = player.online_id
+
+        if method == 'register_player':
+            with manager.changed:
+                proposed_game = manager.proposed_games.get(player_id)
+            if proposed_game is not None:
+                p1, p2 = proposed_game.players
+                self.push(p1, 'opponent_found', opponent=p2)
+                self.push(p2, 'opponent_found', opponent=p1)
+
+        elif method in ('accept_opponent', 'reject_opponent'):
+            players = []
+            with manager.changed:
+                if player_id in manager.online_games:
+                    game = manager.online_games[player_id]
+                    accepted, players = True, [game.player1, game.player2]
+                elif player_id in manager.rejected_games:
+                    accepted, players = False, manager.rejected_games[player_id].players
+            for p in players:
+                self.push(p, 'opponent_responded', accepted=accepted)
+
+        elif method == 'deregister_player':
+            if proposed_game is not None:
+                for p in proposed_game.players:
+                    if p is not player:
+                        self.push(p, 'opponent_responded', accepted=False)
+            if game is not None:
+                with game.condition():
+                    abandoned = game.left is player
+                if abandoned:
+                    opponent = game.player2 if game.player1 is player else game.player1
+                    self.push(opponent, 'game_over', winner=opponent.online_id)
+
+        elif method == 'add_ship':
+            if not was_ready and self.game_ready(player):
+                with manager.changed:
+                    game = manager.online_games[player_id]
+                for p in [game.player1, game.player2]:
+                    self.push(p, 'game_ready')
+
+        elif method in ('fire', 'fire_salvo'):
+            with manager.changed:
+                game = manager.online_games[player_id]
+            with game.condition():
+                if not game.incoming_ready(player):
+                    return # The opponent has not fired
+
+            players = [game.player1, game.player2]
+            if game.salvo:
+                incoming, outgoing = 'incoming_salvo', 'outgoing_salvo'
+            else:
+                incoming, outgoing = 'incoming', 'outgoing'
+            for p in players:
+                self.push(p, incoming, result=getattr(manager, incoming)(p))
+            for p in players:
+                self.push(p, outgoing, result=getattr(manager, outgoing)(p))
+
+            if manager.game_over(player):
+                winner = manager.winner(player)
+                for p in players:
+                    self.push(p, 'game_over', winner=winner)
+
+    def game_ready(self, player):
+        try:
+            return player is not None and self.manager.game_ready(player)
+        except (KeyError, OpponentLeftException):
+            return False # Not in a game, or it was evicted or abandoned
+
+# Serves the PushServer from an event loop on a thread of its own. Returns
+# the port and a function that stops the server
+def run_in_thread(push_server, host="127.0.0.1", port=0, **kwargs):
+    loop = asyncio.new_event_loop()
+    tcp_server = loop.run_until_complete(push_server.start(host, port, **kwargs))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        async def close():
+            tcp_server.close()
+            await tcp_server.wait_closed()
+        asyncio.run_coroutine_threadsafe(close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    return tcp_server.sockets[0].getsockname()[1], stop
+
+
+class Client:
+    '''A blocking client for the PushServer. Calls are made like on a
+    ServerProxy, client.fire(player, coordinates). The events pushed in
+    the meantime are kept until wait_event takes them. The codec is
+    JsonCodec or wire.Codec.'''
+
+    def __init__(self, host, port, timeout=None, codec=None):
+        self.socket = socket.create_connection((host, port), timeout)
+        self.file = self.socket.makefile('rb')
+        self.codec = codec or JsonCodec()
+        if self.codec.greeting:
+            self.socket.sendall(self.codec.greeting)
+        self.events = collections.deque()
+        self.next_id = 1
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return functools.partial(self.call, method)
+
+    def call(self, method, *params):
+        request_id = self.next_id
+        self.next_id += 1
+        self.socket.sendall(self.codec.request(request_id, method, params))
+        while True:
+            message = self.receive()
+            if 'event' in message:
+                self.events.append(message)
+            elif message.get('id') == request_id:
+                break
+
+        if 'error' in message:
+            raise load_error(message['error'])
+        return message.get('result')
+
+    # Returns the first event with one of the names, and leaves the others
+    def wait_event(self, *names):
+        for event in self.events:
+            if event['event'] in names:
+                self.events.remove(event)
+                return event
+        while True:
+            message = self.receive()
+            if 'event' not in message:
+                continue # The answer to a call that was given up on
+            if message['event'] in names:
+                return message
+            self.events.append(message)
+
+    def receive(self):
+        return self.codec.read_message(self.file)
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+# Raises the game's own exceptions, like server.ExceptionUnmarshaller does
+def load_error(error):
+    for e in allowed_errors:
+        if e.__name__ == error['type']:
+            return e(error['message'])
+    return RemoteError("{0}: {1}".format(error['type'], error['message']))
+
+def getClient():
+    return Client('137.142.101.27', 8001)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default="137.142.101.27")
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--backlog', type=int, default=1024,
+                        help="connections waiting to be accepted")
+    parser.add_argument('--stats-interval', type=float, default=60,
+                        help="seconds between dumps of the call numbers to "
+                             "stderr, 0 for none")
+    parser.add_argument('--sweep-interval', type=float, default=10,
+                        help="seconds between evictions of idle players and "
+                             "finished games")
+    args = parser.parse_args()
+
+    async def main():
+        push_server = PushServer()
+        if args.stats_interval:
+            metrics.dump_every(push_server.manager, args.stats_interval)
+        sweep_every(push_server.manager, args.sweep_interval)
+        tcp_server = await push_server.start(args.host, args.port, backlog=args.backlog)
+        async with tcp_server:
+            await tcp_server.serve_forever()
+
+    asyncio.run(main())
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+'''Steps many two player games at once with NumPy.
+
+A BatchGame holds N games as stacked arrays and follows the same rules and
+state machine as battleship.Game: both players fire, both call incoming,
+both call outgoing. Every call works on all the games (or the ones picked
+with the games argument) in one vectorized step.
+
+Players are numbered 0 and 1. Cells are indexed [game, player, x, y], where
+(x, y) is a coordinate of a (w, h) grid like in battleship.Game.
+'''
+
+import numpy as np
+from battleship import *
+
+
+class BatchGame:
+
+    def __init__(self, count, grid, max_ships=8):
+        self.count = count
+        self.grid = grid
+        shape = (count, 2, grid[0], grid[1])
+
+        # Ship ID covering each cell of each player's grid, 0 for water.
+        # Ships are numbered from 1
+        self.ships = np.zeros(shape, dtype=np.int16)
+        # Cells each player has fired on
+        self.shots = np.zeros(shape, dtype=bool)
+        # Cells of each player's ships that have been hit
+        self.hits = np.zeros(shape, dtype=bool)
+        # Cells left on every ship, indexed by ship ID
+        self.remaining = np.zeros((count, 2, max_ships + 1), dtype=np.int16)
+        self.ship_count = np.zeros((count, 2), dtype=np.int16)
+        self.afloat = np.zeros((count, 2), dtype=np.int16)
+
+        # Each player's last firing coordinates
+        self.last_shot = np.zeros((count, 2, 2), dtype=np.intp)
+        self.ready = np.zeros((count, 2), dtype=bool)
+        # Same states as Game.state. The players are always initialized
+        self.state = np.zeros(count, dtype=np.int8)
+
+    # Builds a batch from initialized Games. Ship IDs follow the order of
+    # each player's ships
+    @classmethod
+    def from_games(cls, games):
+        max_ships = max(len(p.ships) for g in games for p in [g.player1, g.player2])
+        batch = cls(len(games), games[0].grid, max(max_ships, 1))
+
+        for i, game in enumerate(games):
+            if game.grid != batch.grid:
+                raise ValueError("All the games must have the same grid")
+            for p, player in enumerate([game.player1, game.player2]):
+                for ship in player.ships:
+                    batch.add_ship(i, p, ship.coordinates)
+        return batch
+
+    # Places a ship for one player in one game, with the checks of
+    # Game.add_ship. Returns the ship ID
+    def add_ship(self, game, player, coordinates):
+        coordinates = np.asarray(coordinates, dtype=np.intp).reshape(-1, 2)
+        if not self.inside_grid(coordinates).all():
+            raise OutsideGridException("A point on the ship is outside the coordinate")
+
+        cells = self.ships[game, player, coordinates[:, 0], coordinates[:, 1]]
+        if cells.any():
+            raise ShipCollisionException("The ship collides with another ship on the grid")
+
+        ship_id = self.ship_count[game, player] + 1
+        if ship_id >= self.remaining.shape[2]:
+            raise ValueError("The batch was created for fewer ships")
+
+        self.ships[game, player, coordinates[:, 0], coordinates[:, 1]] = ship_id
+        placed = int(np.count_nonzero(self.ships[game, player] == ship_id))
+        self.remaining[game, player, ship_id] = placed
+        self.ship_count[game, player] = ship_id
+        if placed:
+            self.afloat[game, player] += 1
+        return ship_id
+
+    def inside_grid(self, coordinates):
+        x, y = coordinates[..., 0], coordinates[..., 1]
+        return (x >= 0) & (x < self.grid[0]) & (y >= 0) & (y < self.grid[1])
+
+    # Index array of the games a call applies to
+    def selected(self, games):
+        if games is None:
+            return np.arange(self.count)
+        games = np.asarray(games)
+        if games.dtype == bool:
+            return np.flatnonzero(games)
+        return games
+
+    # Fires one shot for the player in every selected game. coordinates is
+    # an (n, 2) array with a row per selected game. Nothing is changed if
+    # the shot is not allowed in one of the games, and the exception
+    # Game.fire would raise names the first such game
+    def fire(self, player, coordinates, games=None):
+        games = self.selected(games)
+        coordinates = np.asarray(coordinates, dtype=np.intp).reshape(-1, 2)
+
+        def reject(exception, failed, message):
+            raise exception("Game {0}: {1}".format(games[failed][0], message))
+
+        failed = self.state[games] != 0
+        if failed.any():
+            reject(OutOfTurnException, failed, "You can't fire yet")
+
+        failed = self.ready[games, player]
+        if failed.any():
+            reject(OutOfTurnException, failed, "You can't fire twice per round")
+
+        failed = ~self.inside_grid(coordinates)
+        if failed.any():
+            reject(OutsideGridException, failed, "That firing coordinate is outside the grid")
+
+        x, y = coordinates[:, 0], coordinates[:, 1]
+        failed = self.shots[games, player, x, y]
+        if failed.any():
+            reject(RepeatFireException, failed, "Player has already fired there")
+
+        self.shots[games, player, x, y] = True
+        self.last_shot[games, player] = coordinates
+
+        self.ready[games, player] = True
+        self.increment_state(games)
+
+    # Resolves the player's last shot in the selected games, like
+    # Game.check_player_hit. Returns the ID of the ship hit (0 for a miss)
+    # and whether it was sunk, as arrays
+    def check_player_hit(self, player, games=None):
+        games = self.selected(games)
+        target = 1 - player
+        x, y = self.last_shot[games, player, 0], self.last_shot[games, player, 1]
+
+        ship_hit = self.ships[games, target, x, y]
+        # A cell only counts once, so the same shot can be checked again
+        new_hit = (ship_hit > 0) & ~self.hits[games, target, x, y]
+        self.hits[games, target, x, y] |= new_hit
+
+        np.subtract.at(self.remaining, (games, target, ship_hit),
+                       new_hit.astype(np.int16))
+        ship_sunk = (ship_hit > 0) & (self.remaining[games, target, ship_hit] == 0)
+        np.subtract.at(self.afloat, (games, target),
+                       (new_hit & ship_sunk).astype(np.int16))
+
+        return ship_hit, ship_sunk
+
+    # Returns the opponent's firing coordinates and the hit/sunk arrays for
+    # the selected games, like Game.incoming
+    def incoming(self, player, games=None):
+        games = self.selected(games)
+
+        if (self.state[games] != 1).any():
+            raise OutOfTurnException("Both players did not fire")
+
+        ship_hit, ship_sunk = self.check_player_hit(1 - player, games)
+        firing_coordinates = self.last_shot[games, 1 - player]
+
+        self.ready[games, player] = True
+        self.increment_state(games)
+        return (firing_coordinates, ship_hit, ship_sunk)
+
+    def outgoing(self, player, games=None):
+        games = self.selected(games)
+
+        if (self.state[games] != 2).any():
+            raise OutOfTurnException("Both players did not call incoming")
+
+        ship_hit, ship_sunk = self.check_player_hit(player, games)
+        firing_coordinates = self.last_shot[games, player]
+
+        self.ready[games, player] = True
+        self.increment_state(games)
+        return (firing_coordinates, ship_hit, ship_sunk)
+
+    # Plays one full round in the selected games and returns each player's
+    # outgoing hit/sunk arrays
+    def play_round(self, coordinates1, coordinates2, games=None):
+        games = self.selected(games)
+        self.fire(0, coordinates1, games)
+        self.fire(1, coordinates2, games)
+        self.incoming(0, games)
+        self.incoming(1, games)
+        hit1 = self.outgoing(0, games)[1:]
+        hit2 = self.outgoing(1, games)[1:]
+        return hit1, hit2
+
+    def increment_state(self, games):
+        advance = games[self.ready[games].all(axis=1)]
+        self.state[advance] = (self.state[advance] + 1) % 3
+        self.ready[advance] = False
+
+    # Boolean array of the players that had ships and lost all of them
+    def fleet_sunk(self):
+        return (self.ship_count > 0) & (self.afloat == 0)
+
+    def game_over(self):
+        return self.fleet_sunk().any(axis=1)
+
+    # The player (0 or 1) that won each game, or -1 if the game is not over
+    # or both fleets were sunk in the same round
+    def winner(self):
+        sunk = self.fleet_sunk()
+        winner = np.full(self.count, -1, dtype=np.int8)
+        winner[sunk[:, 1] & ~sunk[:, 0]] = 0
+        winner[sunk[:, 0] & ~sunk[:, 1]] = 1
+        return winner
@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 
-import random # to generate a ID
+import threading
+import placement
+
+# Guards the lazy creation of every Game's condition variable
+condition_lock = threading.Lock()
 
 
 class OutsideGridException(Exception):
@@ -18,8 +22,23 @@ class GameInitializedException(Exception):
 class RepeatFireException(Exception):
     pass
 
+class SalvoSizeException(Exception):
+    pass
+
+class RulesetException(Exception):
+    pass
+
+class OpponentLeftException(Exception):
+    pass
+
+# Game salvo setting where each player fires one shot per ship they have
+# afloat
+SHIPS_AFLOAT = -1
+
 class Ship:
 
+    __slots__ = ('id', 'coordinates')
+
     def __init__(self, id, coordinates = None):
         self.id = id
         if coordinates:
@@ -33,10 +52,13 @@ class Ship:
 
 class Player:
 
+    __slots__ = ('name', 'ships', 'firing_coordinates', 'fired', 'ready')
+
     def __init__(self, name):
         self.name = name 
         self.ships = []
         self.firing_coordinates = [] # list of coordinates in tuple form
+        self.fired = set() # the same coordinates, for repeat fire checks
         self.ready = False # Player ready to transition to next state
 
     # Returns true if the ship collides with the player's ships
@@ -47,9 +69,71 @@ class Player:
                     return True
         return False
 
+class Fleet:
+    '''Index from coordinate to ship for one player's ships, so a shot is
+    resolved with one dictionary lookup. It also counts the cells left on
+    every ship and the ships left afloat, so sinks and the end of the game
+    are known without rescanning the shots.
+
+    Coordinates are stored as tuples; the XML-RPC server hands them to the
+    game as lists.'''
+
+    __slots__ = ('cells', 'remaining', 'hit_cells', 'afloat', 'ship_list',
+                 'ship_count')
+
+    def __init__(self):
+        self.cells = dict() # coordinate -> Ship
+        self.remaining = dict() # Ship -> cells that have not been hit
+        self.hit_cells = set() # coordinates of the ship cells that were hit
+        self.afloat = 0 # ships with cells that have not been hit
+        # The Player.ships list the index was built from, and how many of
+        # its ships have been indexed
+        self.ship_list = None
+        self.ship_count = 0
+
+    def add(self, ship):
+        cells = set( tuple(c) for c in ship.coordinates )
+        for c in cells:
+            self.cells[c] = ship
+        self.remaining[ship] = len(cells)
+        if cells:
+            self.afloat += 1
+        self.ship_count += 1
+
+    # Records a shot on the fleet and returns the ship that was hit, or None.
+    # A cell only counts once, so the same shot can be checked again
+    def hit(self, coordinates):
+        cell = tuple(coordinates)
+        ship = self.cells.get(cell)
+        if ship is not None and cell not in self.hit_cells:
+            self.hit_cells.add(cell)
+            self.remaining[ship] -= 1
+            if not self.remaining[ship]:
+                self.afloat -= 1
+        return ship
+
+    def is_sunk(self, ship):
+        return self.remaining[ship] == 0
+
+    # True once the fleet had ships and all of them were sunk
+    def destroyed(self):
+        return self.ship_count > 0 and self.afloat == 0
+
+    def clear(self):
+        self.cells.clear()
+        self.remaining.clear()
+        self.hit_cells.clear()
+        self.afloat = 0
+        self.ship_count = 0
+
 class Game:
 
-    def __init__(self, grid):
+    __slots__ = ('player1', 'player2', 'grid', 'state', 'fleets', 'journal',
+                 'journal_id', 'changed', 'salvo', 'salvos', 'left')
+
+    # salvo is the number of shots each player fires per round, or
+    # SHIPS_AFLOAT. None is the classic one shot game
+    def __init__(self, grid, salvo=None):
         self.player1 = None
         self.player2 = None
         self.grid = grid
@@ -65,6 +149,27 @@ class Game:
         # 1 = Ready for incoming
         # 2 = Ready for outgoing
 
+        # Player -> Fleet, the player's ships indexed by coordinate
+        self.fleets = dict()
+
+        # The journal.Journal the game writes its moves to, if any, and the
+        # game's ID in it
+        self.journal = None
+        self.journal_id = 0
+
+        # threading.Condition notified when the state changes. It is only
+        # created once something waits on the game
+        self.changed = None
+
+        # The player that left the game before it was over, if any, see
+        # server.GameManager.deregister_player
+        self.left = None
+
+        self.salvo = salvo
+        # Player -> [coordinates of the player's last salvo, their results
+        # once the salvo is resolved], in salvo games
+        self.salvos = dict()
+
 
     # TODO: raise an Error if ship is on top of another
     #       return the length of the ship
@@ -73,10 +178,38 @@ class Game:
         if any( not self.point_inside_grid(c) for c in ship.coordinates ):
             raise OutsideGridException("A point on the ship is outside the coordinate")
 
-        if player.ship_collides(ship):
+        fleet = self.fleet(player)
+
+        if any( tuple(c) in fleet.cells for c in ship.coordinates ):
             raise ShipCollisionException("The ship collides with another ship on the grid")
         
+        # Journaled first, so a ship the journal refuses is not placed
+        if self.journal is not None:
+            self.journal.add_ship(self, player, ship)
         player.ships.append(ship)
+        fleet.add(ship)
+
+    # Returns the player's Fleet, updated with any ships that were appended
+    # to Player.ships without going through add_ship
+    def fleet(self, player):
+        fleet = self.fleets.get(player)
+        if fleet is None:
+            fleet = self.fleets[player] = Fleet()
+
+        if fleet.ship_list is not player.ships:
+            fleet.clear()
+            fleet.ship_list = player.ships
+
+        if fleet.ship_count < len(player.ships):
+            for ship in player.ships[fleet.ship_count:]:
+                fleet.add(ship)
+            # The new ships may already have been fired on
+            other_player = self.other_player(player)
+            if other_player:
+                for c in other_player.firing_coordinates:
+                    fleet.hit(c)
+
+        return fleet
     
     # Initialize the game 
     # Input :
@@ -91,9 +224,13 @@ class Game:
         if self.player1 and self.player2: #to check if the game is already init
             raise GameInitializedException("Game Already initialized")
         else:
+            # Journaled first, like add_ship
+            if self.journal is not None:
+                self.journal.init_game(self, player1, player2)
             self.player1 = player1
             self.player2 = player2
             self.state = 0
+            self.notify()
 
     # Checks to see if Game is ready by Tim Broadwell
     # The frontend queries this to see if the game is ready
@@ -116,6 +253,9 @@ class Game:
     #        coordinates to fire to
     def fire(self, player, coordinates):
 
+        if self.salvo:
+            return self.fire_salvo(player, [coordinates])
+
         if self.state != 0:
             raise OutOfTurnException("You can't fire yet")
 
@@ -125,14 +265,25 @@ class Game:
         if not self.point_inside_grid(coordinates):
             raise OutsideGridException("That firing coordinate is outside the grid")
 
-        if coordinates in player.firing_coordinates:
+        if self.already_fired(player, coordinates):
            raise RepeatFireException("Player has already fired there") 
 
-        player.firing_coordinates.append(coordinates)
+        if self.journal is not None:
+            self.journal.fire(self, player, coordinates)
+        self.record_shot(player, coordinates)
 
         player.ready = True
         self.increment_state();
 
+    # Returns true if the player has fired on the coordinates before
+    def already_fired(self, player, coordinates):
+        return tuple(coordinates) in player.fired
+
+    # Adds the coordinates to the player's firing history
+    def record_shot(self, player, coordinates):
+        player.firing_coordinates.append(coordinates)
+        player.fired.add(tuple(coordinates))
+
     # Returns true if the other player fired
     # Input: 
     #         gameid
@@ -151,12 +302,17 @@ class Game:
     #          if they sunk the ship
     def incoming(self, player):
 
+        if self.salvo:
+            return self.incoming_salvo(player)[-1]
+
         if not self.incoming_ready(player):
             raise OutOfTurnException("Both players did not fire")
 
         other_player = self.other_player(player)
         ship_hit, ship_sunk = self.check_player_hit(other_player)
         firing_coordinates = other_player.firing_coordinates[-1]
+        if self.journal is not None:
+            self.journal.incoming(self, player)
 
         player.ready = True
         self.increment_state()
@@ -167,16 +323,118 @@ class Game:
 
     def outgoing(self, player):
 
+        if self.salvo:
+            return self.outgoing_salvo(player)[-1]
+
         if not self.outgoing_ready(player):
             raise OutOfTurnException("Both players did not call incoming")
         
         ship_hit, ship_sunk = self.check_player_hit(player)
         firing_coordinates = player.firing_coordinates[-1]
+        if self.journal is not None:
+            self.journal.outgoing(self, player)
 
         player.ready = True
         self.increment_state()
         return (firing_coordinates, ship_hit, ship_sunk)
 
+    # The number of shots the player fires this round
+    def salvo_size(self, player):
+        if self.salvo == SHIPS_AFLOAT:
+            return self.ships_afloat(player)
+        return self.salvo or 1
+
+    def ships_afloat(self, player):
+        return self.fleet(player).afloat
+
+    # Fires all of the player's shots for the round at once. The whole salvo
+    # is checked before any of it is recorded
+    def fire_salvo(self, player, salvo):
+
+        if self.state != 0:
+            raise OutOfTurnException("You can't fire yet")
+
+        if player.ready:
+            raise OutOfTurnException("You can't fire twice per round")
+
+        if len(salvo) != self.salvo_size(player):
+            raise SalvoSizeException("You must fire {0} shots this round"
+                                     .format(self.salvo_size(player)))
+
+        if not all(self.point_inside_grid(c) for c in salvo):
+            raise OutsideGridException("That firing coordinate is outside the grid")
+
+        cells = set( tuple(c) for c in salvo )
+        if len(cells) != len(salvo) or any(self.already_fired(player, c) for c in cells):
+            raise RepeatFireException("Player has already fired there")
+
+        if self.journal is not None:
+            self.journal.fire_salvo(self, player, salvo)
+        for c in salvo:
+            self.record_shot(player, c)
+        if self.salvo:
+            self.salvos[player] = [list(salvo), None]
+
+        player.ready = True
+        self.increment_state()
+
+    # Returns a list with (coordinates, ship hit, ship sunk) for every shot
+    # of the player's last salvo. A ship the salvo sinks is reported sunk on
+    # the salvo's last hit on it
+    def salvo_results(self, player_firing):
+        if not self.salvo:
+            ship_hit, ship_sunk = self.check_player_hit(player_firing)
+            return [ (player_firing.firing_coordinates[-1], ship_hit, ship_sunk) ]
+
+        salvo = self.salvos[player_firing]
+        if salvo[1] is None:
+            salvo[1] = self.check_salvo_hits(player_firing, salvo[0])
+        return salvo[1]
+
+    def check_salvo_hits(self, player_firing, salvo):
+        fleet = self.fleet(self.other_player(player_firing))
+        ships = [fleet.hit(c) for c in salvo]
+
+        # The fleet may have counted the whole salvo already, so the shot
+        # that sank a ship is the salvo's last hit on it
+        results = []
+        later_hits = set()
+        for c, ship_hit in reversed(list(zip(salvo, ships))):
+            ship_sunk = ship_hit is not None and ship_hit not in later_hits \
+                        and fleet.is_sunk(ship_hit)
+            later_hits.add(ship_hit)
+            results.append( (c, ship_hit, ship_sunk) )
+        results.reverse()
+        return results
+
+    # Relays the results of the other player's salvo, like incoming
+    def incoming_salvo(self, player):
+
+        if not self.incoming_ready(player):
+            raise OutOfTurnException("Both players did not fire")
+
+        results = self.salvo_results(self.other_player(player))
+        if self.journal is not None:
+            self.journal.incoming(self, player)
+
+        player.ready = True
+        self.increment_state()
+        return results
+
+    # Relays the results of the player's own salvo, like outgoing
+    def outgoing_salvo(self, player):
+
+        if not self.outgoing_ready(player):
+            raise OutOfTurnException("Both players did not call incoming")
+
+        results = self.salvo_results(player)
+        if self.journal is not None:
+            self.journal.outgoing(self, player)
+
+        player.ready = True
+        self.increment_state()
+        return results
+
     # Convenience method to return the other player
     def other_player(self, player):
         if player == self.player1:
@@ -199,18 +457,37 @@ class Game:
 
         firing_coordinates = player_firing.firing_coordinates[-1]
 
-        ship_hit = None # The ship that was hit
+        fleet = self.fleet(self.other_player(player_firing))
+        ship_hit = fleet.hit(firing_coordinates) # The ship that was hit
         ship_sunk = False
-        for s in self.other_player(player_firing).ships:
-            if firing_coordinates in s.coordinates:
-                ship_hit = s
-                break
         
         if ship_hit:
-            if ship_hit.is_sunk(player_firing.firing_coordinates):
-                ship_sunk = True
+            ship_sunk = fleet.is_sunk(ship_hit)
                 
         return (ship_hit, ship_sunk)
+
+    # Returns true if all of the player's ships have been sunk
+    def fleet_sunk(self, player):
+        return self.fleet(player).destroyed()
+
+    # Returns true once either player has lost all of their ships
+    def game_over(self):
+        if not self.player1 or not self.player2:
+            return False
+        return self.fleet_sunk(self.player1) or self.fleet_sunk(self.player2)
+
+    # Returns the player that sunk all of the other player's ships. Returns
+    # None if the game is not over, or if both fleets were sunk in the same
+    # round
+    def winner(self):
+        if not self.game_over():
+            return None
+
+        player1_sunk = self.fleet_sunk(self.player1)
+        player2_sunk = self.fleet_sunk(self.player2)
+        if player1_sunk and player2_sunk:
+            return None
+        return self.player2 if player1_sunk else self.player1
         
     def players_ready(self):
         return self.player1.ready and self.player2.ready
@@ -219,6 +496,35 @@ class Game:
         if self.players_ready():
             self.state = (self.state + 1) % 3
             self.player1.ready = self.player2.ready = False
+            self.notify()
+
+    # The condition waiters wait on. Its lock is also the game's lock, which
+    # the server holds around every call it makes on the game
+    def condition(self):
+        if self.changed is None:
+            with condition_lock:
+                if self.changed is None:
+                    self.changed = threading.Condition()
+        return self.changed
+
+    # Wakes up the threads waiting on the game
+    def notify(self):
+        changed = self.changed
+        if changed is not None:
+            with changed:
+                changed.notify_all()
+
+    # Blocks until predicate() is true or the timeout, in seconds, runs out.
+    # Returns the last result of predicate()
+    def wait_for(self, predicate, timeout=None):
+        changed = self.condition()
+        with changed:
+            return changed.wait_for(predicate, timeout)
+
+    # Blocks until the game reaches the state. Returns false if the timeout
+    # ran out first
+    def wait_for_state(self, state, timeout=None):
+        return self.wait_for(lambda: self.state == state, timeout)
 
     def point_inside_grid(self, point):
 
@@ -228,3 +534,154 @@ class Game:
         return x_inside and y_inside
 
 
+class Bitboard:
+    '''One player's ships and shots stored as integer bitmasks over the grid.
+    Cell (x, y) of a (w, h) grid is bit x * h + y.'''
+
+    __slots__ = ('fleet', 'ships', 'shots', 'resolved', 'ship_list', 'shot_count')
+
+    def __init__(self):
+        self.fleet = 0 # Every cell covered by one of the player's ships
+        self.ships = [] # (mask, ship) pairs in placement order
+        self.shots = 0 # Every cell the player has fired on
+        # The shots whose hits count, like the hits of a Fleet: those
+        # resolved by incoming or outgoing
+        self.resolved = 0
+
+        # The ship list and shot count the masks were built from. Ships can
+        # be appended to Player.ships directly, so the masks are brought up
+        # to date before they are used
+        self.ship_list = None
+        self.shot_count = 0
+
+class BitboardGame(Game):
+    '''A Game that keeps every fleet and shot history as bitmasks, so
+    collisions, hits and sinks are single AND/compare operations instead of
+    scans over the coordinate lists.
+
+    The Ship and Player objects are still updated, so the frontends and the
+    server can use a BitboardGame anywhere they use a Game.'''
+
+    __slots__ = ('bitboards',)
+
+    def __init__(self, grid, salvo=None):
+        super(BitboardGame, self).__init__(grid, salvo)
+        # Player -> Bitboard
+        self.bitboards = dict()
+
+    def cell_mask(self, point):
+        return 1 << (point[0] * self.grid[1] + point[1])
+
+    def ship_mask(self, ship):
+        # Straight ships on small grids have their mask precomputed
+        cells = self.grid[0] * self.grid[1]
+        if ship.coordinates and cells <= placement.MASK_TABLE_MAX_CELLS:
+            table = placement.placement_table(self.grid, len(ship.coordinates))
+            index = table.find(ship.coordinates)
+            if index is not None:
+                table.build_masks()
+                return table.masks[index]
+
+        mask = 0
+        for c in ship.coordinates:
+            mask |= self.cell_mask(c)
+        return mask
+
+    # Returns the player's Bitboard, updated with any ships or shots that
+    # were added without going through the game
+    def bitboard(self, player):
+        board = self.bitboards.get(player)
+        if board is None:
+            board = self.bitboards[player] = Bitboard()
+
+        if board.ship_list is not player.ships:
+            board.fleet = 0
+            board.ships = []
+            board.ship_list = player.ships
+
+        for ship in player.ships[len(board.ships):]:
+            mask = self.ship_mask(ship)
+            board.fleet |= mask
+            board.ships.append( (mask, ship) )
+
+        # Shots added without the game, like those of a replayed game,
+        # count as resolved, as Game.fleet counts them
+        for c in player.firing_coordinates[board.shot_count:]:
+            board.shots |= self.cell_mask(c)
+            board.resolved |= self.cell_mask(c)
+        board.shot_count = len(player.firing_coordinates)
+
+        return board
+
+    def add_ship(self, player, ship):
+
+        if any( not self.point_inside_grid(c) for c in ship.coordinates ):
+            raise OutsideGridException("A point on the ship is outside the coordinate")
+
+        board = self.bitboard(player)
+        mask = self.ship_mask(ship)
+
+        if board.fleet & mask:
+            raise ShipCollisionException("The ship collides with another ship on the grid")
+
+        if self.journal is not None:
+            self.journal.add_ship(self, player, ship)
+        player.ships.append(ship)
+        board.fleet |= mask
+        board.ships.append( (mask, ship) )
+
+    def already_fired(self, player, coordinates):
+        return bool(self.bitboard(player).shots & self.cell_mask(coordinates))
+
+    def record_shot(self, player, coordinates):
+        board = self.bitboard(player)
+        super(BitboardGame, self).record_shot(player, coordinates)
+        board.shots |= self.cell_mask(coordinates)
+        board.shot_count += 1
+
+    def check_player_hit(self, player_firing):
+
+        board = self.bitboard(player_firing)
+        target = self.bitboard(self.other_player(player_firing))
+        cell = self.cell_mask(player_firing.firing_coordinates[-1])
+        board.resolved |= cell
+
+        if not target.fleet & cell:
+            return (None, False)
+
+        for mask, ship in target.ships:
+            if mask & cell:
+                return (ship, mask & board.resolved == mask)
+
+    def fleet_sunk(self, player):
+        board = self.bitboard(player)
+        resolved = self.bitboard(self.other_player(player)).resolved
+        return bool(board.ships) and board.fleet & resolved == board.fleet
+
+    def ships_afloat(self, player):
+        board = self.bitboard(player)
+        resolved = self.bitboard(self.other_player(player)).resolved
+        return sum(1 for mask, ship in board.ships if mask & resolved != mask)
+
+    def check_salvo_hits(self, player_firing, salvo):
+        board = self.bitboard(player_firing)
+        target = self.bitboard(self.other_player(player_firing))
+        cells = [self.cell_mask(c) for c in salvo]
+
+        # Each shot is checked against the shots resolved before it
+        shots = board.resolved
+        for cell in cells:
+            shots &= ~cell
+
+        results = []
+        for c, cell in zip(salvo, cells):
+            shots |= cell
+            result = (c, None, False)
+            if target.fleet & cell:
+                for mask, ship in target.ships:
+                    if mask & cell:
+                        result = (c, ship, mask & shots == mask)
+                        break
+            results.append(result)
+        board.resolved |= shots
+        return results
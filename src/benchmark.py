@@ -0,0 +1,850 @@
+#!/usr/bin/env python3
+'''Benchmarks for the game engine and the server.
+
+Run one by name, for example:
+    $ python3 benchmark.py repeat_fire
+'''
+
+import battleship, server, async_server, simulator, placement, snapshot, journal
+import matchmaking, shard
+import wire, xmlrpc.client
+import asyncio, gc, io, multiprocessing, os, pickle, random, socket, sys
+import threading, time, tracemalloc
+from xmlrpc.client import ServerProxy
+from xmlrpc.server import SimpleXMLRPCServer
+from battleship import *
+from ai import ProbabilityStrategy
+
+
+class ListGame(Game):
+    # The repeat fire check as it was before Player kept a set of the fired
+    # coordinates. Used as the baseline
+    def already_fired(self, player, coordinates):
+        return coordinates in player.firing_coordinates
+
+
+def bench_repeat_fire(grid=300, shots=20000, window=2000):
+    '''Per-shot cost of Game.fire as the firing history grows.
+
+    Both players fire on every cell of an empty grid in a random order.
+    The cost of the fire calls is reported for every window of shots, once
+    for Game and once for the old list scan.'''
+
+    cells = [(x, y) for x in range(grid) for y in range(grid)]
+    random.seed(0)
+    random.shuffle(cells)
+    cells = cells[:shots]
+
+    results = []
+    for game_class in [Game, ListGame]:
+        game = game_class( (grid, grid) )
+        player1, player2 = Player("1"), Player("2")
+        game.init_game(player1, player2)
+
+        timings = []
+        elapsed = 0
+        for i, c in enumerate(cells):
+            start = time.perf_counter()
+            game.fire(player1, c)
+            game.fire(player2, c)
+            elapsed += time.perf_counter() - start
+
+            game.incoming(player1)
+            game.incoming(player2)
+            game.outgoing(player1)
+            game.outgoing(player2)
+
+            if (i + 1) % window == 0:
+                timings.append(elapsed / (2 * window))
+                elapsed = 0
+        results.append(timings)
+
+    print("{0}x{0} grid, microseconds per shot".format(grid))
+    print("{:>8} {:>10} {:>10}".format("shots", "set", "list"))
+    for i, (fast, slow) in enumerate(zip(*results)):
+        print("{:>8} {:>10.2f} {:>10.2f}".format((i + 1) * window,
+                                                 fast * 1e6, slow * 1e6))
+
+
+def without_slots(cls, *bases):
+    '''A copy of a slotted class that keeps its attributes in a __dict__, as
+    the classes did before they used __slots__. Used as the baseline.'''
+    namespace = dict(vars(cls))
+    for name in cls.__slots__ + ('__slots__',):
+        namespace.pop(name, None)
+    return type(cls.__name__, bases or (object,), namespace)
+
+def fill_manager(games):
+    '''Returns the memory used by a GameManager holding the given number of
+    proposed games, then the same number of games with both fleets placed'''
+
+    gc.collect()
+    tracemalloc.start()
+
+    manager = server.GameManager()
+    for i in range(2 * games):
+        player = server.OnlinePlayer("Player " + str(i))
+        player.online_id = i
+        manager.online_players[i] = player
+        manager.register_player(player)
+    proposed = tracemalloc.get_traced_memory()[0]
+
+    for player in manager.online_players.values():
+        manager.accept_opponent(player)
+    for player in manager.online_players.values():
+        manager.add_ship(player, server.Ship("A", [(0,0), (0,1)]))
+        manager.add_ship(player, server.Ship("B", [(2,0), (2,1), (2,2)]))
+    started = tracemalloc.get_traced_memory()[0]
+
+    tracemalloc.stop()
+    del manager
+    gc.collect()
+    return proposed, started
+
+def bench_memory(games=100000):
+    '''Bytes per game held by a GameManager, with the __slots__ classes and
+    with copies of them that use a __dict__.'''
+
+    slotted = fill_manager(games)
+
+    dict_player = without_slots(Player)
+    originals = [ (battleship, 'Fleet'), (server, 'Game'), (server, 'Ship'),
+                  (server, 'OnlinePlayer'), (server, 'ProposedGame') ]
+    replacements = [ without_slots(Fleet), without_slots(Game),
+                     without_slots(Ship),
+                     without_slots(server.OnlinePlayer, dict_player),
+                     without_slots(server.ProposedGame) ]
+
+    saved = [getattr(module, name) for module, name in originals]
+    for (module, name), cls in zip(originals, replacements):
+        setattr(module, name, cls)
+    try:
+        unslotted = fill_manager(games)
+    finally:
+        for (module, name), cls in zip(originals, saved):
+            setattr(module, name, cls)
+
+    print("{0} games, bytes per game".format(games))
+    print("{:>16} {:>10} {:>10}".format("", "__dict__", "__slots__"))
+    for i, phase in enumerate(["proposed", "ships placed"]):
+        print("{:>16} {:>10.0f} {:>10.0f}".format(phase,
+                unslotted[i] / games, slotted[i] / games))
+
+
+def bench_ai_latency(games=20):
+    '''Time the probability AI takes to pick a shot and to take in its
+    result, on 10x10 and 100x100 grids with the standard fleet.'''
+
+    print("{:>10} {:>12} {:>12} {:>12}".format("grid", "setup ms",
+                                                "mean ms", "max ms"))
+    for size in [10, 100]:
+        grid = (size, size)
+        setup, moves = [], []
+        for seed in range(games if size == 10 else 2):
+            rng = random.Random(seed)
+            game = Game(grid)
+            player = Player("1")
+            placement.place_fleet(game, player, simulator.standard_fleet, rng)
+            fleet = game.fleet(player)
+
+            start = time.perf_counter()
+            strategy = ProbabilityStrategy(grid, simulator.standard_fleet, rng)
+            setup.append(time.perf_counter() - start)
+
+            while not fleet.destroyed():
+                start = time.perf_counter()
+                coordinates = strategy.next_shot()
+                ship = fleet.hit(coordinates)
+                strategy.record(coordinates, ship, ship is not None and fleet.is_sunk(ship))
+                moves.append(time.perf_counter() - start)
+
+        print("{:>10} {:>12.2f} {:>12.3f} {:>12.3f}".format(
+            "{0}x{0}".format(size), 1000 * sum(setup) / len(setup),
+            1000 * sum(moves) / len(moves), 1000 * max(moves)))
+
+
+def bench_snapshot(games=100000, rounds=20):
+    '''Games per second encoded and decoded by snapshot, and the size of
+    the snapshots, with pickle as the baseline. The games are 10x10 with the
+    standard fleet and the given number of rounds played.'''
+
+    rng = random.Random(0)
+    cells = [(x, y) for x in range(10) for y in range(10)]
+    played = []
+    for i in range(1000):
+        game = Game( (10,10) )
+        players = [Player("Player 1"), Player("Player 2")]
+        game.init_game(*players)
+        for player in players:
+            placement.place_fleet(game, player, simulator.standard_fleet, rng)
+        shots = [rng.sample(cells, rounds) for player in players]
+        for r in range(rounds):
+            for player, player_shots in zip(players, shots):
+                game.fire(player, player_shots[r])
+            for player in players:
+                game.incoming(player)
+            for player in players:
+                game.outgoing(player)
+        played.append(game)
+    played = (played * (games // len(played) + 1))[:games]
+
+    codecs = [ ("snapshot", snapshot.encode, snapshot.decode),
+               ("pickle", pickle.dumps, pickle.loads) ]
+
+    print("{0} games, {1} rounds each".format(games, rounds))
+    print("{:>10} {:>8} {:>14} {:>14}".format("", "bytes", "encode/s", "decode/s"))
+    for name, encode, decode in codecs:
+        start = time.perf_counter()
+        encoded = [encode(g) for g in played]
+        encode_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for data in encoded:
+            decode(data)
+        decode_time = time.perf_counter() - start
+
+        size = sum(len(data) for data in encoded) / games
+        print("{:>10} {:>8.0f} {:>14.0f} {:>14.0f}".format(name, size,
+                games / encode_time, games / decode_time))
+
+
+def bench_journal(games=5000):
+    '''Cost of leaving the journal on while games are played, and how fast
+    journal.replay rebuilds the games compared to playing them. The games
+    are 10x10 hunt against random games with the standard fleet.'''
+
+    # The moves of each game, played once up front
+    recorded = journal.Journal(buffer_size=1 << 30)
+    for seed in range(games):
+        game = Game( (10,10) )
+        recorded.attach(game)
+        play_strategies(game, seed)
+    moves = recorded.getvalue()
+
+    timings = []
+    for journal_on in [False, True]:
+        log = journal.Journal(open(os.devnull, 'wb'))
+        start = time.perf_counter()
+        for seed in range(games):
+            game = Game( (10,10) )
+            if journal_on:
+                log.attach(game)
+            play_strategies(game, seed)
+        log.flush()
+        timings.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    journal.replay(moves)
+    replay_time = time.perf_counter() - start
+
+    print("{0} games, {1:.0f} bytes of journal per game".format(games, len(moves) / games))
+    print("{:>24} {:>12}".format("", "games/s"))
+    print("{:>24} {:>12.0f}".format("played", games / timings[0]))
+    print("{:>24} {:>12.0f}".format("played with journal", games / timings[1]))
+    print("{:>24} {:>12.0f}".format("replayed", games / replay_time))
+
+# Plays a hunt against random game to the end, the same moves for the seed
+def play_strategies(game, seed):
+    rng = random.Random(seed)
+    players = [Player("1"), Player("2")]
+    game.init_game(*players)
+    strategies = []
+    for player, strategy_class in zip(players, [simulator.HuntTargetStrategy,
+                                                simulator.RandomStrategy]):
+        placement.place_fleet(game, player, simulator.standard_fleet, rng)
+        strategies.append(strategy_class(game.grid, simulator.standard_fleet, rng))
+
+    while not game.game_over():
+        for player, strategy in zip(players, strategies):
+            game.fire(player, strategy.next_shot())
+        for player in players:
+            game.incoming(player)
+        for player, strategy in zip(players, strategies):
+            strategy.record(*game.outgoing(player))
+
+
+def bench_concurrency(clients=(1, 2, 4, 8, 16), seconds=3.0):
+    '''RPC throughput of the XML-RPC server as the number of clients grows,
+    for the single-threaded server and server.ThreadedXMLRPCServer.
+
+    The server runs on a thread of this process and every client is a
+    process of its own, playing 10x10 games with the standard fleet through
+    fire, incoming and outgoing as fast as it can. Each server is run again
+    with a stalled client, one that sends half a request and then nothing,
+    as a slow or stuck client on a real network would. The single-threaded
+    server serves nobody else until it gives up, the threaded server serves
+    the others. The calls can run on many cores only if the clients do: the
+    server shares one interpreter lock, see the sharded server for scaling
+    the server itself.'''
+
+    print("{0} cores, calls per second over {1:.0f}s".format(os.cpu_count(), seconds))
+    print("{:>8} {:>16} {:>16} {:>16} {:>16}".format(
+        "clients", "single", "single stalled", "threaded", "threaded stalled"))
+    for n in clients:
+        row = []
+        for server_class in [SimpleXMLRPCServer, server.ThreadedXMLRPCServer]:
+            for stalled in [False, True]:
+                row.append(serve_clients(server_class, n, stalled, seconds) / seconds)
+        print("{:>8} {:>16.0f} {:>16.0f} {:>16.0f} {:>16.0f}".format(n, *row))
+
+# Runs the server with n clients, and returns how many calls they made
+def serve_clients(server_class, n, stalled, seconds):
+    manager = server.GameManager()
+    rng = random.Random(0)
+    # Enough games that no client runs out
+    games = [ [new_online_game(manager, rng) for i in range(50)] for c in range(n) ]
+
+    rpc_server = server_class(("127.0.0.1", 0), allow_none=True, logRequests=False)
+    rpc_server.register_instance(manager)
+    port = rpc_server.server_address[1]
+
+    thread = threading.Thread(target=rpc_server.serve_forever)
+    thread.start()
+
+    if stalled:
+        stalled_client = socket.create_connection(("127.0.0.1", port))
+        stalled_client.sendall(b"POST /RPC2 HTTP/1.0\r\n")
+
+    with multiprocessing.Pool(n) as pool:
+        calls = sum(pool.map(play_online_games,
+                             [(port, g, seconds) for g in games]))
+
+    if stalled:
+        stalled_client.close()
+    rpc_server.shutdown()
+    rpc_server.server_close()
+    thread.join()
+    return calls
+
+# Adds a game with both fleets placed to the manager, and returns the
+# players as the clients send them
+def new_online_game(manager, rng):
+    players = [server.OnlinePlayer("1"), server.OnlinePlayer("2")]
+    while players[0].online_id == players[1].online_id or \
+          any(p.online_id in manager.online_players for p in players):
+        players = [server.OnlinePlayer("1"), server.OnlinePlayer("2")]
+    game = Game( (10,10) )
+    game.init_game(*players)
+    for player in players:
+        placement.place_fleet(game, player, simulator.standard_fleet, rng)
+    manager.add_online_game(game)
+    return [ {'name': p.name, 'online_id': p.online_id} for p in players ]
+
+# A benchmark client. Plays the games, both players firing on every cell in
+# order, until the time is up or a call times out. Returns how many calls
+# it made
+def play_online_games(args):
+    port, games, seconds = args
+    socket.setdefaulttimeout(seconds)
+    proxy = ServerProxy("http://127.0.0.1:{0}".format(port), allow_none=True)
+    calls = 0
+    deadline = time.perf_counter() + seconds
+    try:
+        for players in games:
+            for cell in ( (x, y) for x in range(10) for y in range(10) ):
+                for player in players:
+                    proxy.fire(player, cell)
+                for player in players:
+                    proxy.incoming(player)
+                for player in players:
+                    proxy.outgoing(player)
+                calls += 6
+                if time.perf_counter() > deadline:
+                    return calls
+                if proxy.game_over(players[0]):
+                    break
+                calls += 1
+    except OSError:
+        pass # Stuck behind the stalled client
+    return calls
+
+
+def bench_idle_connections(counts=(1000, 4000, 8000), games=20):
+    '''Memory held by async_server for each idle connection, and the time
+    two clients take to play a 10x10 game through pushed events while the
+    idle connections are open.
+
+    The idle clients are sockets of this process, so the open file limit
+    must allow two files per connection. Only memory allocated by Python
+    is counted, not the kernel's socket buffers.'''
+
+    print("{:>12} {:>16} {:>16}".format("connections", "bytes each", "ms per game"))
+    for count in counts:
+        push_server = async_server.PushServer()
+        gc.collect()
+        tracemalloc.start()
+        port, stop = async_server.run_in_thread(push_server, backlog=count)
+
+        idle = [socket.create_connection(("127.0.0.1", port)) for i in range(count)]
+        # Wait until the server has accepted them all
+        ping = async_server.Client("127.0.0.1", port)
+        ping.opponent_found({'name': "", 'online_id': -1})
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        rng = random.Random(0)
+        start = time.perf_counter()
+        for i in range(games):
+            play_pushed_game(port, rng)
+        elapsed = time.perf_counter() - start
+
+        print("{:>12} {:>16.0f} {:>16.2f}".format(count, size / count,
+                                                  1000 * elapsed / games))
+        ping.close()
+        for s in idle:
+            s.close()
+        stop()
+
+# Plays a game between two async_server clients, both firing on every cell
+# in order, with the events the server pushes
+def play_pushed_game(port, rng):
+    clients = [async_server.Client("127.0.0.1", port) for i in range(2)]
+    players = [server.OnlinePlayer("1"), server.OnlinePlayer("2")]
+    players[1].online_id = players[0].online_id + 1
+
+    for client, player in zip(clients, players):
+        client.register_player(player)
+    for client, player in zip(clients, players):
+        client.wait_event("opponent_found")
+        client.accept_opponent(player)
+    game = Game( (10,10) )
+    for client, player in zip(clients, players):
+        client.wait_event("opponent_responded")
+        placement.place_fleet(game, player, simulator.standard_fleet, rng)
+        for ship in player.ships:
+            client.add_ship(player, ship)
+
+    for cell in ( (x, y) for x in range(10) for y in range(10) ):
+        for client, player in zip(clients, players):
+            client.fire(player, cell)
+        for client in clients:
+            client.wait_event("outgoing")
+        if clients[0].game_over(players[0]):
+            break
+    for client in clients:
+        client.close()
+
+
+def bench_wire(calls=5000, round_trips=2000):
+    '''Bytes and microseconds per call for XML-RPC through
+    server.ExceptionTransport, async_server's JSON lines and wire.py.
+
+    The first table is the request and response of each call, encoded by
+    the client, decoded by the server, encoded by the server and decoded
+    by the client, without the network. The XML-RPC bytes are the bodies
+    only, every call also sends HTTP headers both ways. The second table
+    is round trips per second over localhost, one client calling
+    game_ready, with the threaded XML-RPC server and async_server.'''
+
+    manager = server.GameManager()
+    game = new_game_in(manager)
+    player = game.player1
+    ship = player.ships[0]
+    shot = (ship.coordinates[0], ship, False)
+    samples = [ ("fire", (player, (3, 4)), None),
+                ("add_ship", (player, ship), None),
+                ("incoming", (player,), shot),
+                ("opponent_responded", (player,), (True, True)) ]
+
+    print("{:>20} {:>24} {:>24} {:>24}".format("", "XML-RPC", "JSON", "wire"))
+    print("{:>20} {:>12}{:>12} {:>12}{:>12} {:>12}{:>12}".format(
+        "call", "bytes", "us", "bytes", "us", "bytes", "us"))
+    for method, params, result in samples:
+        row = []
+        for codec_call in [xmlrpc_call, json_call, wire_call]:
+            size = codec_call(manager, method, params, result)
+            start = time.perf_counter()
+            for i in range(calls):
+                codec_call(manager, method, params, result)
+            row += [size, (time.perf_counter() - start) / calls * 1e6]
+        print("{:>20} {:>12}{:>12.1f} {:>12}{:>12.1f} {:>12}{:>12.1f}".format(method, *row))
+
+    rpc_server = server.ThreadedXMLRPCServer(("127.0.0.1", 0), allow_none=True,
+                                             logRequests=False)
+    rpc_server.register_instance(manager)
+    thread = threading.Thread(target=rpc_server.serve_forever)
+    push_server = async_server.PushServer(manager)
+    port, stop = async_server.run_in_thread(push_server)
+    rates = []
+    thread.start()
+    clients = [ ("XML-RPC", ServerProxy("http://127.0.0.1:{0}".format(
+                    rpc_server.server_address[1]), allow_none=True,
+                    transport=server.ExceptionTransport())),
+                ("JSON", async_server.Client("127.0.0.1", port)),
+                ("wire", async_server.Client("127.0.0.1", port, codec=wire.Codec())) ]
+    for name, client in clients:
+        start = time.perf_counter()
+        for i in range(round_trips):
+            client.game_ready(player)
+        rates.append( (name, round_trips / (time.perf_counter() - start)) )
+        if name != "XML-RPC":
+            client.close()
+    rpc_server.shutdown()
+    rpc_server.server_close()
+    thread.join()
+    stop()
+
+    print()
+    print("{:>20} {:>12}".format("", "calls/s"))
+    for name, rate in rates:
+        print("{:>20} {:>12.0f}".format(name, rate))
+
+def new_game_in(manager):
+    game = Game( (10,10) )
+    game.init_game(server.OnlinePlayer("Player 1"), server.OnlinePlayer("Player 2"))
+    for player in [game.player1, game.player2]:
+        placement.place_fleet(game, player, simulator.standard_fleet, random.Random(0))
+    manager.add_online_game(game)
+    return game
+
+# Each of these makes one call without the network and returns its bytes
+def xmlrpc_call(manager, method, params, result):
+    request = xmlrpc.client.dumps(params, method, allow_none=True).encode()
+    params, method = xmlrpc.client.loads(request)
+    manager.load_params(params)
+    response = xmlrpc.client.dumps( (result,), methodresponse=True,
+                                    allow_none=True ).encode()
+    parser, unmarshaller = server.ExceptionTransport().getparser()
+    parser.feed(response)
+    parser.close()
+    unmarshaller.close()
+    return len(request) + len(response)
+
+def json_call(manager, method, params, result):
+    client, server_codec = async_server.JsonCodec(), async_server.JsonCodec(manager.load_params)
+    request = client.request(1, method, params)
+    server_codec.decode_request(request)
+    response = server_codec.result(1, method, result)
+    client.read_message(io.BytesIO(response))
+    return len(request) + len(response)
+
+def wire_call(manager, method, params, result):
+    client, server_codec = wire.Codec(), wire.Codec(manager.load_player)
+    request = client.request(1, method, params)
+    server_codec.decode_request(request[4:])
+    response = server_codec.result(1, method, result)
+    client.read_message(io.BytesIO(response))
+    return len(request) + len(response)
+
+
+class PrintingManager(server.GameManager):
+    # _dispatch as it was before the calls were timed, printing every call.
+    # Used as the baseline
+    def _dispatch(self, method, params):
+        print("dispatch!", method)
+        params = self.load_params(params)
+        return getattr(self, method)(*params)
+
+class UntimedManager(server.GameManager):
+    def _dispatch(self, method, params):
+        params = self.load_params(params)
+        return getattr(self, method)(*params)
+
+def bench_dispatch(calls=200000):
+    '''Microseconds per GameManager._dispatch of game_ready and of a fire
+    that raises, with the call timing, without it, and printing every call
+    as _dispatch used to. The printing goes to /dev/null, a terminal or a
+    log file costs more.'''
+
+    print("{:>24} {:>12} {:>12}".format("", "game_ready", "fire error"))
+    for name, manager_class in [("timed", server.GameManager),
+                                ("untimed", UntimedManager),
+                                ("printing", PrintingManager)]:
+        manager = manager_class()
+        player = new_game_in(manager).player1
+        params = ({'name': player.name, 'online_id': player.online_id},)
+        bad_shot = params + ((10, 10),)
+
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        start = time.perf_counter()
+        for i in range(calls):
+            manager._dispatch("game_ready", params)
+        ready_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(calls // 10):
+            try:
+                manager._dispatch("fire", bad_shot)
+            except OutsideGridException:
+                pass
+        error_time = time.perf_counter() - start
+        sys.stdout.close()
+        sys.stdout = stdout
+
+        print("{:>24} {:>12.2f} {:>12.2f}".format(name, ready_time / calls * 1e6,
+                                                  error_time / (calls // 10) * 1e6))
+
+
+class DictLobbyManager(server.GameManager):
+    # register_player as it was before the matchmaking.Lobby, a dictionary
+    # popped for any opponent. Used as the baseline
+    def __init__(self):
+        super(DictLobbyManager, self).__init__()
+        self.free_players = dict()
+
+    def register_player(self, player):
+        with self.free_lock:
+            self.free_players[player.online_id] = player
+            if len(self.free_players) <= 1:
+                return
+            del self.free_players[player.online_id]
+            opponent_id, opponent = self.free_players.popitem()
+
+        proposed_game = server.ProposedGame(player, opponent)
+        with self.changed:
+            self.proposed_games[player.online_id] = proposed_game
+            self.proposed_games[opponent_id] = proposed_game
+            self.notify()
+
+# Players with distinct online IDs from first on
+def numbered_players(count, first=0):
+    players = [server.OnlinePlayer(str(first + i)) for i in range(count)]
+    for i, player in enumerate(players):
+        player.online_id = first + i
+    return players
+
+# The rulesets of the grids from 1x1 up, in a random order
+def distinct_rulesets(count):
+    side = int(count ** 0.5) + 1
+    rulesets = [matchmaking.ruleset( (w, h) ) for w in range(1, side + 1)
+                for h in range(1, side + 1)][:count]
+    random.shuffle(rulesets)
+    return rulesets
+
+def bench_matchmaking(players=100000):
+    """Players a second through GameManager.register_player, against the
+    dictionary it popped before, and through a bare matchmaking.Lobby with
+    the players waiting in distinct rulesets, then expiring. The players
+    that wait are counted in bytes each."""
+
+    print("{0} players".format(players))
+    for name, manager_class in [("dict popitem", DictLobbyManager),
+                                ("lobby", server.GameManager)]:
+        manager = manager_class()
+        online = numbered_players(players)
+        start = time.perf_counter()
+        for player in online:
+            manager.register_player(player)
+        elapsed = time.perf_counter() - start
+        print("{:>28} {:>10.0f} players/s, {} games".format(
+            "register_player " + name, players / elapsed,
+            len(manager.proposed_games) // 2))
+
+    now = [0.0]
+    lobby = matchmaking.Lobby(ttl=60, clock=lambda: now[0])
+    waiting = numbered_players(players)
+    arriving = numbered_players(players, players)
+    rulesets = distinct_rulesets(players)
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    for player, ruleset in zip(waiting, rulesets):
+        lobby.add(player, ruleset)
+    queued = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print("{:>28} {:>10.0f} players/s, {:.0f} bytes a player".format(
+        "wait, distinct rulesets", players / queued, size / len(lobby)))
+
+    # Half are paired, a quarter leave, an eighth is touched and an eighth
+    # expires
+    half, quarter = players // 2, players // 4
+    now[0] = 30
+    for player in waiting[-players // 8:]:
+        lobby.touch(player.online_id)
+    start = time.perf_counter()
+    paired = sum(lobby.add(p, r) is not None
+                 for p, r in zip(arriving[:half], rulesets[:half]))
+    pairing = time.perf_counter() - start
+    start = time.perf_counter()
+    for player in waiting[half:half + quarter]:
+        lobby.remove(player.online_id)
+    removing = time.perf_counter() - start
+    now[0] = 61
+    start = time.perf_counter()
+    expired = lobby.expire()
+    expiring = time.perf_counter() - start
+    print("{:>28} {:>10.0f} players/s, {} paired".format(
+        "pair with a waiting player", half / pairing, paired))
+    print("{:>28} {:>10.0f} players/s".format("remove", quarter / removing))
+    print("{:>28} {:>10.0f} players/s, {} expired, {} left".format(
+        "expire", len(expired) / expiring, len(expired), len(lobby)))
+
+
+# Plays a 1x1 game to the end through _dispatch, then has another pair
+# reject their game and a player give up waiting
+def play_sessions(manager, first_id):
+    players = [{'name': str(first_id + i), 'online_id': first_id + i} for i in range(5)]
+    for p in players[:4]:
+        manager._dispatch("register_player", (p, (1, 1)))
+    for p in players[:2]:
+        manager._dispatch("accept_opponent", (p,))
+    for p in players[2:4]:
+        manager._dispatch("reject_opponent", (p,))
+    for p in players[:2]:
+        manager._dispatch("add_ship", (p, {'id': "A", 'coordinates': [(0, 0)]}))
+    for method in ["fire", "incoming", "outgoing", "winner"]:
+        for p in players[:2]:
+            manager._dispatch(method, (p, (0, 0)) if method == "fire" else (p,))
+    manager._dispatch("register_player", (players[4], (2, 2)))
+
+def bench_eviction(hours=1, sessions_per_second=2, sweep_interval=10):
+    """A server run for hours of simulated time with and without sweeping:
+    the players and games it holds at the end, the bytes of them, and the
+    time spent sweeping. Every second some sessions play a game, reject
+    one and give up waiting, see play_sessions."""
+
+    seconds = int(hours * 3600)
+    print("{0} simulated hours, {1} sessions a second, a sweep every {2}s".format(
+        hours, sessions_per_second, sweep_interval))
+    print("{:>10} {:>9} {:>9} {:>9} {:>9} {:>10} {:>10}".format(
+        "", "players", "games", "rejected", "waiting", "MB held", "sweep ms"))
+    for sweeping in [False, True]:
+        now = [0.0]
+        gc.collect()
+        tracemalloc.start()
+        manager = server.GameManager(clock=lambda: now[0])
+        swept = 0.0
+        sweeps = 0
+        next_id = 0
+        for second in range(seconds):
+            now[0] = second
+            for i in range(sessions_per_second):
+                play_sessions(manager, next_id)
+                next_id += 5
+            if sweeping and second % sweep_interval == 0:
+                start = time.perf_counter()
+                manager.sweep()
+                swept += time.perf_counter() - start
+                sweeps += 1
+        gc.collect()
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("{:>10} {:>9} {:>9} {:>9} {:>9} {:>10.1f} {:>10.3f}".format(
+            "sweeping" if sweeping else "not", len(manager.online_players),
+            len(manager.online_games), len(manager.rejected_games),
+            len(manager.free_players), held / 1e6,
+            swept / sweeps * 1000 if sweeps else 0))
+
+
+# A benchmark client. Plays 10x10 games between its two connections with
+# the pushed events until the time is up, and returns how many calls it
+# made. Its games have a grid of their own, so its players pair together
+def play_sharded_games(args):
+    port, index, seconds = args
+    rng = random.Random(index)
+    grid = (10, 10 + index)
+    clients = [async_server.Client("127.0.0.1", port, timeout=seconds + 30)
+               for i in range(2)]
+    calls = 0
+    next_id = index * 1000000
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        players = [server.OnlinePlayer("1"), server.OnlinePlayer("2")]
+        for player in players:
+            player.online_id = next_id
+            next_id += 1
+
+        for client, player in zip(clients, players):
+            client.register_player(player, grid)
+        for client, player in zip(clients, players):
+            client.wait_event("opponent_found")
+            client.accept_opponent(player)
+        game = Game( (10,10) )
+        for client, player in zip(clients, players):
+            client.wait_event("opponent_responded")
+            placement.place_fleet(game, player, simulator.standard_fleet, rng)
+            for ship in player.ships:
+                client.add_ship(player, ship)
+        calls += 4 + 2 * len(simulator.standard_fleet)
+
+        for cell in ( (x, y) for x in range(10) for y in range(10) ):
+            for client, player in zip(clients, players):
+                client.fire(player, cell)
+            for client in clients:
+                client.wait_event("outgoing")
+            calls += 3
+            if clients[0].game_over(players[0]) or time.perf_counter() > deadline:
+                break
+    for client in clients:
+        client.close()
+    return calls
+
+def run_router(addresses, pipe):
+    async def main():
+        tcp_server = await shard.Router(addresses).start("127.0.0.1", 0)
+        pipe.send(tcp_server.sockets[0].getsockname()[1])
+        pipe.close()
+        async with tcp_server:
+            await tcp_server.serve_forever()
+    asyncio.run(main())
+
+# CPU seconds the process has used, from /proc
+def cpu_seconds(pid):
+    with open("/proc/{0}/stat".format(pid)) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def bench_sharding(workers=(1, 2, 4), clients=8, seconds=3.0):
+    """Calls a second by clients processes playing games through a single
+    async_server process, and through the shard.Router in front of
+    each number of worker processes, with the share of a CPU the router
+    and the busiest worker used. All of them share this machine's CPUs,
+    so the scaling is capped at os.cpu_count()."""
+
+    print("{0} client processes, {1} CPUs".format(clients, os.cpu_count()))
+    print("{:>22} {:>10} {:>10} {:>12}".format("", "calls/s", "router %",
+                                                "worker % max"))
+    for count in [None] + list(workers):
+        addresses, processes = shard.start_workers(count or 1)
+        router = None
+        port = addresses[0][1]
+        if count is not None:
+            receiver, sender = multiprocessing.Pipe(False)
+            router = multiprocessing.Process(target=run_router,
+                                             args=(addresses, sender), daemon=True)
+            router.start()
+            port = receiver.recv()
+
+        watched = processes + ([router] if router else [])
+        before = [cpu_seconds(p.pid) for p in watched]
+        start = time.perf_counter()
+        with multiprocessing.Pool(clients) as pool:
+            calls = sum(pool.map(play_sharded_games,
+                                 [(port, i, seconds) for i in range(clients)]))
+        elapsed = time.perf_counter() - start
+        used = [(cpu_seconds(p.pid) - b) / elapsed * 100 for p, b in zip(watched, before)]
+
+        for p in watched:
+            p.terminate()
+            p.join()
+        name = "router, {0} workers".format(count) if count else "async_server"
+        print("{:>22} {:>10.0f} {:>10} {:>12.0f}".format(
+            name, calls / elapsed, "{:.0f}".format(used[-1]) if router else "-",
+            max(used[:len(processes)])))
+
+
+benchmarks = {
+    'ai_latency': bench_ai_latency,
+    'concurrency': bench_concurrency,
+    'dispatch': bench_dispatch,
+    'eviction': bench_eviction,
+    'idle_connections': bench_idle_connections,
+    'journal': bench_journal,
+    'matchmaking': bench_matchmaking,
+    'memory': bench_memory,
+    'repeat_fire': bench_repeat_fire,
+    'sharding': bench_sharding,
+    'snapshot': bench_snapshot,
+    'wire': bench_wire,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] not in benchmarks:
+        print("Usage: {0} [{1}]".format(sys.argv[0], "|".join(sorted(benchmarks))))
+        sys.exit(1)
+
+    benchmarks[sys.argv[1]]()
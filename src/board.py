@@ -0,0 +1,76 @@
+'''Boards for the frontends that only store the cells that were set.
+
+A SparseBoard is indexed like the list of lists the frontends used before,
+board[i][j], and iterates the same way, but every cell that was never set
+reads as the default. A board costs memory for its ships, hits and misses
+only, whatever the grid size.
+'''
+
+
+class SparseBoard:
+    '''rows lists of cols cells, all the default until they are set'''
+
+    __slots__ = ('rows', 'cols', 'default', 'cells')
+
+    def __init__(self, rows, cols, default="~"):
+        self.rows = rows
+        self.cols = cols
+        self.default = default
+        self.cells = dict() # (i, j) -> the cell, for the cells that were set
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, i):
+        return SparseRow(self, index(i, self.rows))
+
+    def __iter__(self):
+        for i in range(self.rows):
+            yield SparseRow(self, i)
+
+    def __eq__(self, other):
+        return self.tolist() == [list(row) for row in other]
+
+    def tolist(self):
+        return [list(row) for row in self]
+
+class SparseRow:
+    '''One row of a SparseBoard, made when it is indexed'''
+
+    __slots__ = ('board', 'i')
+
+    def __init__(self, board, i):
+        self.board = board
+        self.i = i
+
+    def __len__(self):
+        return self.board.cols
+
+    def __getitem__(self, j):
+        j = index(j, self.board.cols)
+        return self.board.cells.get( (self.i, j), self.board.default )
+
+    def __setitem__(self, j, value):
+        j = index(j, self.board.cols)
+        if value == self.board.default:
+            self.board.cells.pop( (self.i, j), None )
+        else:
+            self.board.cells[ (self.i, j) ] = value
+
+    def __iter__(self):
+        cells = self.board.cells
+        default = self.board.default
+        for j in range(self.board.cols):
+            yield cells.get( (self.i, j), default )
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+# Checks a list index like a list does, with negative indexes counting
+# from the end
+def index(i, length):
+    if i < 0:
+        i += length
+    if not 0 <= i < length:
+        raise IndexError("board index out of range")
+    return i
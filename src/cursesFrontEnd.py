@@ -1,5 +1,6 @@
 #! /usr/bin/env python3
 import battleship, os, traceback, curses, time, sys
+from board import SparseBoard
 
 shipInfo = [ ("Patrol Boat", 2) ]
 
@@ -22,15 +23,16 @@ class FrontEndPlayer( battleship.Player ):
         self.board = []
         self.opponentsBoard = []
         self.initBoards()
-        self.shipSunkCount = 0
         self.stdscr = curses.initscr()
 
+    # Only the cells with ships, hits and misses are stored, so large grids
+    # don't cost memory until they are played on
     def initBoards(self):
-        cols = range( self.grid[0] )
-        rows = range( self.grid[1] )
-        
-        self.board = [["~" for c in cols] for r in rows]
-        self.opponentsBoard = [["~" for c in cols] for r in rows]
+        cols = self.grid[0]
+        rows = self.grid[1]
+
+        self.board = SparseBoard(rows, cols)
+        self.opponentsBoard = SparseBoard(rows, cols)
 
 #------------------------Curses Functions------------------------------------------
 def printGenericWindow(stdscr, playerName):
@@ -316,8 +318,7 @@ def main(stdscr):
     #--------------Game Logic----------------------------------------
     if not game.game_ready():
         raise Exception("The game is unexpectedly not ready")
-    winner = None
-    while not winner:
+    while not game.game_over():
         for p in [player1, player2]:
             printWindow(p.stdscr, p.opponentsBoard, p.board, (4,2), \
                         (4, int( ( maxX) / 2)), p.name)
@@ -381,19 +382,17 @@ def main(stdscr):
             else:
                 p.opponentsBoard[ outgoingHit[0] ][ outgoingHit[1] ] = "M"
 
-            other_p = game.other_player(p)
-
             if shipSunk:
                 printPrompt( p.stdscr, "{0}, you have sunk {1} (Press enter)".format(p.name, ship.id) )
                 stdscr.getch()
-                other_p.shipSunkCount += 1
-
-            if other_p.shipSunkCount == len(shipInfo):
-                winner = p
                 
         clearScreen(p.stdscr)
 
-    printPrompt(stdscr, "Congratulations " + winner.name + ". You won!")
+    winner = game.winner()
+    if winner:
+        printPrompt(stdscr, "Congratulations " + winner.name + ". You won!")
+    else:
+        printPrompt(stdscr, "Both fleets were sunk in the same round. It's a draw!")
     stdscr.refresh()
     stdscr.getch()
     
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+'''Append-only journal of game state transitions, and a replayer.
+
+A Journal is attached to games with Journal.attach. The games then write a
+record for every init_game, add_ship, fire, incoming and outgoing that
+succeeds. Records are packed with struct into a buffer, which is written
+to the sink every buffer_size records and on flush. One journal can hold
+any number of games, told apart by the ID attach gives them. Games on
+different threads can share a journal: appending a record takes no
+lock, only writing the buffer out does.
+
+replay rebuilds the games, or one game up to any record, from the bytes
+of a journal. It applies the records without the checks the live game
+already made, and leaves the hits to the fleet index, which is built from
+the ships and shots the first time the game needs it. So it is faster
+than playing the moves.
+
+Every record starts with the record type and the game ID, then:
+
+    INIT      width, height, salvo, then for each player: online ID, name
+              length, name
+    ADD_SHIP  player, ID length, cell count, ID, x and y of every cell
+    FIRE      player, x, y
+    SALVO     player, shot count, x and y of every shot
+    INCOMING  player
+    OUTGOING  player
+
+The salvo is 0 for one shot games and 0xFFFF for SHIPS_AFLOAT.
+
+Players are 0 for player1 and 1 for player2. Ships added before init_game
+are written right after the INIT record.
+'''
+
+import collections, struct, threading
+from array import array
+from battleship import *
+
+INIT = 1
+ADD_SHIP = 2
+FIRE = 3
+INCOMING = 4
+OUTGOING = 5
+SALVO = 6
+
+SHIPS_AFLOAT_SALVO = 0xFFFF
+
+record_header = struct.Struct("<BI")
+init_record = struct.Struct("<BIHHH")
+init_player = struct.Struct("<IH")
+ship_record = struct.Struct("<BIBHH")
+fire_record = struct.Struct("<BIBHH")
+salvo_record = struct.Struct("<BIBH")
+turn_record = struct.Struct("<BIB")
+
+
+class JournalError(Exception):
+    pass
+
+class Journal:
+    '''Buffers the records of the attached games and writes them to the
+    sink, a file opened for binary writing. Without a sink the records are
+    kept in memory, see getvalue.'''
+
+    def __init__(self, sink=None, buffer_size=512):
+        self.sink = sink
+        # Packed records not written yet. deque.append is atomic, so games
+        # on several threads append without the lock
+        self.buffer = collections.deque()
+        self.buffer_size = buffer_size
+        self.data = bytearray() # everything flushed, if there is no sink
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    # Starts journaling the game. Attach it before init_game, so the
+    # journal knows the players. Returns the game's ID in the journal
+    def attach(self, game, game_id=None):
+        with self.lock:
+            if game_id is None:
+                game_id = self.next_id
+            self.next_id = max(self.next_id, game_id + 1)
+        game.journal = self
+        game.journal_id = game_id
+        return game_id
+
+    def append(self, record):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.write()
+
+    # Writes out the buffer. The caller holds the lock. Records appended
+    # meanwhile stay for the next write
+    def write(self):
+        buffer = self.buffer
+        if not buffer:
+            return
+        records = b"".join([buffer.popleft() for i in range(len(buffer))])
+        if self.sink is None:
+            self.data += records
+        else:
+            self.sink.write(records)
+            self.sink.flush()
+
+    # Returns all the records so far, when there is no sink
+    def getvalue(self):
+        self.flush()
+        return bytes(self.data)
+
+    # The game calls it before it takes the players
+    def init_game(self, game, player1, player2):
+        salvo = game.salvo or 0
+        if salvo == SHIPS_AFLOAT:
+            salvo = SHIPS_AFLOAT_SALVO
+        records = [init_record.pack(INIT, game.journal_id, game.grid[0],
+                                    game.grid[1], salvo)]
+        for player in [player1, player2]:
+            name = player.name.encode('utf-8')
+            records.append(init_player.pack(getattr(player, 'online_id', 0), len(name)))
+            records.append(name)
+        # Ships placed before init_game are written with it
+        for index, player in enumerate([player1, player2]):
+            for ship in player.ships:
+                records.append(pack_ship(game, index, ship))
+        self.append(b"".join(records))
+
+    def add_ship(self, game, player, ship):
+        # Packed before init_game too, so a ship it can't write is refused
+        record = pack_ship(game, player is game.player2, ship)
+        if player is game.player1 or player is game.player2:
+            self.append(record)
+
+    def fire(self, game, player, coordinates):
+        self.append(fire_record.pack(FIRE, game.journal_id,
+                                     player is game.player2,
+                                     coordinates[0], coordinates[1]))
+
+    def fire_salvo(self, game, player, salvo):
+        cells = array('H', [n for c in salvo for n in c])
+        self.append(salvo_record.pack(SALVO, game.journal_id,
+                                      player is game.player2, len(salvo))
+                    + cells.tobytes())
+
+    def incoming(self, game, player):
+        self.append(turn_record.pack(INCOMING, game.journal_id, player is game.player2))
+
+    def outgoing(self, game, player):
+        self.append(turn_record.pack(OUTGOING, game.journal_id, player is game.player2))
+
+
+def pack_ship(game, index, ship):
+    ship_id = str(ship.id).encode('utf-8')
+    if len(ship_id) > 0xFFFF or len(ship.coordinates) > 0xFFFF:
+        raise JournalError("The ship's ID or cell count is too long to journal")
+    cells = array('H', [n for c in ship.coordinates for n in c])
+    return b"".join([ ship_record.pack(ADD_SHIP, game.journal_id, index,
+                                       len(ship_id), len(ship.coordinates)),
+                      ship_id, cells.tobytes() ])
+
+def read_cells(data, offset, count):
+    if offset + 4 * count > len(data):
+        raise JournalError("The journal is cut short or corrupt")
+    cells = array('H')
+    cells.frombytes(data[offset:offset + 4 * count])
+    return [(cells[i], cells[i + 1]) for i in range(0, len(cells), 2)]
+
+def replay(data, game_id=None, until=None, game_class=Game, player_class=Player):
+    '''Rebuilds the games in a journal. Returns a dictionary from game ID to
+    Game, or only the game with game_id if it is given. until is how many
+    records to apply: of that game if game_id is given, else of the whole
+    journal. Raises JournalError if the data is cut short or corrupt.'''
+
+    data = bytes(data)
+    games = dict()
+    applied = 0
+    offset = 0
+
+    try:
+        while offset < len(data) and (until is None or applied < until):
+            kind, record_id = record_header.unpack_from(data, offset)
+            skip = game_id is not None and record_id != game_id
+
+            if kind == INIT:
+                kind, record_id, w, h, salvo = init_record.unpack_from(data, offset)
+                offset += init_record.size
+                players = []
+                for i in range(2):
+                    online_id, name_length = init_player.unpack_from(data, offset)
+                    offset += init_player.size
+                    player = player_class(data[offset:offset + name_length].decode('utf-8'))
+                    offset += name_length
+                    if online_id:
+                        try:
+                            player.online_id = online_id
+                        except AttributeError:
+                            pass # Like Player, it has no online ID to give back
+                    players.append(player)
+                if skip:
+                    continue
+                if salvo == SHIPS_AFLOAT_SALVO:
+                    salvo = SHIPS_AFLOAT
+                game = games[record_id] = game_class( (w, h), salvo or None )
+                game.init_game(*players)
+
+            elif kind == ADD_SHIP:
+                kind, record_id, index, id_length, cell_count = \
+                    ship_record.unpack_from(data, offset)
+                offset += ship_record.size
+                ship_id = data[offset:offset + id_length].decode('utf-8')
+                offset += id_length
+                coordinates = read_cells(data, offset, cell_count)
+                offset += 4 * cell_count
+                if skip:
+                    continue
+                game = games[record_id]
+                player = game.player2 if index else game.player1
+                # The fleet index picks up ships appended to the list
+                player.ships.append(Ship(ship_id, coordinates))
+
+            elif kind == FIRE:
+                kind, record_id, index, x, y = fire_record.unpack_from(data, offset)
+                offset += fire_record.size
+                if skip:
+                    continue
+                game = games[record_id]
+                player = game.player2 if index else game.player1
+                player.firing_coordinates.append( (x, y) )
+                player.fired.add( (x, y) )
+                player.ready = True
+                game.increment_state()
+
+            elif kind == SALVO:
+                kind, record_id, index, count = salvo_record.unpack_from(data, offset)
+                offset += salvo_record.size
+                salvo = read_cells(data, offset, count)
+                offset += 4 * count
+                if skip:
+                    continue
+                game = games[record_id]
+                player = game.player2 if index else game.player1
+                player.firing_coordinates.extend(salvo)
+                player.fired.update(salvo)
+                if game.salvo:
+                    game.salvos[player] = [salvo, None]
+                player.ready = True
+                game.increment_state()
+
+            elif kind == INCOMING or kind == OUTGOING:
+                kind, record_id, index = turn_record.unpack_from(data, offset)
+                offset += turn_record.size
+                if skip:
+                    continue
+                game = games[record_id]
+                player = game.player2 if index else game.player1
+                player.ready = True
+                game.increment_state()
+
+            else:
+                raise JournalError("Unknown record type {0}".format(kind))
+
+            applied += 1
+    except (struct.error, UnicodeDecodeError):
+        raise JournalError("The journal is cut short or corrupt")
+    except KeyError:
+        raise JournalError("A record is for a game that was not started")
+
+    if game_id is not None:
+        return games.get(game_id)
+    return games
@@ -0,0 +1,173 @@
+'''The players waiting for an opponent.
+
+A Lobby pairs every new player with the player waiting for the same
+ruleset, the grid size and salvo setting they want. A second player for
+a ruleset is paired straight away, so at most one player waits for each,
+and finding an opponent is a dictionary lookup however many wait.
+
+Players expire ttl seconds after they were added or last touched, see
+Lobby.touch. Their expiry times are kept in a heap, so expiring a player
+takes O(log n) time, and touching one O(1): the heap keeps the time the
+player was added or checked at, which is moved on when the player is
+found touched since, or when alive vouches for them. The players that
+leave are not searched for in the heap or in the queue of arrivals
+longest_wait reads, they are marked and skipped, and both are rebuilt
+once they are mostly players that left.
+Without a ttl players wait until they are paired or removed.
+'''
+
+import collections, heapq, itertools, time
+from battleship import RulesetException, SHIPS_AFLOAT
+
+default_grid = (10, 10)
+
+# The largest grid side and salvo a journal or snapshot can hold. Salvo
+# 0xFFFF stands for SHIPS_AFLOAT in them
+max_side = 0xFFFF
+max_salvo = 0xFFFE
+
+
+# A ruleset is a tuple of the grid width and height and the salvo setting,
+# 0 for one shot a round. Raises RulesetException for a grid or salvo
+# setting that no game can be played with
+def ruleset(grid=None, salvo=None):
+    grid = grid or default_grid
+    if (not isinstance(grid, (list, tuple)) or len(grid) != 2
+            or not all(is_int(n) and 0 < n <= max_side for n in grid)):
+        raise RulesetException("The grid must be two sizes from 1 to {0}"
+                               .format(max_side))
+    salvo = salvo or 0
+    if not is_int(salvo) or not (0 <= salvo <= max_salvo or salvo == SHIPS_AFLOAT):
+        raise RulesetException("The salvo must be from 1 to {0} shots, or "
+                               "SHIPS_AFLOAT".format(max_salvo))
+    return (grid[0], grid[1], salvo)
+
+def is_int(n):
+    return isinstance(n, int) and not isinstance(n, bool)
+
+default_ruleset = ruleset()
+
+class Entry:
+
+    __slots__ = ('player', 'ruleset', 'since', 'touched', 'waiting')
+
+    def __init__(self, player, ruleset, now):
+        self.player = player
+        self.ruleset = ruleset
+        self.since = now
+        self.touched = now
+        self.waiting = True
+
+class Lobby:
+    '''The waiting players, looked up by online ID like a dictionary'''
+
+    # alive(player) keeps the players it returns true for waiting, touched
+    # or not, like the players with a connection open to a PushServer
+    def __init__(self, ttl=None, clock=time.monotonic, alive=None):
+        self.ttl = ttl
+        self.clock = clock
+        self.alive = alive
+        # Player ID -> Entry, of the waiting players
+        self.entries = dict()
+        # Ruleset -> Entry of the player waiting for it
+        self.waiting = dict()
+        # Entries in the order they were added. May hold players that left
+        self.arrivals = collections.deque()
+        # Heap of (time, n, entry), touched at or after time. May hold
+        # players that left
+        self.expiries = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, player_id):
+        return player_id in self.entries
+
+    def get(self, player_id):
+        entry = self.entries.get(player_id)
+        return entry.player if entry else None
+
+    def add(self, player, ruleset=default_ruleset):
+        '''Pairs the player with the player waiting for the ruleset and
+        returns them, or leaves the player waiting and returns None'''
+
+        now = self.clock()
+        self.expire(now)
+        self.remove(player.online_id)
+
+        entry = self.waiting.get(ruleset)
+        if entry is not None:
+            self.drop(entry)
+            return entry.player
+
+        entry = Entry(player, ruleset, now)
+        self.entries[player.online_id] = entry
+        self.waiting[ruleset] = entry
+        self.arrivals.append(entry)
+        if self.ttl is not None:
+            heapq.heappush(self.expiries, (now, next(self.counter), entry))
+        return None
+
+    # Takes the player out of the lobby. Returns false if it was not waiting
+    def remove(self, player_id):
+        entry = self.entries.get(player_id)
+        if entry is None:
+            return False
+        self.drop(entry)
+        return True
+
+    # Puts off the player's expiry, as if it had just been added
+    def touch(self, player_id):
+        entry = self.entries.get(player_id)
+        if entry is not None:
+            entry.touched = self.clock()
+
+    def expire(self, now=None):
+        '''Removes the players that were not touched for ttl seconds, and
+        returns them'''
+
+        if self.ttl is None:
+            return []
+        if now is None:
+            now = self.clock()
+
+        expired = []
+        # drop may rebuild the heap
+        while self.expiries and self.expiries[0][0] <= now - self.ttl:
+            touched, n, entry = self.expiries[0]
+            if not entry.waiting:
+                heapq.heappop(self.expiries)
+            elif entry.touched > touched:
+                heapq.heapreplace(self.expiries, (entry.touched, next(self.counter), entry))
+            elif self.alive is not None and self.alive(entry.player):
+                entry.touched = now
+                heapq.heapreplace(self.expiries, (now, next(self.counter), entry))
+            else:
+                heapq.heappop(self.expiries)
+                self.drop(entry)
+                expired.append(entry.player)
+        return expired
+
+    # Seconds the player that has waited longest has waited
+    def longest_wait(self, now=None):
+        if now is None:
+            now = self.clock()
+        arrivals = self.arrivals
+        while arrivals and not arrivals[0].waiting:
+            arrivals.popleft()
+        return now - arrivals[0].since if arrivals else 0
+
+    # Marks the entry as gone, and rebuilds the arrivals and expiries if
+    # they are mostly entries that are gone
+    def drop(self, entry):
+        entry.waiting = False
+        del self.entries[entry.player.online_id]
+        del self.waiting[entry.ruleset]
+
+        limit = 2 * len(self.entries) + 16
+        if len(self.arrivals) > limit:
+            self.arrivals = collections.deque(e for e in self.arrivals if e.waiting)
+        if len(self.expiries) > limit:
+            self.expiries = [e for e in self.expiries if e[2].waiting]
+            heapq.heapify(self.expiries)
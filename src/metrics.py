@@ -0,0 +1,120 @@
+'''Call counts, errors and latency histograms for the game servers.
+
+GameManager keeps a Stats and records every call routed through its
+_dispatch, or through async_server, with the time it took and the
+exception it raised, if any. Recording is a few dictionary and list
+operations under a lock, cheap enough to leave on.
+
+Latencies go into power of two buckets of microseconds: bucket i counts
+the calls that took less than 2**i us and at least 2**(i-1) us. The wait
+calls and take_turn include the time spent waiting for the opponent.
+'''
+
+import sys, threading, time
+
+# Calls slower than 2**(buckets - 2) us, about 35 minutes, share the last
+# bucket
+buckets = 33
+
+
+class Histogram:
+
+    __slots__ = ('counts', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * buckets
+        self.total = 0.0 # seconds
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[min(int(seconds * 1e6).bit_length(), buckets - 1)] += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # The latency under which the fraction of the calls fall, in seconds,
+    # rounded up to a bucket
+    def percentile(self, fraction):
+        count = sum(self.counts)
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= fraction * count:
+                return min(2 ** i / 1e6, self.max)
+        return 0.0
+
+class MethodStats:
+
+    __slots__ = ('calls', 'errors', 'latency')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = dict() # exception class name -> count
+        self.latency = Histogram()
+
+class Stats:
+    '''The numbers of every method called on a server'''
+
+    def __init__(self):
+        self.methods = dict() # method -> MethodStats
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, method, seconds, error=None):
+        with self.lock:
+            stats = self.methods.get(method)
+            if stats is None:
+                stats = self.methods[method] = MethodStats()
+            stats.calls += 1
+            stats.latency.add(seconds)
+            if error is not None:
+                name = type(error).__name__
+                stats.errors[name] = stats.errors.get(name, 0) + 1
+
+    def report(self):
+        '''Returns the numbers as dictionaries, lists and numbers only, so
+        they can be sent over XML-RPC. Latencies are in milliseconds, and
+        a histogram is a list of [upper bound, count] for its non-empty
+        buckets.'''
+
+        with self.lock:
+            methods = dict()
+            for method, stats in self.methods.items():
+                latency = stats.latency
+                methods[method] = {
+                    'calls': stats.calls,
+                    'errors': dict(stats.errors),
+                    'mean_ms': 1000 * latency.total / stats.calls,
+                    'p50_ms': 1000 * latency.percentile(0.5),
+                    'p99_ms': 1000 * latency.percentile(0.99),
+                    'max_ms': 1000 * latency.max,
+                    'histogram': [ [2 ** i / 1000, n]
+                                   for i, n in enumerate(latency.counts) if n ],
+                }
+        return {'uptime': time.time() - self.started, 'methods': methods}
+
+# Writes a report from server.GameManager.stats as a table
+def dump(report, file=sys.stderr):
+    lines = ["uptime {0:.0f}s ".format(report['uptime']) +
+             " ".join("{0} {1}".format(k, v) for k, v in sorted(report['gauges'].items()))]
+    lines.append("{:<22} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+        "method", "calls", "errors", "mean ms", "p50 ms", "p99 ms", "max ms"))
+    for method, stats in sorted(report['methods'].items()):
+        lines.append("{:<22} {:>9} {:>7} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}".format(
+            method, stats['calls'], sum(stats['errors'].values()), stats['mean_ms'],
+            stats['p50_ms'], stats['p99_ms'], stats['max_ms']))
+        for error, count in sorted(stats['errors'].items()):
+            lines.append("    {0} {1}".format(error, count))
+    file.write("\n".join(lines) + "\n\n")
+    file.flush()
+
+# Dumps the reports of the manager every interval seconds, from a daemon
+# thread
+def dump_every(manager, interval, file=sys.stderr):
+    def run():
+        while True:
+            time.sleep(interval)
+            dump(manager.stats(), file)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,238 @@
+'''Random fleet placement for any grid size and fleet.
+
+Ships are drawn directly from the positions that are still legal, instead
+of retrying random starts until one fits. Occupied cells are tracked as a
+bitmask over the grid, with cell (x, y) of a (w, h) grid at bit x * h + y
+like battleship.BitboardGame. With no_touch, ships may not be next to each
+other, diagonals included.
+
+The placements of each (grid, ship length) are precomputed once per
+process in a PlacementTable and shared by every game on that grid, with the
+least recently used tables evicted.
+
+This module is also used by the pygame GUI, so it stays Python 2
+compatible.
+'''
+
+import random, threading
+from collections import OrderedDict
+
+# How many (grid, ship length) tables are kept
+TABLE_CACHE_SIZE = 64
+
+# Grids with more cells than this don't keep a mask for every placement,
+# the masks are computed as they are needed
+MASK_TABLE_MAX_CELLS = 2500
+
+
+class PlacementGrid:
+    '''Numbers every placement of a ship of a given length on the grid.
+    Vertical placements (along y) come first, then horizontal ones.'''
+
+    def __init__(self, grid):
+        self.grid = grid
+
+    def vertical_count(self, length):
+        w, h = self.grid
+        return w * max(h - length + 1, 0)
+
+    def count(self, length):
+        w, h = self.grid
+        if length == 1:
+            return w * h
+        return self.vertical_count(length) + max(w - length + 1, 0) * h
+
+    # Returns (x, y, vertical) for the placement's first cell
+    def start(self, length, index):
+        w, h = self.grid
+        vertical_count = self.vertical_count(length)
+        if index < vertical_count:
+            x, y = divmod(index, h - length + 1)
+            return x, y, True
+        x, y = divmod(index - vertical_count, h)
+        return x, y, False
+
+    def coordinates(self, length, index):
+        x, y, vertical = self.start(length, index)
+        if vertical:
+            return [(x, y + i) for i in range(length)]
+        return [(x + i, y) for i in range(length)]
+
+    # Mask of the rectangle from (x0, y0) to (x1, y1), clipped to the grid
+    def rectangle(self, x0, y0, x1, y1):
+        w, h = self.grid
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, w - 1), min(y1, h - 1)
+        row = (1 << (y1 - y0 + 1)) - 1
+        mask = 0
+        for x in range(x0, x1 + 1):
+            mask |= row << (x * h + y0)
+        return mask
+
+    def mask(self, length, index):
+        x, y, vertical = self.start(length, index)
+        if vertical:
+            return self.rectangle(x, y, x, y + length - 1)
+        return self.rectangle(x, y, x + length - 1, y)
+
+    # Mask of the placement and every cell next to it
+    def halo(self, length, index):
+        x, y, vertical = self.start(length, index)
+        if vertical:
+            return self.rectangle(x - 1, y - 1, x + 1, y + length)
+        return self.rectangle(x - 1, y - 1, x + length, y + 1)
+
+    def cell_mask(self, point):
+        return 1 << (point[0] * self.grid[1] + point[1])
+
+
+class PlacementTable:
+    '''Every placement of a ship of one length on a grid, numbered like
+    PlacementGrid:
+        coordinates - index -> tuple of the placement's cells, in order
+        lookup - the same tuple -> index
+        covering - cell -> indexes of the placements through it
+        masks, halos - index -> bitmask, see build_masks'''
+
+    def __init__(self, grid, length):
+        self.grid = grid
+        self.length = length
+
+        placements = PlacementGrid(grid)
+        self.coordinates = [ tuple(placements.coordinates(length, i))
+                             for i in range(placements.count(length)) ]
+        self.lookup = dict( (c, i) for i, c in enumerate(self.coordinates) )
+
+        self.covering = dict()
+        for i, cells in enumerate(self.coordinates):
+            for c in cells:
+                self.covering.setdefault(c, []).append(i)
+
+        self.masks = None
+        self.halos = None
+
+    # The masks take the most memory, so they are only built for the tables
+    # that need them
+    def build_masks(self):
+        if self.masks is None:
+            placements = PlacementGrid(self.grid)
+            indexes = range(len(self.coordinates))
+            self.halos = [placements.halo(self.length, i) for i in indexes]
+            self.masks = [placements.mask(self.length, i) for i in indexes]
+
+    # Returns the index of the placement that covers exactly the
+    # coordinates, in any order, or None if they are not a placement
+    def find(self, coordinates):
+        return self.lookup.get( tuple(sorted(tuple(c) for c in coordinates)) )
+
+class LRUCache:
+    '''A dictionary that keeps the most recently used entries'''
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Returns the entry for the key, calling build to make it if needed
+    def get(self, key, build):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+                return value
+
+        value = build()
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return value
+
+tables = LRUCache(TABLE_CACHE_SIZE)
+
+def placement_table(grid, length):
+    grid = tuple(grid)
+    return tables.get( (grid, length), lambda: PlacementTable(grid, length) )
+
+# Returns the index of the placement covering exactly the coordinates, or
+# None if they are not a straight line of cells inside the grid
+def find_placement(grid, coordinates):
+    if not coordinates:
+        return None
+    return placement_table(grid, len(coordinates)).find(coordinates)
+
+# Returns a function from placement index to the cells the placement rules
+# out for the next ships
+def footprints(grid, length, no_touch):
+    if grid[0] * grid[1] <= MASK_TABLE_MAX_CELLS:
+        table = placement_table(grid, length)
+        table.build_masks()
+        return (table.halos if no_touch else table.masks).__getitem__
+
+    placements = PlacementGrid(grid)
+    footprint = placements.halo if no_touch else placements.mask
+    return lambda index: footprint(length, index)
+
+# Picks a legal placement uniformly at random, or returns None if there is
+# none. A few random draws are tried first, which is enough on all but
+# crowded grids, then the legal placements are listed
+def choose(count, footprint, taken, rng, draws=16):
+    if count == 0:
+        return None
+
+    for i in range(draws):
+        index = rng.randrange(count)
+        if not footprint(index) & taken:
+            return index
+
+    legal = [i for i in range(count) if not footprint(i) & taken]
+    if not legal:
+        return None
+    return rng.choice(legal)
+
+def random_fleet(grid, lengths, rng=random, no_touch=False, occupied=(),
+                 attempts=20):
+    '''Returns a list with the coordinates of a ship for each of the lengths,
+    in the same order. occupied are cells that already hold ships. Raises
+    ValueError if the fleet does not fit.'''
+
+    placements = PlacementGrid(grid)
+    base = 0
+    for c in occupied:
+        base |= placements.cell_mask(c)
+
+    # The longest ships are the hardest to fit, so they go first
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+
+    counts = dict( (l, placements.count(l)) for l in lengths )
+    footprint = dict( (l, footprints(grid, l, no_touch)) for l in lengths )
+
+    for attempt in range(attempts):
+        taken = base
+        fleet = [None] * len(lengths)
+        for i in order:
+            length = lengths[i]
+            index = choose(counts[length], footprint[length], taken, rng)
+            if index is None:
+                break
+            fleet[i] = placements.coordinates(length, index)
+            taken |= placements.mask(length, index)
+        else:
+            return fleet
+
+    raise ValueError("The fleet does not fit on the grid")
+
+def place_fleet(game, player, lengths, rng=random, no_touch=False):
+    '''Adds ships of the given lengths to the player through game.add_ship,
+    around any ships the player already has. Ship IDs are letters,
+    following on from the player's ships.'''
+
+    # battleship uses this module, so it is imported here
+    from battleship import Ship
+
+    occupied = [c for ship in player.ships for c in ship.coordinates]
+    fleet = random_fleet(game.grid, lengths, rng, no_touch, occupied)
+
+    first_id = ord('A') + len(player.ships)
+    for i, coordinates in enumerate(fleet):
+        game.add_ship(player, Ship(chr(first_id + i), coordinates))
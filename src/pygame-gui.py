@@ -1,7 +1,7 @@
 #!/usr/bin/python2
 
 # Importing pygame modules
-import random, sys, pygame
+import sys, pygame, placement
 from pygame.locals import *
 
 # Set variables, like screen width and height 
@@ -271,64 +271,26 @@ def add_ships_to_board(board, ships):
     ships: list of ships to place on board
     '''
     new_board = board[:]
-    ship_length = 0
+    ship_lengths = []
     for ship in ships:
-        valid_ship_position = False
-        while not valid_ship_position:
-            xStartpos = random.randint(0, 9)
-            yStartpos = random.randint(0, 9)
-            isHorizontal = random.randint(0, 1)
-            if 'battleship' in ship:
-                ship_length = 5
-            elif 'cruiser' in ship:
-                ship_length = 4
-            elif 'destroyer'in ship:
-                ship_length = 3
-            elif 'submarine' in ship:
-                ship_length = 2
-
-            valid_ship_position, ship_coords = make_ship_position(new_board,
-                xStartpos, yStartpos, isHorizontal, ship_length, ship)
-            if valid_ship_position:
-                for coord in ship_coords:
-                    new_board[coord[0]][coord[1]] = ship
+        if 'battleship' in ship:
+            ship_lengths.append(5)
+        elif 'cruiser' in ship:
+            ship_lengths.append(4)
+        elif 'destroyer'in ship:
+            ship_lengths.append(3)
+        elif 'submarine' in ship:
+            ship_lengths.append(2)
+        else:
+            # Every ship needs a length, or the coordinates pair up wrong
+            raise ValueError("Unknown ship {0}".format(ship))
+
+    fleet = placement.random_fleet((BOARDWIDTH, BOARDHEIGHT), ship_lengths,
+                                   no_touch=True)
+    for ship, ship_coords in zip(ships, fleet):
+        for coord in ship_coords:
+            new_board[coord[0]][coord[1]] = ship
     return new_board
-
-
-def make_ship_position(board, xPos, yPos, isHorizontal, length, ship):
-    '''
-    returns tuple: True if ship position is valid and list ship coordinates
-    board: list of board tiles
-    xPos: x-coordinate of first ship piece
-    yPos: y-coordinate of first ship piece
-    isHorizontal: True if ship is horizontal
-    length: length of ship
-    '''
-    ship_coordinates = []
-    if isHorizontal:
-        for i in range(length):
-            if (i+xPos > 9) or (board[i+xPos][yPos] != None) or \
-                hasAdjacent(board, i+xPos, yPos, ship):
-                return (False, ship_coordinates)
-            else:
-                ship_coordinates.append((i+xPos, yPos))
-    else:
-        for i in range(length):
-            if (i+yPos > 9) or (board[xPos][i+yPos] != None) or \
-                hasAdjacent(board, xPos, i+yPos, ship):
-                return (False, ship_coordinates)        
-            else:
-                ship_coordinates.append((xPos, i+yPos))
-    return (True, ship_coordinates)
-
-
-def hasAdjacent(board, xPos, yPos, ship):
-    for x in range(xPos-1,xPos+2):
-        for y in range(yPos-1,yPos+2):
-            if (x in range (10)) and (y in range (10)) and \
-                (board[x][y] not in (ship, None)):
-                return True
-    return False
     
     
 def left_top_coords_tile(tilex, tiley):
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+'''Plays scripted text frontend games without a terminal.
+
+A script is what the players would type into PVPTextGame, one answer per
+line, like input/winning_game. The runner feeds every script in a
+directory to PVPTextGame through its input and print hooks, spread over a
+process pool, and prints each script's outcome and how long it took.
+
+    $ python3 script_runner.py ../input
+
+The exit status is 1 if any script raised an error.
+'''
+
+import argparse, functools, io, multiprocessing, os, random, sys, time
+from text_frontend import PVPTextGame
+
+
+class ScriptInput:
+    '''Hands out the lines of a script like input does, and raises EOFError
+    once they run out'''
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.read = 0
+
+    def __call__(self, prompt=""):
+        if self.read >= len(self.lines):
+            raise EOFError("The script ended")
+        self.read += 1
+        return self.lines[self.read - 1]
+
+# Plays one script and returns (name, outcome, lines read, lines, seconds).
+# The computer opponent's ships and shots are drawn from the seed
+def run_script(path, seed=0):
+    with open(path) as f:
+        lines = f.read().splitlines()
+
+    script = ScriptInput(lines)
+    output = io.StringIO()
+    game = PVPTextGame(script, functools.partial(print, file=output),
+                       clear=False, rng=random.Random(seed))
+
+    start = time.perf_counter()
+    try:
+        winner = game.main()
+        outcome = "won by " + winner.name if winner else "draw"
+    except EOFError:
+        outcome = "unfinished"
+    except Exception as e:
+        outcome = "error: {0}: {1}".format(type(e).__name__, e)
+    elapsed = time.perf_counter() - start
+
+    return os.path.basename(path), outcome, script.read, len(lines), elapsed
+
+def run_scripts(args):
+    paths, seed = args
+    return [run_script(path, seed) for path in paths]
+
+def scripts_in(directory):
+    names = sorted(os.listdir(directory))
+    paths = [os.path.join(directory, name) for name in names]
+    return [p for p in paths if os.path.isfile(p)]
+
+def run_directory(directory, workers=None, chunk=50, seed=0):
+    '''Yields the results of run_script for every script in the directory,
+    in name order, as the process pool finishes them'''
+
+    paths = scripts_in(directory)
+    chunks = [ (paths[i:i + chunk], seed) for i in range(0, len(paths), chunk) ]
+    with multiprocessing.Pool(workers) as pool:
+        for results in pool.imap(run_scripts, chunks):
+            for result in results:
+                yield result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('directory')
+    parser.add_argument('--workers', type=int, default=None,
+                        help="processes to use (default: one per core)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--quiet', action='store_true',
+                        help="only print the summary")
+    args = parser.parse_args()
+
+    outcomes = dict()
+    times = []
+    errors = 0
+    start = time.perf_counter()
+    for name, outcome, read, lines, elapsed in run_directory(args.directory,
+                                                            args.workers,
+                                                            seed=args.seed):
+        kind = outcome.split(":")[0]
+        outcomes[kind] = outcomes.get(kind, 0) + 1
+        errors += kind == "error"
+        times.append(elapsed)
+        if not args.quiet:
+            print("{:<32} {:<32} {:>5}/{:<5} {:>9.2f} ms".format(
+                name, outcome, read, lines, 1000 * elapsed))
+    total = time.perf_counter() - start
+
+    if times:
+        print("{0} scripts in {1:.2f}s, {2:.0f} scripts/s, mean {3:.2f} ms, "
+              "max {4:.2f} ms".format(len(times), total, len(times) / total,
+                                      1000 * sum(times) / len(times),
+                                      1000 * max(times)))
+        print(", ".join("{0} {1}".format(kind, count)
+                        for kind, count in sorted(outcomes.items())))
+    sys.exit(1 if errors else 0)
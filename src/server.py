@@ -3,9 +3,13 @@
 from battleship import *
 from xmlrpc.server import *
 from xmlrpc.client import *
-import re
+from socketserver import ThreadingMixIn
+import re, snapshot, journal, matchmaking, metrics, heapq, itertools
+import logging, threading, time
 from random import randrange
 
+log = logging.getLogger(__name__)
+
 def except_func(number):
     if number == 1:
         raise OutsideGridException("Server Exception")
@@ -14,8 +18,15 @@ def except_func(number):
 
 class ProposedGame:
 
-    def __init__(self, p1, p2):
+    __slots__ = ('players', 'ruleset')
+
+    def __init__(self, p1, p2, ruleset=matchmaking.default_ruleset):
         self.players = [p1, p2]
+        self.ruleset = ruleset
+        # Votes on an earlier proposal don't count
+        for p in self.players:
+            p.accepted_game = False
+            p.voted = False
 
     def accept(self, player):
         if player in self.players:
@@ -37,14 +48,48 @@ class ProposedGame:
         return any(not p.accepted_game for p in self.players)
 
 class GameManager(Game):
-    
-    def __init__(self):
+    '''Matches players and relays their games. It is safe to call from
+    many threads at once: free_players has its own lock, the rest of the
+    matchmaking (proposed_games, rejected_games and adding to online_games)
+    is guarded by the lock of the changed condition, and every game has its
+    own lock, see Game.condition. A thread holding the matchmaking lock may
+    take free_lock, never the other way around.
+
+    Nothing is kept for good, see sweep: players are forgotten player_ttl
+    seconds after their last call, finished and abandoned games game_ttl
+    seconds after they ended, and rejected games rejected_ttl seconds after
+    the vote.'''
+
+    player_ttl = 600
+    game_ttl = 60
+    rejected_ttl = 60
+
+    # The methods clients may call. The rest, like checkpoint and restore,
+    # are for the server's own use
+    rpc_methods = frozenset([
+        'register_player', 'deregister_player', 'opponent_found',
+        'accept_opponent', 'reject_opponent', 'opponent_responded',
+        'add_ship', 'game_ready', 'fire', 'incoming_ready', 'incoming',
+        'outgoing_ready', 'outgoing', 'fire_salvo', 'incoming_salvo',
+        'outgoing_salvo', 'game_over', 'winner', 'wait_opponent',
+        'wait_response', 'wait_game', 'wait_incoming', 'wait_outgoing',
+        'take_turn', 'stats',
+    ])
+
+    # Waiting players that are not touched, by opponent_found and
+    # wait_opponent, for lobby_ttl seconds give up their place
+    def __init__(self, journal=None, lobby_ttl=120, clock=time.monotonic):
         # Player ID -> Player object
         self.online_players = dict()
 
-        # Players looking for a game
+        # A function of a player, true for the players kept registered
+        # without making calls, see PushServer. None for none
+        self.keep_alive = None
+
+        # Players looking for a game, queued by ruleset
         # Player ID -> Player object
-        self.free_players = dict()
+        self.free_players = matchmaking.Lobby(lobby_ttl, clock, self._kept_alive)
+        self.free_lock = threading.Lock()
 
         # Games that both players have yet to accept/reject
         # Player ID -> Proposed game
@@ -57,10 +102,44 @@ class GameManager(Game):
         # Player ID -> Game object
         self.online_games = dict()
 
+        # The journal.Journal every online game writes its moves to, if any
+        self.journal = journal
+
+        # Notified when players are paired and when proposed games are
+        # accepted or rejected. Each game notifies its own waiters
+        self.changed = threading.Condition()
+
+        # Counts and latencies of the calls, see stats
+        self.call_stats = metrics.Stats()
+
+        # Heap of (time, n, evict, key), what sweep does when. Its lock is
+        # taken last, with no other lock taken while it is held
+        self.clock = clock
+        self.deadlines = []
+        self.deadline_count = itertools.count()
+        self.deadline_lock = threading.Lock()
+
     # All method calls to this object are routed through here.
-    # Converts dict objects into battleship objects
     def _dispatch(self, method, params):
-        print("dispatch!", method)
+        if method not in self.rpc_methods:
+            raise Exception('method "{0}" is not supported'.format(method))
+        params = self.load_params(params)
+        f = getattr(self, method)
+        return self.timed_call(method, f, params)
+
+    # Calls f, and records how long it took and what it raised
+    def timed_call(self, method, f, params):
+        start = time.perf_counter()
+        try:
+            result = f(*params)
+        except Exception as e:
+            self.call_stats.record(method, time.perf_counter() - start, e)
+            raise
+        self.call_stats.record(method, time.perf_counter() - start)
+        return result
+
+    # Converts dict objects into battleship objects
+    def load_params(self, params):
         param_list = list(params)
 
         for i in range(len(param_list)):
@@ -70,16 +149,8 @@ class GameManager(Game):
 
             # Hack way to determine if parameter is a Player
             if 'online_id' in params[i]:
-
-                player_id = params[i]['online_id']
-                player = self.online_players.get(player_id)
-                
-                if not player:
-                    player = OnlinePlayer(params[i]['name'])
-                    player.online_id = player_id
-                    self.online_players[player_id] = player 
-
-                param_list[i] = player
+                param_list[i] = self.load_player(params[i]['online_id'],
+                                                 params[i]['name'])
 
             # Hack way to determine if parameter is a Ship
             if 'coordinates' in params[i]:
@@ -89,107 +160,421 @@ class GameManager(Game):
 
                 param_list[i] = ship
 
-        params = tuple(param_list)
-        f = getattr(self, method)
-        return f(*params)
-
-    def register_player(self, player):
-        self.free_players[player.online_id] = player
-
-        if len(self.free_players) <= 1:
+        return tuple(param_list)
+
+    # Returns the online player with the ID, made if it is new, and counts
+    # the call as the player's latest activity
+    def load_player(self, player_id, name):
+        player = self.online_players.get(player_id)
+        now = self.clock()
+
+        if not player:
+            new_player = OnlinePlayer(name)
+            new_player.online_id = player_id
+            # Another thread may have added the player first
+            player = self.online_players.setdefault(player_id, new_player)
+            if player is new_player:
+                self._schedule(now + self.player_ttl, self._evict_idle, player)
+
+        player.seen = now
+        return player
+
+    # Pairs the player with the player that has waited longest for the same
+    # grid size and salvo setting, see Game
+    def register_player(self, player, grid=None, salvo=None):
+        ruleset = matchmaking.ruleset(grid, salvo)
+        with self.free_lock:
+            opponent = self.free_players.add(player, ruleset)
+
+        if opponent is None:
             return # No opponents available
 
-        # Remove player
-        del self.free_players[player.online_id]
-        opponent_id, opponent = self.free_players.popitem()
-
-        proposed_game = ProposedGame(player, opponent)
+        proposed_game = ProposedGame(player, opponent, ruleset)
         
-        self.proposed_games[player.online_id] = proposed_game
-        self.proposed_games[opponent_id] = proposed_game
+        with self.changed:
+            for p in proposed_game.players:
+                self.proposed_games[p.online_id] = proposed_game
+                # Or opponent_responded reports the earlier rejection
+                self.rejected_games.pop(p.online_id, None)
+            self.notify()
 
         return None
 
     def opponent_found(self, player):
+        with self.free_lock:
+            self.free_players.touch(player.online_id)
         return player.online_id in self.proposed_games
 
     def accept_opponent(self, player):
-        proposed_game = self.proposed_games[player.online_id]
-        proposed_game.accept(player)
-        
-        if not proposed_game.ready():
-            return
-
-        if proposed_game.accepted():
-            game = Game( (10,10) )
-            game.init_game(*proposed_game.players)
+        with self.changed:
+            proposed_game = self.proposed_games[player.online_id]
+            proposed_game.accept(player)
+            
+            if not proposed_game.ready():
+                return
 
-        for p in proposed_game.players:
-            del self.proposed_games[p.online_id]
             if proposed_game.accepted():
-                self.online_games[p.online_id] = game
-            else:
-                self.rejected_games[p.online_id] = proposed_game
+                width, height, salvo = proposed_game.ruleset
+                game = Game( (width, height), salvo or None )
+                if self.journal is not None:
+                    self.journal.attach(game)
+                game.init_game(*proposed_game.players)
+
+            for p in proposed_game.players:
+                del self.proposed_games[p.online_id]
+                if proposed_game.accepted():
+                    self.online_games[p.online_id] = game
+                else:
+                    self._add_rejected_game(p, proposed_game)
+            self.notify()
             
     def reject_opponent(self, player):
-        proposed_game = self.proposed_games[player.online_id]
-        proposed_game.reject(player)
-
-        if not proposed_game.ready():
-            return
-
-        for p in proposed_game.players:
-            del self.proposed_games[p.online_id]
-            self.rejected_games[p.online_id] = proposed_game
-
+        with self.changed:
+            proposed_game = self.proposed_games[player.online_id]
+            proposed_game.reject(player)
+
+            if not proposed_game.ready():
+                return
+
+            for p in proposed_game.players:
+                del self.proposed_games[p.online_id]
+                self._add_rejected_game(p, proposed_game)
+            self.notify()
+
+    # Call with the matchmaking lock held
+    def _add_rejected_game(self, player, proposed_game):
+        self.rejected_games[player.online_id] = proposed_game
+        self._schedule(self.clock() + self.rejected_ttl, self._evict_rejected,
+                      (player.online_id, proposed_game))
+
+    # Forgets the player and takes them out of matchmaking. A game proposed
+    # to them is rejected for the opponent. A game they are playing is
+    # abandoned: the opponent wins it, and their calls on it, waits too,
+    # raise OpponentLeftException
     def deregister_player(self, player):
-        pass
+        player_id = player.online_id
+        with self.changed:
+            with self.free_lock:
+                self.free_players.remove(player_id)
+
+            proposed_game = self.proposed_games.pop(player_id, None)
+            if proposed_game is not None:
+                proposed_game.reject(player)
+                for p in proposed_game.players:
+                    if p.online_id != player_id:
+                        del self.proposed_games[p.online_id]
+                        self._add_rejected_game(p, proposed_game)
+
+            self.rejected_games.pop(player_id, None)
+            game = self.online_games.pop(player_id, None)
+            self.online_players.pop(player_id, None)
+            self.notify()
+
+        if game is not None:
+            with game.condition():
+                if game.left is None and not game.game_over():
+                    game.left = player
+                    game.notify()
+                    self._schedule(self.clock() + self.game_ttl, self._evict_game, game)
+
+    # Returns the player's game. Raises OpponentLeftException if the
+    # opponent left it
+    def _game(self, player):
+        game = self.online_games[player.online_id]
+        self._check_left(game)
+        return game
+
+    def _check_left(self, game):
+        if game.left is not None:
+            raise OpponentLeftException("Your opponent left the game")
 
     # Returns a tuple (ready, accepted) where
     # ready is True if both players voted
     # accepted is True if both players accepted the game or 
     #          None if both players have not voted
     def opponent_responded(self, player):
-        if player.online_id in self.online_games:
-            return True, True
-        elif player.online_id in self.rejected_games:
-            return True, False
-        else:
-            return False, None
+        with self.changed:
+            if player.online_id in self.online_games:
+                return True, True
+            elif player.online_id in self.rejected_games:
+                return True, False
+            else:
+                return False, None
 
     def add_ship(self, player, ship):
-        game = self.online_games[player.online_id]
-        return game.add_ship(player,ship)
+        game = self._game(player)
+        with game.condition():
+            game.add_ship(player,ship)
+            # The opponent may be waiting in game_ready
+            game.notify()
 
     def game_ready(self, player):
-        game = self.online_games[player.online_id]
-        if len(game.player1.ships) == 2 and len(game.player2.ships):
-            return True
-        else:
-            return False
+        game = self._game(player)
+        with game.condition():
+            if len(game.player1.ships) == 2 and len(game.player2.ships):
+                return True
+            else:
+                return False
 
     def fire(self, player, coordinates):
-        game = self.online_games[player.online_id]
-        return game.fire(player, coordinates)
+        game = self._game(player)
+        with game.condition():
+            return game.fire(player, coordinates)
 
     def incoming_ready(self, player):
-        game = self.online_games[player.online_id]
-        return game.incoming_ready(player)
+        game = self._game(player)
+        with game.condition():
+            return game.incoming_ready(player)
 
     def incoming(self, player):
-        game = self.online_games[player.online_id]
-        return game.incoming(player)
+        game = self._game(player)
+        with game.condition():
+            return game.incoming(player)
 
     def outgoing_ready(self, player):
-        game = self.online_games[player.online_id]
-        return game.outgoing_ready(player)
+        game = self._game(player)
+        with game.condition():
+            return game.outgoing_ready(player)
 
     def outgoing(self, player):
+        game = self._game(player)
+        with game.condition():
+            result = game.outgoing(player)
+            self._check_over(game)
+            return result
+
+    # A salvo is a list of firing coordinates
+    def fire_salvo(self, player, salvo):
+        game = self._game(player)
+        with game.condition():
+            return game.fire_salvo(player, salvo)
+
+    def incoming_salvo(self, player):
+        game = self._game(player)
+        with game.condition():
+            return game.incoming_salvo(player)
+
+    def outgoing_salvo(self, player):
+        game = self._game(player)
+        with game.condition():
+            result = game.outgoing_salvo(player)
+            self._check_over(game)
+            return result
+
+    # An abandoned game is over
+    def game_over(self, player):
         game = self.online_games[player.online_id]
-        return game.outgoing(player)
+        with game.condition():
+            return game.left is not None or game.game_over()
+
+    # Returns the online ID of the player that won, or None if the game is
+    # not over or ended in a draw. The player that stayed wins an abandoned
+    # game
+    def winner(self, player):
+        game = self.online_games[player.online_id]
+        with game.condition():
+            if game.left is not None:
+                winner = game.player2 if game.left is game.player1 else game.player1
+            else:
+                winner = game.winner()
+            return winner.online_id if winner else None
+
+    # The waits below block until the step is done, or the timeout in
+    # seconds runs out, and return whether it is done. Each waiter holds a
+    # thread of the server, so the timeout is at most max_wait. The waits
+    # on a game raise OpponentLeftException when the opponent leaves it
+    max_wait = 30
+
+    def wait_time(self, timeout):
+        if timeout is None:
+            return self.max_wait
+        return min(timeout, self.max_wait)
+
+    # Until the player is paired, see opponent_found
+    def wait_opponent(self, player, timeout=None):
+        return self.wait_for(lambda: self.opponent_found(player),
+                             self.wait_time(timeout))
+
+    # Until both players accepted or rejected the game
+    def wait_response(self, player, timeout=None):
+        return self.wait_for(lambda: self.opponent_responded(player)[0],
+                             self.wait_time(timeout))
+
+    # Until the fleets are placed, see game_ready
+    def wait_game(self, player, timeout=None):
+        game = self._game(player)
+        return self._wait_on(game, lambda: self.game_ready(player),
+                             self.wait_time(timeout))
+
+    def wait_incoming(self, player, timeout=None):
+        game = self._game(player)
+        return self._wait_on(game, lambda: game.incoming_ready(player),
+                             self.wait_time(timeout))
+
+    def wait_outgoing(self, player, timeout=None):
+        game = self._game(player)
+        return self._wait_on(game, lambda: game.outgoing_ready(player),
+                             self.wait_time(timeout))
+
+    # Waits on the game like Game.wait_for, until the opponent leaves
+    def _wait_on(self, game, predicate, timeout):
+        with game.condition():
+            done = game.wait_for(lambda: game.left is not None or predicate(),
+                                 timeout)
+            self._check_left(game)
+            return done
+
+    # Fires, then waits for the round to resolve and returns the results
+    # of incoming and outgoing for the player, in one call. Returns None if
+    # the opponent did not fire before the timeout, and take_turn with no
+    # coordinates waits again, from wherever the round has got to. The
+    # outgoing result is None if the opponent did not call incoming in
+    # time, then call outgoing, or take_turn with no coordinates, which
+    # returns None for the incoming result already taken
+    def take_turn(self, player, coordinates, timeout=None):
+        game = self.online_games[player.online_id]
+        deadline = time.monotonic() + self.wait_time(timeout)
+        with game.condition():
+            self._check_left(game)
+            if coordinates is not None:
+                game.fire(player, coordinates)
+            # player.ready is whether the player has done the state's step:
+            # not fired yet, or taken the round's outgoing already
+            elif (game.state == -1 or (game.state == 0 and not player.ready)
+                  or (game.state == 2 and player.ready)):
+                raise OutOfTurnException("There is no shot to wait on")
+
+            incoming = None
+            if game.state == 0 or (game.state == 1 and not player.ready):
+                if not self._wait_on(game, lambda: game.incoming_ready(player),
+                                     deadline - time.monotonic()):
+                    return None
+                incoming = game.incoming(player)
+
+            if not self._wait_on(game, lambda: game.outgoing_ready(player),
+                                 deadline - time.monotonic()):
+                return incoming, None
+            outgoing = game.outgoing(player)
+            self._check_over(game)
+            return incoming, outgoing
+
+    # Games end on a round's outgoing, so only then are they checked. Call
+    # with the game's lock held
+    def _check_over(self, game):
+        if game.game_over():
+            self._schedule(self.clock() + self.game_ttl, self._evict_game, game)
+
+    def _schedule(self, due, evict, key):
+        with self.deadline_lock:
+            heapq.heappush(self.deadlines, (due, next(self.deadline_count), evict, key))
+
+    def sweep(self):
+        '''Evicts what is due and returns how many deadlines were due. Only
+        those are looked at, so a sweep costs O(log n) a deadline however
+        much is held. Every player has one deadline, moved on at most once
+        a player_ttl, and every rejected or finished game two.'''
+
+        now = self.clock()
+        due = []
+        with self.deadline_lock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                due.append(heapq.heappop(self.deadlines))
+        # One that fails is logged, and does not stop the others
+        for deadline, n, evict, key in due:
+            try:
+                evict(key, now)
+            except Exception:
+                log.exception("Eviction of %r failed", key)
+
+        with self.free_lock:
+            self.free_players.expire(now)
+        return len(due)
+
+    def _kept_alive(self, player):
+        return self.keep_alive is not None and self.keep_alive(player)
+
+    def _evict_idle(self, player, now):
+        if self.online_players.get(player.online_id) is not player:
+            return # Deregistered
+        idle_until = player.seen + self.player_ttl
+        if self._kept_alive(player):
+            self._schedule(now + self.player_ttl, self._evict_idle, player)
+        elif idle_until > now:
+            self._schedule(idle_until, self._evict_idle, player)
+        else:
+            self.deregister_player(player)
+
+    def _evict_game(self, game, now):
+        with self.changed:
+            for p in [game.player1, game.player2]:
+                if self.online_games.get(p.online_id) is game:
+                    del self.online_games[p.online_id]
+
+    def _evict_rejected(self, key, now):
+        player_id, proposed_game = key
+        with self.changed:
+            if self.rejected_games.get(player_id) is proposed_game:
+                del self.rejected_games[player_id]
+
+    # Returns the numbers of metrics.Stats.report, and gauges of the players
+    # and games held
+    def stats(self):
+        report = self.call_stats.report()
+        with self.changed:
+            report['gauges'] = {
+                'online_players': len(self.online_players),
+                'free_players': len(self.free_players),
+                'longest_wait': self.free_players.longest_wait(),
+                'proposed_games': len(set(map(id, self.proposed_games.values()))),
+                'online_games': len(set(map(id, self.online_games.values()))),
+            }
+        return report
+
+    # Returns a binary snapshot of every game in progress. A game that
+    # can't be snapshot is logged and left out
+    def checkpoint(self):
+        with self.changed:
+            games = [ game for player_id, game in self.online_games.items()
+                      if game.player1.online_id == player_id ]
+        snapshots = []
+        for game in games:
+            with game.condition():
+                try:
+                    snapshots.append(snapshot.encode(game))
+                except snapshot.SnapshotError:
+                    log.exception("Snapshot of a game failed")
+        return snapshots
+
+    # Puts back the games from a checkpoint, with their players
+    def restore(self, snapshots):
+        for data in snapshots:
+            self.add_online_game(snapshot.decode(data, player_class=OnlinePlayer))
+
+    # Puts back the games that were not over from the bytes of a journal.
+    # They carry on writing to this manager's journal under the same IDs
+    def recover(self, data):
+        games = journal.replay(data, player_class=OnlinePlayer)
+        for game_id, game in games.items():
+            if game.game_over():
+                continue
+            if self.journal is not None:
+                self.journal.attach(game, game_id)
+            self.add_online_game(game)
+
+    def add_online_game(self, game):
+        with self.changed:
+            for player in [game.player1, game.player2]:
+                player.accepted_game = True
+                player.voted = True
+                player.seen = self.clock()
+                self.online_players[player.online_id] = player
+                self.online_games[player.online_id] = game
+                self._schedule(player.seen + self.player_ttl, self._evict_idle, player)
 
 class OnlinePlayer(Player):
     
+    __slots__ = ('online_id', 'accepted_game', 'voted', 'seen')
+
     def __init__(self, name):
         super(OnlinePlayer, self).__init__(name)
         self.online_id = randrange(999999)
@@ -197,12 +582,29 @@ class OnlinePlayer(Player):
         self.accepted_game = False
         # Whether the player accepted or rejected the proposed game
         self.voted = False
+        # When the player last made a call, see GameManager.load_player
+        self.seen = 0.0
+
+
+# Sweeps the manager every interval seconds, from a daemon thread
+def sweep_every(manager, interval):
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                manager.sweep()
+            except Exception:
+                log.exception("Sweep failed")
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
 
 
 # RPC Client boilerplate moved to the server...
 allowed_errors = [OutsideGridException, OutOfTurnException,
                   ShipCollisionException,GameInitializedException,
-                  RepeatFireException ]
+                  RepeatFireException, SalvoSizeException, RulesetException,
+                  OpponentLeftException ]
 
 class ExceptionUnmarshaller (Unmarshaller):
     '''The default Unmarshaller of xmlrpc.client does not allow exceptions from
@@ -253,6 +655,14 @@ class ExceptionUnmarshaller (Unmarshaller):
             return super(ExceptionUnmarshaller, self).close()
 
 
+class ThreadedXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    '''Serves every request on its own thread, so a slow client only holds
+    up its own calls. Register a GameManager, which does its own locking.'''
+
+    daemon_threads = True
+    request_queue_size = 128
+
+
 class ExceptionTransport (Transport):
     # This will force the client ServerProxy to use the new Unmarshaller
     
@@ -263,17 +673,67 @@ class ExceptionTransport (Transport):
         return parser, unmarshaller
 
 
+# XML-RPC sends an object as a struct of all of its attributes. The server
+# only reads a player's name and online ID (see GameManager._dispatch), and
+# the shot bookkeeping on Player, like the set of fired coordinates, has no
+# XML-RPC representation. So players are sent as just those two fields.
+def dump_player(marshaller, value, write):
+    value = {'name': value.name, 'online_id': value.online_id}
+    marshaller.dump_struct(value, write)
+
+# Ships and players use __slots__, so XML-RPC can't find their attributes by
+# itself
+def dump_ship(marshaller, value, write):
+    value = {'id': value.id, 'coordinates': value.coordinates}
+    marshaller.dump_struct(value, write)
+
+_dump_instance = Marshaller.dispatch["_arbitrary_instance"]
+
+# Frontend players are Player subclasses with a __dict__, so they come
+# through here rather than the dispatch table
+def dump_instance(marshaller, value, write):
+    if isinstance(value, Player):
+        dump_player(marshaller, value, write)
+    else:
+        _dump_instance(marshaller, value, write)
+
+Marshaller.dispatch["_arbitrary_instance"] = dump_instance
+Marshaller.dispatch[OnlinePlayer] = dump_player
+Marshaller.dispatch[Ship] = dump_ship
+
+
 def getProxy():
     return ServerProxy('http://137.142.101.27:8000', allow_none=True, 
                 transport=ExceptionTransport())
 
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--single-threaded', action='store_true')
+    parser.add_argument('--stats-interval', type=float, default=60,
+                        help="seconds between dumps of the call numbers to "
+                             "stderr, 0 for none")
+    parser.add_argument('--sweep-interval', type=float, default=10,
+                        help="seconds between evictions of idle players and "
+                             "finished games")
+    parser.add_argument('--player-ttl', type=float, default=GameManager.player_ttl,
+                        help="seconds a player is kept after their last call")
+    args = parser.parse_args()
+
     # IDEA: Have every function the client calls to have a client id. Create a
     # decorator client side, so that the UI never has to deal with it
-    server = SimpleXMLRPCServer(("137.142.101.27", 8000), allow_none=True)
+    if args.single_threaded:
+        server = SimpleXMLRPCServer(("137.142.101.27", 8000), allow_none=True)
+    else:
+        server = ThreadedXMLRPCServer(("137.142.101.27", 8000), allow_none=True)
+    manager = GameManager()
+    manager.player_ttl = args.player_ttl
     server.register_function(except_func)
-    server.register_instance(GameManager())
+    server.register_instance(manager)
+    if args.stats_interval:
+        metrics.dump_every(manager, args.stats_interval)
+    sweep_every(manager, args.sweep_interval)
     # Run the server's main loop
     server.serve_forever()
 
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+'''Serves the games from several worker processes behind a router.
+
+Every worker is an async_server.PushServer with a GameManager of its own,
+in its own process, so the workers do not share a GIL. Clients connect to
+the Router as they would to async_server, in JSON or in the wire protocol,
+and it forwards every request unchanged to the worker that owns the
+player, and relays the answers and the pushed events back. A player is
+owned by the worker its online ID hashes to on a HashRing.
+
+The two players of a game must be on one worker. The Router keeps a
+matchmaking.Lobby of its own, which only decides where players register:
+a player with no one to pair with registers on their own worker and
+waits there, and the next player for the same ruleset registers on the
+waiting player's worker, where the worker pairs them as usual. The
+Router then remembers that the second player is placed on that worker,
+see Placements, and forwards their calls there until they register
+again or deregister.
+
+A client connection gets a connection to each worker it calls, made on
+its first call there, so the events a worker pushes for the client's
+players come back on it. Requests the Router can't read, or without a
+player, go to the first worker, which answers them as async_server does.
+
+    $ python3 shard.py --workers 4 --port 8001
+'''
+
+import argparse, asyncio, bisect, collections, hashlib, json
+import multiprocessing, time
+import async_server, matchmaking, server, wire
+
+
+# Hashes keys to 64 bit points on the ring
+def ring_hash(key):
+    digest = hashlib.blake2b(str(key).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+class HashRing:
+    '''Maps keys to nodes by consistent hashing. Every node has replicas
+    points on the ring, and a key belongs to the node of the first point
+    at or after its hash, so a node that is added or removed only moves
+    the keys that fall to its points.'''
+
+    def __init__(self, nodes, replicas=64):
+        self.points = sorted( (ring_hash("{0}-{1}".format(node, i)), node)
+                              for node in nodes for i in range(replicas) )
+        self.hashes = [h for h, node in self.points]
+
+    def node(self, key):
+        i = bisect.bisect_left(self.hashes, ring_hash(key))
+        return self.points[i % len(self.points)][1]
+
+class Placements:
+    '''Player ID -> the worker of the players whose game is not on their
+    own worker. An entry lasts while it is read at least once every ttl
+    seconds: the entries are in two generations, and every ttl seconds the
+    old generation is dropped and the new one becomes the old, so nothing
+    is ever scanned.'''
+
+    def __init__(self, ttl, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.new = dict()
+        self.old = dict()
+        self.rotated = clock()
+
+    def __len__(self):
+        return len(self.new) + len(self.old)
+
+    def get(self, player_id):
+        self.rotate()
+        worker = self.new.get(player_id)
+        if worker is None:
+            worker = self.old.pop(player_id, None)
+            if worker is not None:
+                self.new[player_id] = worker
+        return worker
+
+    def set(self, player_id, worker):
+        self.rotate()
+        self.old.pop(player_id, None)
+        self.new[player_id] = worker
+
+    def pop(self, player_id):
+        self.new.pop(player_id, None)
+        self.old.pop(player_id, None)
+
+    def rotate(self):
+        now = self.clock()
+        if now - self.rotated < self.ttl:
+            return
+        self.old = self.new if now - self.rotated < 2 * self.ttl else dict()
+        self.new = dict()
+        self.rotated = now
+
+# The players the Router's lobby holds
+Waiting = collections.namedtuple('Waiting', 'online_id')
+
+
+# Reads the requests of a connection and the messages of a worker whole,
+# as they are forwarded. Return b"" at the end of the stream
+async def read_line(reader):
+    return await reader.readline()
+
+async def read_frame(reader):
+    try:
+        head = await reader.readexactly(4)
+        length, = wire.length_header.unpack(head)
+        if length > wire.max_frame:
+            raise ValueError("The frame is too long")
+        return head + await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return b""
+
+# Return the method, the player's online ID and the ruleset of a request,
+# or None for what can't be read
+def route_line(line):
+    try:
+        request = json.loads(line)
+        method = request['method']
+        params = request.get('params', [])
+        player_id = params[0]['online_id'] if params else None
+        if not isinstance(player_id, int):
+            return method, None, None
+        if method == 'register_player':
+            return method, player_id, matchmaking.ruleset(*params[1:3])
+        return method, player_id, None
+    except Exception:
+        return None, None, None
+
+def route_frame(frame):
+    try:
+        kind, request_id, number = wire.request_start.unpack_from(frame, 4)
+        method = wire.methods[number - 1][0]
+        # Every method's first parameter is the player
+        player_id, = wire.UInt32.unpack_from(frame, 10)
+        return method, player_id, matchmaking.default_ruleset
+    except Exception:
+        return None, None, None
+
+
+class Router:
+    '''Forwards the requests of async_server clients to the workers at
+    addresses, a list of (host, port), and relays the answers back'''
+
+    def __init__(self, addresses, lobby_ttl=120,
+                 placement_ttl=server.GameManager.player_ttl):
+        self.addresses = addresses
+        self.ring = HashRing(range(len(addresses)))
+        # Like a PushServer's, the lobby keeps the players that are
+        # connected
+        self.lobby = matchmaking.Lobby(lobby_ttl, alive=self.connected)
+        self.placements = Placements(placement_ttl)
+        # Player ID -> the number of connections the player made calls on
+        self.connections = collections.Counter()
+
+    def start(self, host, port, **kwargs):
+        return asyncio.start_server(self.serve, host, port,
+                                    limit=async_server.line_limit, **kwargs)
+
+    async def serve(self, reader, writer):
+        upstreams = dict() # worker -> writer, for this client
+        relays = []
+        players = set() # IDs of the players that made calls here
+        try:
+            request = await reader.readline()
+            if request == wire.MAGIC:
+                greeting, read, route = wire.MAGIC, read_frame, route_frame
+                request = await read_frame(reader)
+            else:
+                greeting, read, route = b"", read_line, route_line
+
+            while request:
+                method, player_id, ruleset = route(request)
+                if player_id is not None and player_id not in players:
+                    players.add(player_id)
+                    self.connections[player_id] += 1
+                worker = self.worker(method, player_id, ruleset)
+                upstream = upstreams.get(worker)
+                if upstream is None:
+                    host, port = self.addresses[worker]
+                    upstream_reader, upstream = await asyncio.open_connection(
+                        host, port, limit=async_server.line_limit)
+                    upstream.write(greeting)
+                    upstreams[worker] = upstream
+                    relays.append(asyncio.create_task(
+                        self.relay(upstream_reader, read, writer)))
+                upstream.write(request)
+                await upstream.drain()
+                request = await read(reader)
+        except (ConnectionError, ValueError):
+            pass # Gone, or sent a request over the limit
+        finally:
+            for player_id in players:
+                self.connections[player_id] -= 1
+                if not self.connections[player_id]:
+                    del self.connections[player_id]
+            for relay in relays:
+                relay.cancel()
+            for upstream in upstreams.values():
+                upstream.close()
+            writer.close()
+
+    # Copies a worker's answers and events to the client
+    async def relay(self, reader, read, writer):
+        try:
+            message = await read(reader)
+            while message:
+                writer.write(message)
+                await writer.drain()
+                message = await read(reader)
+        except (ConnectionError, ValueError):
+            pass
+        writer.close() # The worker is gone
+
+    # Picks the worker for a request, see the module's docstring
+    def worker(self, method, player_id, ruleset):
+        if player_id is None:
+            return 0
+
+        if method == 'register_player':
+            self.placements.pop(player_id)
+            opponent = self.lobby.add(Waiting(player_id), ruleset)
+            if opponent is None:
+                return self.ring.node(player_id)
+            worker = self.home(opponent.online_id)
+            if worker != self.ring.node(player_id):
+                self.placements.set(player_id, worker)
+            return worker
+
+        if method in ('opponent_found', 'wait_opponent'):
+            self.lobby.touch(player_id)
+        elif method == 'deregister_player':
+            self.lobby.remove(player_id)
+            worker = self.home(player_id)
+            self.placements.pop(player_id)
+            return worker
+        return self.home(player_id)
+
+    def connected(self, player):
+        return player.online_id in self.connections
+
+    def home(self, player_id):
+        worker = self.placements.get(player_id)
+        return self.ring.node(player_id) if worker is None else worker
+
+
+# Serves a PushServer, sweeping its manager, until the process is killed.
+# Sends the port it listens on through the pipe
+def run_worker(host, port, pipe, sweep_interval=10):
+    async def main():
+        push_server = async_server.PushServer()
+        server.sweep_every(push_server.manager, sweep_interval)
+        tcp_server = await push_server.start(host, port)
+        pipe.send(tcp_server.sockets[0].getsockname()[1])
+        pipe.close()
+        async with tcp_server:
+            await tcp_server.serve_forever()
+    asyncio.run(main())
+
+def start_workers(count, host="127.0.0.1"):
+    '''Starts count worker processes on free ports. Returns their addresses
+    and the processes, for terminate'''
+
+    addresses, processes = [], []
+    for i in range(count):
+        receiver, sender = multiprocessing.Pipe(False)
+        process = multiprocessing.Process(target=run_worker, args=(host, 0, sender),
+                                          daemon=True)
+        process.start()
+        addresses.append( (host, receiver.recv()) )
+        processes.append(process)
+    return addresses, processes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default="137.142.101.27")
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--backlog', type=int, default=1024,
+                        help="connections waiting to be accepted")
+    args = parser.parse_args()
+
+    addresses, processes = start_workers(args.workers)
+
+    async def main():
+        router = Router(addresses)
+        tcp_server = await router.start(args.host, args.port, backlog=args.backlog)
+        async with tcp_server:
+            await tcp_server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    finally:
+        for process in processes:
+            process.terminate()
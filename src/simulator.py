@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+'''Headless self-play for battleship.Game.
+
+Plays complete games between two strategies through the real game state
+machine (fire -> incoming -> outgoing), spread over a process pool, and
+prints running totals: games per second, shots to win and the hit rate by
+shot number.
+
+    $ python3 simulator.py --games 100000 --strategy1 hunt --strategy2 random
+'''
+
+import argparse, multiprocessing, random, time
+from battleship import *
+from ai import ProbabilityStrategy
+from placement import place_fleet
+
+# Ship lengths of the standard fleet
+standard_fleet = [5, 4, 3, 3, 2]
+
+
+# A strategy is created for each game with the grid, the ship lengths of
+# the opponent's fleet and a random.Random to draw from
+class RandomStrategy:
+    '''Fires on a random cell that has not been fired on'''
+
+    def __init__(self, grid, fleet, rng):
+        self.rng = rng
+        self.untried = [(x, y) for x in range(grid[0]) for y in range(grid[1])]
+        rng.shuffle(self.untried)
+
+    def next_shot(self):
+        return self.untried.pop()
+
+    # Called with the result of every outgoing shot
+    def record(self, coordinates, ship_hit, ship_sunk):
+        pass
+
+class HuntTargetStrategy(RandomStrategy):
+    '''Fires at random until it hits a ship, then fires on the neighbours of
+    the hits until the ship is sunk'''
+
+    def __init__(self, grid, fleet, rng):
+        super(HuntTargetStrategy, self).__init__(grid, fleet, rng)
+        self.grid = grid
+        self.targets = []
+        self.fired = set()
+
+    def next_shot(self):
+        while self.targets:
+            c = self.targets.pop()
+            if c not in self.fired:
+                self.untried.remove(c)
+                return c
+        return self.untried.pop()
+
+    def record(self, coordinates, ship_hit, ship_sunk):
+        self.fired.add(coordinates)
+        if ship_sunk:
+            self.targets = []
+        elif ship_hit:
+            x, y = coordinates
+            for c in [(x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)]:
+                inside = 0 <= c[0] < self.grid[0] and 0 <= c[1] < self.grid[1]
+                if inside and c not in self.fired:
+                    self.targets.append(c)
+
+strategies = {
+    'random': RandomStrategy,
+    'hunt': HuntTargetStrategy,
+    'probability': ProbabilityStrategy,
+}
+
+
+# Plays one game and returns (winner, rounds, hits) where winner is 0 or 1,
+# or None for a draw, and hits has each player's list of hit/miss results
+def play_game(strategy_classes, grid, fleet, seed):
+    rng = random.Random(seed)
+    game = Game(grid)
+    players = [Player("1"), Player("2")]
+    game.init_game(*players)
+
+    strategies = []
+    for player, strategy_class in zip(players, strategy_classes):
+        place_fleet(game, player, fleet, rng)
+        strategies.append(strategy_class(grid, fleet, rng))
+
+    hits = [[], []]
+    rounds = 0
+    while not game.game_over():
+        for player, strategy in zip(players, strategies):
+            game.fire(player, strategy.next_shot())
+        for player in players:
+            game.incoming(player)
+        for i, (player, strategy) in enumerate(zip(players, strategies)):
+            coordinates, ship_hit, ship_sunk = game.outgoing(player)
+            strategy.record(coordinates, ship_hit, ship_sunk)
+            hits[i].append(ship_hit is not None)
+        rounds += 1
+
+    winner = game.winner()
+    winner = players.index(winner) if winner else None
+    return winner, rounds, hits
+
+def play_games(args):
+    strategy_classes, grid, fleet, seeds = args
+    return [play_game(strategy_classes, grid, fleet, s) for s in seeds]
+
+
+class Results:
+    '''Running totals of the games played so far'''
+
+    def __init__(self):
+        self.games = 0
+        self.wins = [0, 0, 0] # player 1, player 2, draws
+        self.rounds = dict() # rounds -> games won in that many rounds
+        self.shots = [] # shots fired at each shot number
+        self.hits = [] # hits at each shot number
+        self.start = time.perf_counter()
+
+    def add(self, winner, rounds, hits):
+        self.games += 1
+        self.wins[2 if winner is None else winner] += 1
+        # Nobody won a draw, so it has no shots to win
+        if winner is not None:
+            self.rounds[rounds] = self.rounds.get(rounds, 0) + 1
+
+        for player_hits in hits:
+            if len(self.shots) < len(player_hits):
+                extra = len(player_hits) - len(self.shots)
+                self.shots.extend([0] * extra)
+                self.hits.extend([0] * extra)
+            for i, hit in enumerate(player_hits):
+                self.shots[i] += 1
+                self.hits[i] += hit
+
+    def games_per_second(self):
+        return self.games / (time.perf_counter() - self.start)
+
+    # The games somebody won, which the shots to win are counted over
+    def decided(self):
+        return self.games - self.wins[2]
+
+    # The shots to win are None until a game is won
+    def mean_rounds(self):
+        if not self.decided():
+            return None
+        return sum(r * n for r, n in self.rounds.items()) / self.decided()
+
+    def percentile(self, p):
+        wanted = p / 100.0 * self.decided()
+        seen = 0
+        for rounds in sorted(self.rounds):
+            seen += self.rounds[rounds]
+            if seen >= wanted:
+                return rounds
+
+    def hit_rate(self, shot):
+        return self.hits[shot] / self.shots[shot]
+
+    def summary(self):
+        line = "{0} games, {1:.0f} games/s".format(self.games, self.games_per_second())
+        if self.decided():
+            line += ", shots to win: mean {0:.1f} p50 {1} p90 {2} p99 {3}".format(
+                self.mean_rounds(), self.percentile(50), self.percentile(90),
+                self.percentile(99))
+        return line
+
+    def report(self, step=10):
+        print(self.summary())
+        print("Wins: player 1 {0}, player 2 {1}, draws {2}".format(*self.wins))
+        print("Hit rate by shot number")
+        for shot in range(0, len(self.shots), step):
+            print("{:>6} {:>6.3f}".format(shot + 1, self.hit_rate(shot)))
+
+
+def simulate(strategy_classes, games, grid=(10,10), fleet=standard_fleet,
+             workers=None, chunk=100, seed=0, progress=1.0):
+    '''Plays the games over a process pool and returns the Results. A
+    summary line is printed every progress seconds while it runs, if
+    progress is set.'''
+
+    chunks = []
+    for start in range(0, games, chunk):
+        seeds = range(seed + start, seed + min(start + chunk, games))
+        chunks.append( (strategy_classes, grid, fleet, seeds) )
+
+    results = Results()
+    last_print = time.perf_counter()
+    with multiprocessing.Pool(workers) as pool:
+        for played in pool.imap_unordered(play_games, chunks):
+            for game in played:
+                results.add(*game)
+            if progress and time.perf_counter() - last_print > progress:
+                print(results.summary(), flush=True)
+                last_print = time.perf_counter()
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--games', type=int, default=10000)
+    parser.add_argument('--grid', type=int, default=10, help="square grid size")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="processes to use (default: one per core)")
+    parser.add_argument('--strategy1', choices=sorted(strategies), default='hunt')
+    parser.add_argument('--strategy2', choices=sorted(strategies), default='random')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    strategy_classes = (strategies[args.strategy1], strategies[args.strategy2])
+    results = simulate(strategy_classes, args.games, (args.grid, args.grid),
+                       workers=args.workers, seed=args.seed)
+    results.report()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+'''Compact binary snapshots of a battleship.Game.
+
+A snapshot holds the grid, the state, and for both players their name,
+online ID, ready flag, ships and firing history. The layout is fixed and
+little-endian:
+
+    header  magic "BSG", version, width, height, state, flags
+    salvo   salvo, size of each player's last salvo (salvo games only)
+    player  online ID, ready, name length, ship count, shot count
+            name
+            ID length and cell count of every ship, 2 bytes each
+            ship IDs
+            cells of every ship, then the shots in firing order
+
+Cells are stored as x * height + y, in 1, 2 or 4 bytes depending on the
+grid size (see the flags). A 10x10 game with two ships a side is about 60
+bytes before any shots, plus one byte per shot. The salvo is stored like
+in journal.py. Versions 1 and 2 still decode: they kept the ID lengths and
+cell counts in 1 byte each, and version 1 had no salvo games.
+'''
+
+import struct, sys
+from array import array
+from battleship import *
+
+MAGIC = b"BSG"
+VERSION = 3
+
+# Flags
+PLAYERS = 1 # the game has been initialized
+CELL_BYTES_2 = 2
+CELL_BYTES_4 = 4
+CELL_BYTES = CELL_BYTES_2 | CELL_BYTES_4
+SALVO = 8 # the salvo section follows the header
+
+# Cell flags -> array typecode
+cell_typecodes = {0: 'B', CELL_BYTES_2: 'H', CELL_BYTES_4: 'I'}
+
+# array uses the machine's byte order
+swap_bytes = sys.byteorder == 'big'
+
+header = struct.Struct("<3sBHHbB")
+salvo_header = struct.Struct("<HHH")
+player_header = struct.Struct("<IBHHI")
+
+SHIPS_AFLOAT_SALVO = 0xFFFF
+
+# Grid -> list from cell number to coordinate tuple, so decoding a cell is
+# one list lookup
+coordinate_tables = dict()
+
+
+class SnapshotError(Exception):
+    pass
+
+# Returns the cell flags for the grid
+def cell_flags(grid):
+    cells = grid[0] * grid[1]
+    if cells <= 1 << 8:
+        return 0
+    if cells <= 1 << 16:
+        return CELL_BYTES_2
+    return CELL_BYTES_4
+
+def coordinate_table(grid):
+    table = coordinate_tables.get(grid)
+    if table is None:
+        table = [(x, y) for x in range(grid[0]) for y in range(grid[1])]
+        coordinate_tables[grid] = table
+    return table
+
+def encode(game):
+    '''Returns the snapshot of the game as bytes'''
+
+    w, h = game.grid
+    flags = cell_flags(game.grid)
+    typecode = cell_typecodes[flags]
+    players = []
+    if game.player1 and game.player2:
+        flags |= PLAYERS
+        players = [game.player1, game.player2]
+
+    if game.salvo:
+        flags |= SALVO
+    parts = [header.pack(MAGIC, VERSION, w, h, game.state, flags)]
+    if game.salvo:
+        salvo = game.salvo
+        if salvo == SHIPS_AFLOAT:
+            salvo = SHIPS_AFLOAT_SALVO
+        sizes = [len(game.salvos[p][0]) if p in game.salvos else 0 for p in players]
+        parts.append(salvo_header.pack(salvo, *(sizes or [0, 0])))
+
+    for player in players:
+        ships = player.ships
+        shots = player.firing_coordinates
+        name = player.name.encode('utf-8')
+        ids = [str(ship.id).encode('utf-8') for ship in ships]
+        sizes = [ n for ship_id, ship in zip(ids, ships)
+                  for n in (len(ship_id), len(ship.coordinates)) ]
+        if any(n > 0xFFFF for n in sizes):
+            raise SnapshotError("A ship's ID or cell count is too long for a snapshot")
+        sizes = array('H', sizes)
+        cells = [x * h + y for ship in ships for x, y in ship.coordinates]
+        cells += [x * h + y for x, y in shots]
+        cells = array(typecode, cells)
+        if swap_bytes:
+            sizes.byteswap()
+            cells.byteswap()
+
+        parts.append(player_header.pack(getattr(player, 'online_id', 0),
+                                        player.ready, len(name), len(ships),
+                                        len(shots)))
+        parts.append(name)
+        parts.append(sizes.tobytes())
+        parts.extend(ids)
+        parts.append(cells.tobytes())
+
+    return b"".join(parts)
+
+def decode(data, game_class=Game, player_class=Player):
+    '''Rebuilds a game from a snapshot, any bytes-like object. The players
+    are made with player_class, and get their online ID back if they had
+    one and the class can hold it. Raises SnapshotError if the data is not
+    a snapshot this version can read.'''
+
+    # Slicing bytes is cheaper than slicing a memoryview for fields this small
+    data = bytes(data)
+    if len(data) < header.size:
+        raise SnapshotError("The snapshot is truncated")
+    magic, version, w, h, state, flags = header.unpack_from(data)
+    if magic != MAGIC:
+        raise SnapshotError("Not a game snapshot")
+    if version not in (1, 2, VERSION):
+        raise SnapshotError("Unsupported snapshot version {0}".format(version))
+    typecode = cell_typecodes.get(flags & CELL_BYTES)
+    if typecode is None:
+        raise SnapshotError("Unknown cell size")
+
+    grid = (w, h)
+    game = game_class(grid)
+    game.state = state
+    offset = header.size
+    salvo_sizes = []
+    if flags & SALVO:
+        try:
+            salvo, size1, size2 = salvo_header.unpack_from(data, offset)
+        except struct.error:
+            raise SnapshotError("The snapshot is truncated")
+        offset += salvo_header.size
+        game.salvo = SHIPS_AFLOAT if salvo == SHIPS_AFLOAT_SALVO else salvo
+        salvo_sizes = [size1, size2]
+
+    if not flags & PLAYERS:
+        return game
+
+    coordinates = coordinate_table(grid)
+    cell_size = array(typecode).itemsize
+    # Bytes of each ship's ID length and cell count
+    size_bytes = 2 if version >= 3 else 1
+    players = []
+    try:
+        for i in (0, 1):
+            online_id, ready, name_length, ship_count, shot_count = \
+                player_header.unpack_from(data, offset)
+            offset += player_header.size
+            name = data[offset:offset + name_length].decode('utf-8')
+            offset += name_length
+
+            end = offset + 2 * ship_count * size_bytes
+            if end > len(data):
+                raise SnapshotError("The snapshot is truncated")
+            if size_bytes == 1:
+                sizes = data[offset:end]
+            else:
+                sizes = array('H')
+                sizes.frombytes(data[offset:end])
+                if swap_bytes:
+                    sizes.byteswap()
+            offset = end
+            ids = []
+            for length in sizes[::2]:
+                ids.append(data[offset:offset + length].decode('utf-8'))
+                offset += length
+
+            end = offset + (sum(sizes[1::2]) + shot_count) * cell_size
+            if end > len(data):
+                raise SnapshotError("The snapshot is truncated")
+            if cell_size == 1:
+                cells = data[offset:end]
+            else:
+                cells = array(typecode)
+                cells.frombytes(data[offset:end])
+                if swap_bytes:
+                    cells.byteswap()
+            cells = [coordinates[c] for c in cells]
+            offset = end
+
+            player = player_class(name)
+            if online_id:
+                try:
+                    player.online_id = online_id
+                except AttributeError:
+                    pass # Like Player, it has no online ID to give back
+            player.ready = bool(ready)
+
+            start = 0
+            for ship_id, length in zip(ids, sizes[1::2]):
+                player.ships.append(Ship(ship_id, cells[start:start + length]))
+                start += length
+            player.firing_coordinates = cells[start:]
+            player.fired = set(player.firing_coordinates)
+            players.append(player)
+    except (struct.error, IndexError, UnicodeDecodeError):
+        raise SnapshotError("The snapshot is corrupt")
+    if offset != len(data):
+        raise SnapshotError("The snapshot is corrupt")
+
+    game.init_game(*players)
+    game.state = state
+    for player, size in zip(players, salvo_sizes):
+        if size:
+            game.salvos[player] = [player.firing_coordinates[-size:], None]
+    return game
@@ -2,8 +2,16 @@
 
 from battleship import *
 from text_frontend import *
-import unittest
+import unittest, random, struct, threading, time
 from server import *
+import simulator, ai, placement, snapshot, journal, io, os, script_runner
+import async_server, json, matchmaking, metrics, shard, wire
+from board import SparseBoard
+
+try:
+    from batch import *
+except ImportError: # NumPy is not installed
+    BatchGame = None
 
 class BattleShipSimpleTestCase(unittest.TestCase):
 
@@ -186,6 +194,21 @@ class BattleShipSimpleTestCase(unittest.TestCase):
         self.assertRaises(RepeatFireException, self.game.fire, self.player2, (1,0) )
         self.game.fire(self.player2, (1,2))
 
+    def testFiredSet(self):
+        self.game.init_game(self.player1, self.player2)
+
+        self.game.fire(self.player1, [2,3])
+        self.assertEqual(self.player1.firing_coordinates, [[2,3]])
+        self.assertEqual(self.player1.fired, set([(2,3)]))
+
+        self.game.fire(self.player2, (1,0))
+        self.game.incoming(self.player1)
+        self.game.incoming(self.player2)
+        self.game.outgoing(self.player1)
+        self.game.outgoing(self.player2)
+
+        self.assertRaises(RepeatFireException, self.game.fire, self.player1, (2,3))
+
     def testAddShip(self):
         player1 = Player("J")
         ship1 = Ship("A", [(0,0), (0,1)])
@@ -222,6 +245,709 @@ class BattleShipSimpleTestCase(unittest.TestCase):
         g.add_ship(p1, s1)
         self.assertTrue( len(p1.ships) != len(p2.ships) )
 
+    def testFleetIndex(self):
+        player = Player("J")
+        ships = [ Ship(str(r), [(r, c) for c in range(5)]) for r in range(5) ]
+        for ship in ships:
+            self.game.add_ship(player, ship)
+
+        fleet = self.game.fleet(player)
+        self.assertEqual(len(fleet.cells), 25)
+        self.assertTrue(fleet.cells[(3,4)] is ships[3])
+
+    def testListCoordinates(self):
+        # The XML-RPC server passes coordinates as lists
+        self.game.init_game(self.player1, self.player2)
+        self.game.add_ship(self.player2, Ship("Y", [[3,0], [3,1]]))
+        self.assertRaises(ShipCollisionException, self.game.add_ship,
+                          self.player2, Ship("X", [[3,1], [3,2]]))
+
+        self.game.fire(self.player1, [3,0])
+        self.game.fire(self.player2, [4,4])
+
+        coord, ship, sunk = self.game.incoming(self.player2)
+        self.assertEqual(ship.id, "Y")
+        self.assertEqual(sunk, False)
+
+    def playRound(self, player1_coord, player2_coord):
+        self.game.fire(self.player1, player1_coord)
+        self.game.fire(self.player2, player2_coord)
+
+        self.game.incoming(self.player1)
+        self.game.incoming(self.player2)
+
+        self.game.outgoing(self.player1)
+        self.game.outgoing(self.player2)
+
+    def testWinner(self):
+        self.game.init_game(self.player1, self.player2)
+        self.assertEqual(self.game.game_over(), False)
+
+        self.playRound( (1,0), (4,4) )
+        self.assertEqual(self.game.game_over(), False)
+        self.assertEqual(self.game.winner(), None)
+
+        self.playRound( (1,1), (0,0) )
+        self.assertEqual(self.game.game_over(), True)
+        self.assertTrue(self.game.winner() is self.player1)
+
+    def testDraw(self):
+        self.game.init_game(self.player1, self.player2)
+
+        self.playRound( (1,0), (0,0) )
+        self.playRound( (1,1), (0,1) )
+        self.assertEqual(self.game.game_over(), True)
+        self.assertEqual(self.game.winner(), None)
+
+    def testNoShipsIsNotGameOver(self):
+        self.game.init_game(Player("J"), Player("K"))
+        self.assertEqual(self.game.game_over(), False)
+
+    def salvoGame(self, salvo):
+        game = type(self.game)( (5,5), salvo )
+        game.init_game(self.player1, self.player2)
+        return game
+
+    def testSalvo(self):
+        game = self.salvoGame(2)
+        ship = self.player2.ships[0]
+
+        game.fire_salvo(self.player1, [(1,0), (1,1)])
+        game.fire_salvo(self.player2, [(4,4), (0,1)])
+        self.assertEqual(game.incoming_salvo(self.player1),
+                         [ ((4,4), None, False), ((0,1), self.player1.ships[0], False) ])
+        game.incoming_salvo(self.player2)
+
+        results = [ ((1,0), ship, False), ((1,1), ship, True) ]
+        self.assertEqual(game.outgoing_salvo(self.player1), results)
+        game.outgoing_salvo(self.player2)
+        self.assertEqual(game.salvo_results(self.player1), results)
+        self.assertTrue(game.winner() is self.player1)
+
+    def testSalvoChecks(self):
+        game = self.salvoGame(2)
+        self.assertRaises(SalvoSizeException, game.fire, self.player1, (0,0))
+        self.assertRaises(SalvoSizeException, game.fire_salvo, self.player1, [(0,0)])
+        self.assertRaises(RepeatFireException, game.fire_salvo, self.player1,
+                          [(0,0), (0,0)])
+        self.assertRaises(OutsideGridException, game.fire_salvo, self.player1,
+                          [(0,0), (5,0)])
+        self.assertEqual(self.player1.firing_coordinates, [])
+
+        game.fire_salvo(self.player1, [(0,0), (2,2)])
+        self.assertRaises(OutOfTurnException, game.fire_salvo, self.player1,
+                          [(3,3), (4,4)])
+        game.fire_salvo(self.player2, [(0,0), (2,2)])
+        game.incoming(self.player1)
+        game.incoming(self.player2)
+        game.outgoing(self.player1)
+        game.outgoing(self.player2)
+        self.assertRaises(RepeatFireException, game.fire_salvo, self.player1,
+                          [(3,3), (2,2)])
+
+    def testSalvoShipsAfloat(self):
+        self.player1.ships.append( Ship("B", [(3,0), (3,1)]) )
+        game = self.salvoGame(SHIPS_AFLOAT)
+        self.assertEqual(game.salvo_size(self.player1), 2)
+        self.assertEqual(game.salvo_size(self.player2), 1)
+
+        game.fire_salvo(self.player1, [(4,4), (4,3)])
+        game.fire(self.player2, (3,0))
+        for method in [game.incoming, game.outgoing]:
+            method(self.player1)
+            method(self.player2)
+        self.assertEqual(game.salvo_size(self.player1), 2)
+
+        game.fire_salvo(self.player1, [(4,2), (4,1)])
+        game.fire(self.player2, (3,1))
+        for method in [game.incoming, game.outgoing]:
+            method(self.player1)
+            method(self.player2)
+        self.assertEqual(game.salvo_size(self.player1), 1)
+
+    def testWaitForState(self):
+        self.assertEqual(self.game.wait_for_state(0, timeout=0.01), False)
+        self.game.init_game(self.player1, self.player2)
+        self.assertEqual(self.game.wait_for_state(0, timeout=0), True)
+
+        reached = []
+        waiter = threading.Thread(target=lambda:
+                      reached.append(self.game.wait_for_state(1, timeout=5)))
+        waiter.start()
+        self.game.fire(self.player1, (1,0))
+        self.game.fire(self.player2, (4,4))
+        waiter.join()
+        self.assertEqual(reached, [True])
+
+    def testGameOverMidRound(self):
+        self.game.init_game(self.player1, self.player2)
+        for p1_coord, p2_coord in [ ((1,0), (4,4)), ((1,1), (4,3)) ]:
+            self.game.fire(self.player1, p1_coord)
+            self.game.fire(self.player2, p2_coord)
+
+            # The shot that sinks the fleet only counts once it is resolved
+            self.assertFalse(self.game.game_over())
+            self.assertEqual(self.game.winner(), None)
+            self.assertEqual(self.game.ships_afloat(self.player2), 1)
+
+            self.game.incoming(self.player1)
+            self.game.incoming(self.player2)
+            self.game.outgoing(self.player1)
+            self.game.outgoing(self.player2)
+
+        self.assertTrue(self.game.game_over())
+        self.assertIs(self.game.winner(), self.player1)
+
+# Runs the same game rules against the bitboard backend
+class BitboardGameTestCase(BattleShipSimpleTestCase):
+
+    def setUp(self):
+        super(BitboardGameTestCase, self).setUp()
+        self.game = BitboardGame( (5,5) )
+
+    def testMasks(self):
+        player = Player("J")
+        self.game.add_ship( player, Ship("A", [(0,0), (0,1)]) )
+        self.game.add_ship( player, Ship("B", [(4,3), (4,4)]) )
+
+        board = self.game.bitboard(player)
+        self.assertEqual(board.fleet, 0b11 | (0b11 << 23))
+        self.assertEqual([m for m, s in board.ships], [0b11, 0b11 << 23])
+
+    def testShipsAddedAfterHits(self):
+        self.game.init_game(self.player1, self.player2)
+
+        self.game.fire(self.player1, (2,2))
+        self.game.fire(self.player2, (3,3))
+
+        self.game.incoming(self.player1)
+        self.game.incoming(self.player2)
+
+        self.game.outgoing(self.player1)
+        self.game.outgoing(self.player2)
+
+        # Ship placed directly on the player, after the bitboard was built
+        self.player2.ships.append( Ship("Y", [(2,2), (2,3)]) )
+
+        self.game.fire(self.player1, (2,3))
+        self.game.fire(self.player2, (4,4))
+
+        coord, ship, sunk = self.game.incoming(self.player2)
+        self.assertEqual(ship.id, "Y")
+        self.assertEqual(sunk, True)
+
+@unittest.skipIf(BatchGame is None, "NumPy is not installed")
+class BatchGameTestCase(unittest.TestCase):
+
+    def randomGame(self, rng):
+        game = Game( (6,6) )
+        game.init_game(Player("J"), Player("K"))
+        for p in [game.player1, game.player2]:
+            for length in [2, 3, 3]:
+                while True:
+                    x, y = rng.randrange(6), rng.randrange(6)
+                    if rng.randrange(2):
+                        coords = [(x, y + i) for i in range(length)]
+                    else:
+                        coords = [(x + i, y) for i in range(length)]
+                    try:
+                        game.add_ship(p, Ship(str(length), coords))
+                        break
+                    except (OutsideGridException, ShipCollisionException):
+                        continue
+        return game
+
+    def testMatchesGame(self):
+        rng = random.Random(1)
+        games = [self.randomGame(rng) for i in range(20)]
+        batch = BatchGame.from_games(games)
+
+        cells = [(x, y) for x in range(6) for y in range(6)]
+        orders = [ [rng.sample(cells, len(cells)) for p in range(2)]
+                   for g in games ]
+
+        for turn in range(len(cells)):
+            shots = [ [orders[g][p][turn] for g in range(len(games))]
+                      for p in range(2) ]
+            hit1, hit2 = batch.play_round(shots[0], shots[1])
+
+            for g, game in enumerate(games):
+                game.fire(game.player1, shots[0][g])
+                game.fire(game.player2, shots[1][g])
+                game.incoming(game.player1)
+                game.incoming(game.player2)
+
+                for p, player, (ids, sunk) in [ (0, game.player1, hit1),
+                                                (1, game.player2, hit2) ]:
+                    coord, ship, ship_sunk = game.outgoing(player)
+                    expected = game.other_player(player).ships.index(ship) + 1 if ship else 0
+                    self.assertEqual(ids[g], expected)
+                    self.assertEqual(sunk[g], ship_sunk)
+
+            winners = batch.winner()
+            for g, game in enumerate(games):
+                self.assertEqual(batch.game_over()[g], game.game_over())
+                expected = [game.player1, game.player2].index(game.winner()) if game.winner() else -1
+                self.assertEqual(winners[g], expected)
+
+    def testFireRules(self):
+        batch = BatchGame(3, (5,5))
+        batch.fire(0, [(0,0), (1,1), (2,2)])
+        self.assertRaises(OutOfTurnException, batch.fire, 0, [(0,1)] * 3)
+        self.assertRaises(OutsideGridException, batch.fire, 1, [(0,0), (5,0), (0,0)])
+        self.assertRaises(OutOfTurnException, batch.incoming, 0)
+
+        batch.fire(1, [(0,0)] * 3)
+        self.assertEqual(list(batch.state), [1, 1, 1])
+        batch.incoming(0)
+        batch.incoming(1)
+        batch.outgoing(0)
+        batch.outgoing(1)
+
+        self.assertRaises(RepeatFireException, batch.fire, 0, [(0,1), (1,1), (0,1)])
+        # Nothing changed in the games that accepted the shot
+        self.assertEqual(batch.shots[:, 0].sum(), 3)
+
+    def testAddShip(self):
+        batch = BatchGame(2, (5,5))
+        self.assertEqual(batch.add_ship(0, 1, [(0,0), (0,1)]), 1)
+        self.assertRaises(ShipCollisionException, batch.add_ship, 0, 1, [(0,1), (1,1)])
+        self.assertRaises(OutsideGridException, batch.add_ship, 1, 1, [(4,4), (4,5)])
+        self.assertEqual(list(batch.afloat[:, 1]), [1, 0])
+
+class SimulatorTestCase(unittest.TestCase):
+
+    def testPlayGame(self):
+        strategy_classes = (simulator.HuntTargetStrategy, simulator.RandomStrategy)
+        winner, rounds, hits = simulator.play_game(strategy_classes, (10,10),
+                                                   simulator.standard_fleet, 3)
+        self.assertTrue(winner in [0, 1, None])
+        self.assertTrue(rounds <= 100)
+        self.assertEqual(len(hits[0]), rounds)
+
+        # The loser may not have sunk anything, the winner hit every cell
+        if winner is not None:
+            self.assertEqual(sum(hits[winner]), sum(simulator.standard_fleet))
+
+        # Same seed, same game
+        self.assertEqual(simulator.play_game(strategy_classes, (10,10),
+                                             simulator.standard_fleet, 3),
+                         (winner, rounds, hits))
+
+    def testSimulate(self):
+        strategy_classes = (simulator.RandomStrategy, simulator.RandomStrategy)
+        results = simulator.simulate(strategy_classes, 30, (5,5), [2, 3],
+                                     workers=2, chunk=7, progress=None)
+        self.assertEqual(results.games, 30)
+        self.assertEqual(sum(results.wins), 30)
+        self.assertTrue(results.percentile(50) <= results.percentile(99) <= 25)
+
+    def testDrawsNotCounted(self):
+        results = simulator.Results()
+        self.assertEqual(results.mean_rounds(), None)
+        self.assertTrue(results.summary().startswith("0 games"))
+
+        results.add(0, 10, [[1], [0]])
+        results.add(1, 20, [[0], [1]])
+        results.add(None, 90, [[1], [1]])
+        self.assertEqual(results.wins, [1, 1, 1])
+        self.assertEqual(results.mean_rounds(), 15)
+        self.assertEqual(results.percentile(99), 20)
+
+class ProbabilityStrategyTestCase(unittest.TestCase):
+
+    # Counts the placement density from scratch
+    def recount(self, strategy, blocked):
+        density = dict.fromkeys(strategy.density, 0)
+        for length, afloat in strategy.afloat.items():
+            for placement in strategy.all_placements(length):
+                if not any(c in blocked for c in placement):
+                    for c in placement:
+                        density[c] += afloat
+        return density
+
+    def testIncrementalDensity(self):
+        rng = random.Random(2)
+        game = Game( (7,7) )
+        player = Player("K")
+        placement.place_fleet(game, player, [4, 3, 2], rng)
+        fleet = game.fleet(player)
+
+        strategy = ai.ProbabilityStrategy( (7,7), [4, 3, 2], rng )
+        self.assertEqual(strategy.density, self.recount(strategy, set()))
+
+        blocked = set()
+        shots = 0
+        while not fleet.destroyed():
+            coord = strategy.next_shot()
+            ship = fleet.hit(coord)
+            sunk = ship is not None and fleet.is_sunk(ship)
+            shots += 1
+
+            strategy.record(coord, ship, sunk)
+            if not ship:
+                blocked.add(coord)
+            elif sunk:
+                blocked.update(ship.coordinates)
+            self.assertEqual(strategy.density, self.recount(strategy, blocked))
+
+        self.assertTrue(shots < 49)
+
+class PlacementTestCase(unittest.TestCase):
+
+    def assertLegal(self, grid, lengths, fleet, no_touch):
+        self.assertEqual([len(c) for c in fleet], lengths)
+        cells = [c for coordinates in fleet for c in coordinates]
+        self.assertEqual(len(cells), len(set(cells)))
+        for x, y in cells:
+            self.assertTrue(0 <= x < grid[0] and 0 <= y < grid[1])
+
+        if no_touch:
+            owner = dict( (c, i) for i, coords in enumerate(fleet) for c in coords )
+            for (x, y), i in owner.items():
+                for dx in [-1, 0, 1]:
+                    for dy in [-1, 0, 1]:
+                        self.assertTrue(owner.get((x + dx, y + dy), i) == i)
+
+    def testRandomFleet(self):
+        rng = random.Random(4)
+        for grid, lengths, no_touch in [ ((10,10), [5, 4, 3, 3, 2], False),
+                                         ((10,10), [5, 4, 3, 3, 2], True),
+                                         ((7,3), [3, 2, 3, 1], False),
+                                         ((1000,1000), [5] * 50, True) ]:
+            for i in range(20 if grid[0] < 100 else 1):
+                fleet = placement.random_fleet(grid, lengths, rng, no_touch)
+                self.assertLegal(grid, lengths, fleet, no_touch)
+
+    def testCrowdedGrid(self):
+        # Only fits one way (up to symmetry)
+        fleet = placement.random_fleet( (3,3), [3, 3, 3], random.Random(1) )
+        self.assertLegal( (3,3), [3, 3, 3], fleet, False )
+
+        self.assertRaises(ValueError, placement.random_fleet, (3,3), [3, 3, 3],
+                          random.Random(1), True)
+
+    def testPlacementTable(self):
+        table = placement.placement_table( (10,10), 3 )
+        self.assertTrue(placement.placement_table( [10,10], 3 ) is table)
+        self.assertEqual(len(table.coordinates), 2 * 10 * 8)
+
+        for coordinates in [ [(2,3), (2,4), (2,5)], [[4,1], [2,1], [3,1]] ]:
+            index = placement.find_placement( (10,10), coordinates )
+            self.assertEqual(sorted(table.coordinates[index]),
+                             sorted(tuple(c) for c in coordinates))
+
+        for coordinates in [ [(0,0), (1,7), (2,0)], [(8,0), (9,0), (10,0)],
+                             [(0,0), (1,1), (2,2)] ]:
+            self.assertEqual(placement.find_placement( (10,10), coordinates ), None)
+
+        table.build_masks()
+        index = table.find( [(0,0), (0,1), (0,2)] )
+        self.assertEqual(table.masks[index], 0b111)
+        self.assertEqual(table.halos[index], 0b1111 | (0b1111 << 10))
+
+    def testLRUCache(self):
+        cache = placement.LRUCache(2)
+        cache.get("a", lambda: 1)
+        cache.get("b", lambda: 2)
+        cache.get("a", lambda: 3)
+        cache.get("c", lambda: 4)
+        self.assertEqual(list(cache.entries.items()), [("a", 1), ("c", 4)])
+
+    def testPlaceFleetAroundShips(self):
+        game = Game( (4,4) )
+        player = Player("J")
+        game.add_ship(player, Ship("A", [(0,0), (0,1), (0,2), (0,3)]))
+        placement.place_fleet(game, player, [4, 4, 4], random.Random(3))
+        self.assertEqual([s.id for s in player.ships], ["A", "B", "C", "D"])
+
+class SnapshotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.game = Game( (10,10) )
+        self.p1 = Player("J")
+        self.p2 = Player("K")
+        self.game.init_game(self.p1, self.p2)
+        self.game.add_ship(self.p1, Ship("A", [(0,0), (0,1)]))
+        self.game.add_ship(self.p1, Ship("B", [(5,5), (5,6), (5,7)]))
+        self.game.add_ship(self.p2, Ship("A", [(3,3), (4,3), (5,3)]))
+        self.game.add_ship(self.p2, Ship("B", [(8,1), (8,2)]))
+
+        self.game.fire(self.p1, (3,3))
+        self.game.fire(self.p2, (9,9))
+        self.game.incoming(self.p1)
+        self.game.incoming(self.p2)
+
+    def testRoundTrip(self):
+        data = snapshot.encode(self.game)
+        self.assertTrue(len(data) < 100)
+
+        game = snapshot.decode(data)
+        self.assertEqual(game.grid, (10,10))
+        self.assertEqual(game.state, 2)
+        for old, new in [(self.p1, game.player1), (self.p2, game.player2)]:
+            self.assertEqual(new.name, old.name)
+            self.assertEqual(new.ready, old.ready)
+            self.assertEqual(new.firing_coordinates, old.firing_coordinates)
+            self.assertEqual(new.fired, old.fired)
+            self.assertEqual([(s.id, s.coordinates) for s in new.ships],
+                             [(s.id, s.coordinates) for s in old.ships])
+        self.assertEqual(snapshot.encode(game), data)
+
+    def testOnlinePlayers(self):
+        game = Game( (10,10) )
+        p1, p2 = OnlinePlayer("J"), OnlinePlayer("K")
+        game.init_game(p1, p2)
+        game.add_ship(p1, Ship("A", [(0,0), (0,1)]))
+        data = snapshot.encode(game)
+
+        # Player has no online ID, so it is left out
+        copy = snapshot.decode(data)
+        self.assertEqual(copy.player1.name, "J")
+        self.assertEqual(copy.player1.ships[0].coordinates, [(0,0), (0,1)])
+        self.assertEqual(snapshot.decode(snapshot.encode(copy)).player2.name, "K")
+
+        copy = snapshot.decode(data, player_class=OnlinePlayer)
+        self.assertEqual(copy.player2.online_id, p2.online_id)
+        self.assertEqual(snapshot.encode(copy), data)
+
+    def testPlayOnAfterDecode(self):
+        game = snapshot.decode(snapshot.encode(self.game))
+        p1, p2 = game.player1, game.player2
+        coordinates, ship_hit, ship_sunk = game.outgoing(p1)
+        self.assertEqual( (coordinates, ship_hit.id, ship_sunk), ((3,3), "A", False) )
+        game.outgoing(p2)
+
+        for p1_coord, p2_coord in [ ((4,3), (0,0)), ((5,3), (0,1)) ]:
+            game.fire(p1, p1_coord)
+            game.fire(p2, p2_coord)
+            game.incoming(p1)
+            game.incoming(p2)
+            ship_sunk = game.outgoing(p1)[2]
+            game.outgoing(p2)
+        self.assertTrue(ship_sunk)
+        self.assertTrue(game.fleet(p1).is_sunk(p1.ships[0]))
+        self.assertFalse(game.game_over())
+        self.assertRaises(RepeatFireException, game.fire, p1, (3,3))
+
+    def testSalvoGame(self):
+        game = Game( (10,10), SHIPS_AFLOAT )
+        p1, p2 = Player("J"), Player("K")
+        game.init_game(p1, p2)
+        game.add_ship(p1, Ship("A", [(0,0), (0,1)]))
+        game.add_ship(p1, Ship("B", [(5,5), (5,6)]))
+        game.add_ship(p2, Ship("A", [(3,3), (4,3)]))
+        game.fire_salvo(p1, [(3,3), (4,3)])
+        game.fire(p2, (0,0))
+
+        decoded = snapshot.decode(snapshot.encode(game))
+        self.assertEqual(decoded.salvo, SHIPS_AFLOAT)
+        for g in [game, decoded]:
+            g.incoming(g.player1)
+            g.incoming(g.player2)
+            self.assertEqual([sunk for c, ship, sunk in g.outgoing_salvo(g.player1)],
+                             [False, True])
+
+    def testLargeGrid(self):
+        game = Game( (300,300) )
+        game.init_game(Player("J"), Player("K"))
+        game.add_ship(game.player1, Ship("A", [(299,298), (299,299)]))
+        data = snapshot.encode(game)
+        decoded = snapshot.decode(data)
+        self.assertEqual(decoded.player1.ships[0].coordinates, [(299,298), (299,299)])
+
+    def testLongShips(self):
+        game = Game( (300,300) )
+        game.init_game(Player("J"), Player("K"))
+        game.add_ship(game.player1, Ship("A" * 300, [(x, 0) for x in range(300)]))
+        decoded = snapshot.decode(snapshot.encode(game))
+        self.assertEqual(decoded.player1.ships[0].id, "A" * 300)
+        self.assertEqual(len(decoded.player1.ships[0].coordinates), 300)
+
+        game.add_ship(game.player2, Ship("B" * 0x10000, [(0, 0)]))
+        self.assertRaises(snapshot.SnapshotError, snapshot.encode, game)
+
+    def testVersion2(self):
+        data = bytes.fromhex("42534702040004000001000000000101000100010000004a0102410001"
+                             "0f000000000001000100000000004b0101420f")
+        game = snapshot.decode(data)
+        self.assertEqual(game.player1.ships[0].coordinates, [(0,0), (0,1)])
+        self.assertEqual(game.player2.ships[0].id, "B")
+        self.assertEqual(game.player1.firing_coordinates, [(3,3)])
+
+    def testUninitialized(self):
+        game = snapshot.decode(snapshot.encode(Game( (4,4) )))
+        self.assertEqual( (game.grid, game.state, game.player1), ((4,4), -1, None) )
+
+    def testBadData(self):
+        data = snapshot.encode(self.game)
+        self.assertRaises(snapshot.SnapshotError, snapshot.decode, b"XYZ" + data[3:])
+        for end in [5, 20, len(data) - 1]:
+            self.assertRaises(snapshot.SnapshotError, snapshot.decode, data[:end])
+
+class JournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.journal = journal.Journal(buffer_size=4)
+        self.game = Game( (10,10) )
+        self.journal.attach(self.game)
+        self.p1 = Player("J")
+        self.p2 = Player("K")
+
+        self.game.add_ship(self.p1, Ship("A", [(0,0), (0,1)]))
+        self.game.init_game(self.p1, self.p2)
+        self.game.add_ship(self.p2, Ship("A", [(3,3), (4,3)]))
+
+    def playRound(self, game, p1_coord, p2_coord):
+        game.fire(game.player1, p1_coord)
+        game.fire(game.player2, p2_coord)
+        game.incoming(game.player1)
+        game.incoming(game.player2)
+        game.outgoing(game.player1)
+        game.outgoing(game.player2)
+
+    def testReplay(self):
+        self.playRound(self.game, (3,3), (9,9))
+        self.playRound(self.game, (4,3), (0,0))
+        self.assertRaises(RepeatFireException, self.game.fire, self.p1, (3,3))
+
+        game = journal.replay(self.journal.getvalue(), game_id=1)
+        self.assertEqual(snapshot.encode(game), snapshot.encode(self.game))
+        self.assertEqual(game.winner().name, "J")
+
+    def testReplayUntil(self):
+        self.playRound(self.game, (3,3), (9,9))
+        data = self.journal.getvalue()
+
+        # init, two ships and both shots
+        game = journal.replay(data, game_id=1, until=5)
+        self.assertEqual(game.state, 1)
+        self.assertEqual(game.player2.firing_coordinates, [(9,9)])
+        game.incoming(game.player1)
+        game.incoming(game.player2)
+        self.assertEqual(game.outgoing(game.player1)[1].id, "A")
+
+    def testSeveralGames(self):
+        other = Game( (5,5) )
+        self.journal.attach(other)
+        other.init_game(Player("L"), Player("M"))
+        other.add_ship(other.player1, Ship("A", [(1,1)]))
+        self.playRound(self.game, (3,3), (9,9))
+        self.playRound(other, (0,0), (1,1))
+
+        games = journal.replay(self.journal.getvalue())
+        self.assertEqual(sorted(games), [1, 2])
+        self.assertEqual(games[2].grid, (5,5))
+        self.assertEqual(games[2].winner().name, "M")
+        self.assertEqual(games[1].player1.firing_coordinates, [(3,3)])
+
+    def testSalvo(self):
+        game = Game( (10,10), 2 )
+        self.journal.attach(game)
+        game.init_game(Player("L"), Player("M"))
+        game.add_ship(game.player2, Ship("A", [(1,1), (1,2)]))
+        game.fire_salvo(game.player1, [(1,1), (1,2)])
+        game.fire_salvo(game.player2, [(0,0), (0,1)])
+
+        replayed = journal.replay(self.journal.getvalue(), game_id=2)
+        self.assertEqual(replayed.salvo, 2)
+        replayed.incoming(replayed.player1)
+        replayed.incoming(replayed.player2)
+        self.assertEqual(len(replayed.outgoing_salvo(replayed.player1)), 2)
+        self.assertTrue(replayed.winner() is replayed.player1)
+
+    def testOnlinePlayers(self):
+        game = Game( (10,10) )
+        self.journal.attach(game)
+        game.init_game(OnlinePlayer("L"), OnlinePlayer("M"))
+        data = self.journal.getvalue()
+
+        # Player has no online ID, so it is left out
+        self.assertEqual(journal.replay(data, 2).player1.name, "L")
+        replayed = journal.replay(data, 2, player_class=OnlinePlayer)
+        self.assertEqual(replayed.player2.online_id, game.player2.online_id)
+
+    def testLongShips(self):
+        game = Game( (400,10) )
+        self.journal.attach(game)
+        game.init_game(Player("L"), Player("M"))
+        game.add_ship(game.player1, Ship("A" * 300, [(x, 0) for x in range(300)]))
+
+        replayed = journal.replay(self.journal.getvalue(), 2)
+        self.assertEqual(replayed.player1.ships[0].id, "A" * 300)
+        self.assertEqual(len(replayed.player1.ships[0].coordinates), 300)
+
+        # Not placed when the journal can't hold it
+        ship = Ship("B" * 0x10000, [(0, 1)])
+        self.assertRaises(journal.JournalError, game.add_ship, game.player1, ship)
+        self.assertEqual(len(game.player1.ships), 1)
+        game.add_ship(game.player1, Ship("B", [(0, 1)]))
+
+    def testRefusedRecords(self):
+        game = Game( (10,10) )
+        self.journal.attach(game)
+        p1, p2 = Player("L"), Player("M")
+        p1.ships.append(Ship("B" * 0x10000, [(0, 1)]))
+        self.assertRaises(journal.JournalError, game.init_game, p1, p2)
+        self.assertEqual( (game.player1, game.state), (None, -1) )
+
+        # The game is left as it was, so the call can be made again
+        p1.ships.clear()
+        game.init_game(p1, p2)
+        self.assertRaises(struct.error, game.fire, p1, (1.5, 2))
+        self.assertEqual( (p1.firing_coordinates, game.state), ([], 0) )
+        game.fire(p1, (1, 2))
+        self.assertEqual(journal.replay(self.journal.getvalue(), 2).player1.fired,
+                         {(1, 2)})
+
+    def testBuffering(self):
+        sink = io.BytesIO()
+        game = Game( (10,10) )
+        journal.Journal(sink, buffer_size=3).attach(game)
+        game.init_game(Player("J"), Player("K"))
+        game.fire(game.player1, (1,1))
+        self.assertEqual(sink.getvalue(), b"")
+        game.fire(game.player2, (1,1))
+        self.assertEqual(journal.replay(sink.getvalue(), 1).state, 1)
+
+    def testThreads(self):
+        sink = io.BytesIO()
+        log = journal.Journal(sink, buffer_size=3)
+        games = [Game( (10,10) ) for i in range(8)]
+        for game in games:
+            log.attach(game)
+            game.init_game(Player("J"), Player("K"))
+
+        # Writes race the appends of the other threads
+        def play(game):
+            for x in range(10):
+                for y in range(10):
+                    game.fire(game.player1, (x,y))
+                    game.fire(game.player2, (x,y))
+                    game.incoming(game.player1)
+                    game.incoming(game.player2)
+                    game.outgoing(game.player1)
+                    game.outgoing(game.player2)
+
+        threads = [threading.Thread(target=play, args=(g,)) for g in games]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        log.flush()
+
+        replayed = journal.replay(sink.getvalue())
+        for game in games:
+            copy = replayed[game.journal_id]
+            self.assertEqual(copy.player1.firing_coordinates,
+                             game.player1.firing_coordinates)
+            self.assertEqual(copy.state, game.state)
+
+    def testCorrupt(self):
+        data = self.journal.getvalue()
+        self.assertRaises(journal.JournalError, journal.replay, data[:-1])
+        self.assertRaises(journal.JournalError, journal.replay, b"\x09" + data[1:])
+
 class TextFrontEndTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -267,6 +993,60 @@ class TextFrontEndTestCase(unittest.TestCase):
         self.frontend.addShipToBoard(ship2, board)
         self.assertEqual(board, board_result_2)
 
+    def testSparseBoard(self):
+        board = SparseBoard(3, 3)
+        self.frontend.addShipToBoard(Ship("B", [(0,0), (1,0)]), board)
+        self.assertEqual(board.tolist(), [ ['B','~','~'], ['B','~','~'], ['~','~','~'] ])
+        self.assertEqual(board[-1][-1], '~')
+        self.assertRaises(IndexError, lambda: board[3][0])
+        self.assertRaises(IndexError, lambda: board[0][3])
+
+        board[0][0] = '~'
+        self.assertEqual(board.cells, { (1,0): 'B' })
+
+    def testSparsePrintBoard(self):
+        dense = [ ['~','X','~'], ['~','~','~'], ['M','~','~'] ]
+        sparse = SparseBoard(3, 3)
+        sparse[0][1] = 'X'
+        sparse[2][0] = 'M'
+
+        printed = []
+        for board in [dense, sparse]:
+            output = io.StringIO()
+            frontend = TextGame(printFunc=lambda *args, **kwargs:
+                                    print(*args, file=output, **kwargs))
+            frontend.printBoard(board)
+            printed.append(output.getvalue())
+        self.assertEqual(printed[0], printed[1])
+
+    def testLargeGridPlayer(self):
+        player = FrontEndPlayer("J", (5000, 5000))
+        player.opponentsBoard[4999][4999] = 'M'
+        self.assertEqual(len(player.board), 5000)
+        self.assertEqual(len(player.board[0]), 5000)
+        self.assertEqual(len(player.opponentsBoard.cells), 1)
+
+    def testWinningGameScript(self):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "..", "input", "winning_game")
+        name, outcome, read, lines, seconds = script_runner.run_script(path)
+        self.assertEqual( (name, outcome, read), ("winning_game", "won by J", lines) )
+
+    def testHeadlessGame(self):
+        output = io.StringIO()
+        script = script_runner.ScriptInput(["y", "J", "5", "random"] +
+            ["{0},{1}".format(x, y) for x in range(1, 6) for y in range(1, 6)])
+        frontend = PVPTextGame(script, lambda *args, **kwargs:
+                                   print(*args, file=output, **kwargs),
+                               clear=False, rng=random.Random(1))
+        winner = frontend.main()
+        self.assertTrue(winner.name in ["J", "The computer"])
+        self.assertTrue("Congratulations " + winner.name in output.getvalue())
+
+        frontend = PVPTextGame(script_runner.ScriptInput(["n", "J", "K", "5"]),
+                               lambda *args, **kwargs: None, clear=False)
+        self.assertRaises(EOFError, frontend.main)
+
 class GameManagerTestCase(unittest.TestCase):
 
     # Emulates the server calling the _dispatch method
@@ -317,6 +1097,113 @@ class GameManagerTestCase(unittest.TestCase):
         self.assertTrue(self.p2.voted)
         self.assertTrue(self.p2.accepted_game)
 
+    def testRegisterRuleset(self):
+        self.manager.register_player(self.p1, [8, 6], 3)
+        self.manager.register_player(self.p2)
+        self.assertTrue( self.p1.online_id in self.manager.free_players )
+        self.assertTrue( self.p2.online_id in self.manager.free_players )
+
+        # P3 wants the same grid and salvo as P1
+        self.manager.register_player(self.p3, (8, 6), 3)
+        self.assertTrue( self.p2.online_id in self.manager.free_players )
+        for p in [self.p1, self.p3]:
+            self.manager.accept_opponent(p)
+        game = self.manager.online_games[self.p1.online_id]
+        self.assertEqual(game.grid, (8, 6))
+        self.assertEqual(game.salvo, 3)
+
+    def testBadRuleset(self):
+        self.manager = GameManager(journal.Journal())
+        for grid, salvo in [((70000, 2), None), ((0, 0), None), (("a", "b"), None),
+                            ((8, 8, 8), None), (8, None), ((True, 8), None),
+                            (None, -5), (None, 0x10000), (None, "3")]:
+            self.assertRaises(RulesetException, self.manager.register_player,
+                              self.p1, grid, salvo)
+            self.assertRaises(RulesetException, self.manager.register_player,
+                              self.p2, grid, salvo)
+        self.assertEqual(self.manager.proposed_games, {})
+        self.assertEqual(len(self.manager.free_players), 0)
+
+        self.manager.register_player(self.p1, None, SHIPS_AFLOAT)
+        self.manager.register_player(self.p2, [8, 8], 0)
+        self.manager.register_player(self.p3, None, SHIPS_AFLOAT)
+        for p in [self.p1, self.p3]:
+            self.manager.accept_opponent(p)
+        self.assertEqual(self.manager.online_games[self.p1.online_id].salvo,
+                         SHIPS_AFLOAT)
+
+    def testDeregisterPlayer(self):
+        self.manager.register_player(self.p1)
+        self.manager.deregister_player(self.p1)
+        self.assertTrue( self.p1.online_id not in self.manager.free_players )
+        self.assertTrue( self.p1.online_id not in self.manager.online_players )
+
+        # P3 sees the game proposed with P2 rejected
+        self.manager.register_player(self.p2)
+        self.manager.register_player(self.p3)
+        self.manager.accept_opponent(self.p3)
+        self.manager.deregister_player(self.p2)
+        self.assertEqual(self.manager.opponent_responded(self.p3), (True, False))
+        self.assertEqual(self.manager.proposed_games, {})
+
+        self.manager.register_player(self.p1)
+        self.manager.register_player(self.p3)
+        self.assertEqual(self.manager.opponent_responded(self.p3), (False, None))
+        for p in [self.p1, self.p3]:
+            self.manager.accept_opponent(p)
+        self.manager.deregister_player(self.p1)
+        self.assertEqual(list(self.manager.online_games), [self.p3.online_id])
+        self.assertEqual(self.manager.rejected_games, {})
+
+    def testSweep(self):
+        self.now = 0
+        manager = GameManager(lobby_ttl=None, clock=lambda: self.now)
+        players = [{'name': str(i), 'online_id': i} for i in range(6)]
+        for p in players:
+            manager._dispatch("register_player", (p, (1, 1)))
+        for p in players[:2]:
+            manager._dispatch("accept_opponent", (p,))
+        for p in players[2:4]:
+            manager._dispatch("reject_opponent", (p,))
+        for p in players[:2]:
+            manager._dispatch("add_ship", (p, {'id': "a", 'coordinates': [(0, 0)]}))
+        for p in players[:2]:
+            manager._dispatch("fire", (p, (0, 0)))
+        for method in ["incoming", "outgoing"]:
+            for p in players[:2]:
+                manager._dispatch(method, (p,))
+        self.assertEqual(len(manager.online_players), 6)
+        self.assertEqual(len(manager.deadlines), 6 + 2 + 2)
+
+        # The rejected and finished games go first, then the idle players
+        self.now = 60
+        self.assertEqual(manager.sweep(), 4)
+        self.assertEqual(manager.online_games, {})
+        self.assertEqual(manager.rejected_games, {})
+        self.assertEqual(len(manager.proposed_games), 2)
+
+        manager._dispatch("opponent_found", (players[4],))
+        self.now = 600
+        self.assertEqual(manager.sweep(), 6)
+        self.assertEqual(list(manager.online_players), [4])
+        self.assertEqual(manager.opponent_responded(manager.online_players[4]),
+                         (True, False))
+        self.now = 660
+        manager.sweep()
+        self.assertEqual(manager.online_players, {})
+        self.assertEqual(manager.rejected_games, {})
+        self.assertEqual(manager.deadlines, [])
+
+    def testSweepFailure(self):
+        self.manager._schedule(0, "not an eviction", 1)
+        self.manager._schedule(1, self.manager._evict_idle, self.p1)
+        self.manager.player_ttl = 0
+        with self.assertLogs('server', 'ERROR'):
+            self.assertEqual(self.manager.sweep(), 2)
+        self.assertTrue(self.p1.online_id not in self.manager.online_players)
+        self.assertRaises(Exception, self.manager._dispatch, "_schedule", (0, "x", 1))
+        self.assertEqual(self.manager.deadlines, [])
+
     def testRejectOpponent(self):
         self.manager.register_player(self.p1)
         self.manager.register_player(self.p2)
@@ -619,6 +1506,896 @@ class GameManagerTestCase(unittest.TestCase):
 
         self.assertRaises(OutOfTurnException, self.manager.incoming, self.p2)
 
+    def testPlayerMarshalling(self):
+        self.p1.fired.add( (0,0) )
+        params, method = loads( dumps( (self.p1,), allow_none=True ) )
+        self.assertEqual(params[0], {'name': "Player 1",
+                                     'online_id': self.p1.online_id})
+
+    def testWinner(self):
+        self.manager.register_player(self.p1)
+        self.manager.register_player(self.p2)
+
+        self.manager.accept_opponent(self.p1)
+        self.manager.accept_opponent(self.p2)
+
+        self.manager.add_ship(self.p1, Ship("A", [(0,0), (0,1)]))
+        self.manager.add_ship(self.p2, Ship("A", [(0,0), (0,1)]))
+
+        for p1_coord, p2_coord in [ ((0,0), (5,5)), ((0,1), (5,6)) ]:
+            self.assertEqual(self.manager.game_over(self.p1), False)
+            self.assertEqual(self.manager.winner(self.p1), None)
+
+            self.manager.fire(self.p1, p1_coord)
+            self.manager.fire(self.p2, p2_coord)
+
+            self.manager.incoming(self.p1)
+            self.manager.incoming(self.p2)
+
+            self.manager.outgoing(self.p1)
+            self.manager.outgoing(self.p2)
+
+        self.assertEqual(self.manager.game_over(self.p2), True)
+        self.assertEqual(self.manager.winner(self.p2), self.p1.online_id)
+
+    def testMatchmakingNotifications(self):
+        found = []
+        waiter = threading.Thread(target=lambda: found.append(
+            self.manager.wait_for(lambda: self.manager.opponent_found(self.p1), 5)))
+        waiter.start()
+        self.manager.register_player(self.p1)
+        self.manager.register_player(self.p2)
+        waiter.join()
+        self.assertEqual(found, [True])
+
+        self.manager.accept_opponent(self.p1)
+        self.assertEqual(self.manager.wait_for(
+            lambda: self.manager.opponent_responded(self.p1)[0], 0.01), False)
+        self.manager.accept_opponent(self.p2)
+        self.assertEqual(self.manager.wait_for(
+            lambda: self.manager.opponent_responded(self.p1)[0], 0), True)
+
+    def testCheckpoint(self):
+        self.manager.register_player(self.p1)
+        self.manager.register_player(self.p2)
+        self.manager.accept_opponent(self.p1)
+        self.manager.accept_opponent(self.p2)
+        self.manager.add_ship(self.p1, Ship("A", [(0,0), (0,1)]))
+        self.manager.add_ship(self.p2, Ship("A", [(0,0), (0,1)]))
+        self.manager.fire(self.p1, (0,0))
+
+        snapshots = self.manager.checkpoint()
+        self.assertEqual(len(snapshots), 1)
+
+        manager = GameManager()
+        manager.restore(snapshots)
+        p1 = manager.online_players[self.p1.online_id]
+        p2 = manager.online_players[self.p2.online_id]
+        self.assertEqual(p1.name, "Player 1")
+        self.assertIs(manager.online_games[p1.online_id],
+                      manager.online_games[p2.online_id])
+
+        manager.fire(p2, (5,5))
+        manager.incoming(p1)
+        manager.incoming(p2)
+        self.assertEqual(manager.outgoing(p1)[0], (0,0))
+
+        # A game that can't be snapshot does not stop the others
+        game = Game( (10,10) )
+        game.init_game(OnlinePlayer("3"), OnlinePlayer("4"))
+        game.player1.ships.append(Ship("A" * 0x10000, [(0,0)]))
+        self.manager.add_online_game(game)
+        with self.assertLogs('server', 'ERROR'):
+            self.assertEqual(len(self.manager.checkpoint()), 1)
+
+    def testRecover(self):
+        self.manager = GameManager(journal.Journal())
+        for p in [self.p1, self.p2]:
+            self.manager.online_players[p.online_id] = p
+            self.manager.register_player(p)
+        for p in [self.p1, self.p2]:
+            self.manager.accept_opponent(p)
+        self.manager.add_ship(self.p1, Ship("A", [(0,0), (0,1)]))
+        self.manager.add_ship(self.p2, Ship("A", [(0,0), (0,1)]))
+        self.manager.fire(self.p1, (0,0))
+
+        manager = GameManager(journal.Journal())
+        manager.recover(self.manager.journal.getvalue())
+        p1 = manager.online_players[self.p1.online_id]
+        p2 = manager.online_players[self.p2.online_id]
+        self.assertRaises(OutOfTurnException, manager.fire, p1, (0,1))
+        manager.fire(p2, (5,5))
+        manager.incoming(p1)
+        self.assertEqual(manager.incoming(p2)[:2], ((0,0), p2.ships[0]))
+        self.assertEqual(manager.journal.getvalue()[0], journal.FIRE)
+
+    def testLongPoll(self):
+        self.assertFalse(self.manager.wait_opponent(self.p1, 0.01))
+
+        results = []
+        def wait(f, player):
+            results.append(f(player, 10))
+        def waiting(f, player):
+            thread = threading.Thread(target=wait, args=(f, player))
+            thread.start()
+            return thread
+
+        thread = waiting(self.manager.wait_opponent, self.p1)
+        self.manager.register_player(self.p1)
+        self.manager.register_player(self.p2)
+        thread.join()
+
+        thread = waiting(self.manager.wait_response, self.p1)
+        self.manager.accept_opponent(self.p1)
+        self.assertFalse(self.manager.wait_response(self.p2, 0.01))
+        self.manager.accept_opponent(self.p2)
+        thread.join()
+
+        thread = waiting(self.manager.wait_game, self.p2)
+        for p in [self.p1, self.p2]:
+            self.manager.add_ship(p, Ship("A", [(0,0), (0,1)]))
+            self.manager.add_ship(p, Ship("B", [(1,0), (1,1)]))
+        thread.join()
+
+        thread = waiting(self.manager.wait_incoming, self.p1)
+        self.manager.fire(self.p1, (0,0))
+        self.assertFalse(self.manager.wait_incoming(self.p2, 0.01))
+        self.manager.fire(self.p2, (0,0))
+        thread.join()
+
+        thread = waiting(self.manager.wait_outgoing, self.p2)
+        self.manager.incoming(self.p1)
+        self.manager.incoming(self.p2)
+        thread.join()
+        self.assertEqual(results, [True] * 5)
+
+        # Timeouts are capped
+        self.manager.max_wait = 0.01
+        self.assertTrue(self.manager.wait_outgoing(self.p1))
+        self.manager.outgoing(self.p1)
+        self.manager.outgoing(self.p2)
+        self.assertFalse(self.manager.wait_incoming(self.p1, 60))
+
+    def testTakeTurn(self):
+        for p in [self.p1, self.p2]:
+            self.manager.register_player(p)
+        for p in [self.p1, self.p2]:
+            self.manager.accept_opponent(p)
+        for p in [self.p1, self.p2]:
+            self.manager.add_ship(p, Ship("A", [(0,0), (0,1)]))
+            self.manager.add_ship(p, Ship("B", [(1,0), (1,1)]))
+
+        self.assertRaises(OutOfTurnException, self.manager.take_turn, self.p1, None)
+        self.assertEqual(self.manager.take_turn(self.p1, (0,0), 0.01), None)
+        self.assertRaises(OutOfTurnException, self.manager.fire, self.p1, (0,1))
+
+        turns = []
+        thread = threading.Thread(target=lambda:
+            turns.append(self.manager.take_turn(self.p1, None, 10)))
+        thread.start()
+        p2_turn = self.manager.take_turn(self.p2, (5,5), 10)
+        thread.join()
+
+        p1_turn = turns[0]
+        self.assertEqual(p1_turn, ( ((5,5), None, False),
+                                    ((0,0), self.p2.ships[0], False) ))
+        self.assertEqual(p2_turn, ( ((0,0), self.p2.ships[0], False),
+                                    ((5,5), None, False) ))
+
+        # The opponent fires, but does not call incoming in time
+        self.manager.fire(self.p2, (0,0))
+        incoming, outgoing = self.manager.take_turn(self.p1, (0,1), 0.01)
+        self.assertEqual(incoming, ((0,0), self.p1.ships[0], False))
+        self.assertEqual(outgoing, None)
+        self.manager.incoming(self.p2)
+        self.assertEqual(self.manager.outgoing(self.p1),
+                         ((0,1), self.p2.ships[0], True))
+
+    def testTakeTurnRetry(self):
+        for p in [self.p1, self.p2]:
+            self.manager.register_player(p)
+        for p in [self.p1, self.p2]:
+            self.manager.accept_opponent(p)
+        for p in [self.p1, self.p2]:
+            self.manager.add_ship(p, Ship("A", [(0,0), (0,1)]))
+            self.manager.add_ship(p, Ship("B", [(1,0), (1,1)]))
+
+        # The opponent fires between the timed out call and the retry
+        self.assertEqual(self.manager.take_turn(self.p1, (0,0), 0.01), None)
+        self.manager.fire(self.p2, (5,5))
+        self.assertEqual(self.manager.take_turn(self.p1, None, 0.01),
+                         ( ((5,5), None, False), None ))
+
+        # Then calls incoming between the retries
+        self.manager.incoming(self.p2)
+        self.assertEqual(self.manager.take_turn(self.p1, None, 0.01),
+                         ( None, ((0,0), self.p2.ships[0], False) ))
+        self.assertRaises(OutOfTurnException, self.manager.take_turn, self.p1, None)
+        self.manager.outgoing(self.p2)
+        self.assertRaises(OutOfTurnException, self.manager.take_turn, self.p1, None)
+
+        # The whole round lands between the two calls
+        self.assertEqual(self.manager.take_turn(self.p1, (0,1), 0.01), None)
+        self.manager.fire(self.p2, (5,6))
+        p2_turn = []
+        thread = threading.Thread(target=lambda:
+            p2_turn.append(self.manager.take_turn(self.p2, None, 10)))
+        thread.start()
+        self.assertEqual(self.manager.take_turn(self.p1, None, 10),
+                         ( ((5,6), None, False), ((0,1), self.p2.ships[0], True) ))
+        thread.join()
+        self.assertEqual(p2_turn[0][1], ((5,6), None, False))
+
+    def testAbandonedGame(self):
+        self.now = 0
+        self.manager = GameManager(clock=lambda: self.now)
+        for p in [self.p1, self.p2]:
+            self.manager.online_players[p.online_id] = p
+            self.manager.register_player(p)
+        for p in [self.p1, self.p2]:
+            self.manager.accept_opponent(p)
+        for p in [self.p1, self.p2]:
+            self.manager.add_ship(p, Ship("A", [(0,0), (0,1)]))
+            self.manager.add_ship(p, Ship("B", [(1,0), (1,1)]))
+
+        # The waiting opponent hears of it at once
+        errors = []
+        def take_turn():
+            try:
+                self.manager.take_turn(self.p2, (5,5), 10)
+            except OpponentLeftException as e:
+                errors.append(e)
+        thread = threading.Thread(target=take_turn)
+        thread.start()
+        while not self.p2.ready:
+            time.sleep(0.001)
+        self.manager.deregister_player(self.p1)
+        thread.join()
+        self.assertEqual(len(errors), 1)
+
+        for method in [self.manager.take_turn, self.manager.wait_incoming]:
+            self.assertRaises(OpponentLeftException, method, self.p2, None)
+        self.assertRaises(OpponentLeftException, self.manager.incoming_ready, self.p2)
+        self.assertRaises(OpponentLeftException, self.manager.fire, self.p2, (6,6))
+        self.assertTrue(self.manager.game_over(self.p2))
+        self.assertEqual(self.manager.winner(self.p2), self.p2.online_id)
+
+        self.now = GameManager.game_ttl
+        self.manager.sweep()
+        self.assertEqual(self.manager.online_games, {})
+
+    def testOnlineTextGame(self):
+        rpc_server = ThreadedXMLRPCServer(("127.0.0.1", 0), allow_none=True,
+                                          logRequests=False)
+        rpc_server.register_instance(self.manager)
+        port = rpc_server.server_address[1]
+        thread = threading.Thread(target=rpc_server.serve_forever)
+        thread.start()
+
+        class LocalTextGame(OnlineTextGame):
+            def connect(self):
+                return ServerProxy("http://127.0.0.1:{0}".format(port),
+                                   allow_none=True, transport=ExceptionTransport())
+
+        shots = ["{0},{1}".format(x, y) for x in range(1, 11) for y in range(1, 11)]
+        winners = []
+        def play(name, seed):
+            frontend = LocalTextGame(script_runner.ScriptInput([name, "random"] + shots),
+                                     lambda *args, **kwargs: None,
+                                     clear=False, rng=random.Random(seed))
+            winners.append(frontend.main())
+
+        threads = [threading.Thread(target=play, args=args)
+                   for args in [("J", 1), ("K", 2)]]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        rpc_server.shutdown()
+        rpc_server.server_close()
+        thread.join()
+
+        self.assertEqual(len(winners), 2)
+        self.assertEqual(winners[0], winners[1])
+        game = list(self.manager.online_games.values())[0]
+        self.assertTrue(game.game_over())
+
+    def testOpponentLeavesTextGame(self):
+        class LocalTextGame(OnlineTextGame):
+            def connect(this):
+                return self.manager
+
+        output = []
+        frontend = LocalTextGame(script_runner.ScriptInput(["J", "random", "1,1"]),
+                                 lambda *args, **kwargs: output.extend(args),
+                                 clear=False, rng=random.Random(1))
+        winner = []
+        thread = threading.Thread(target=lambda: winner.append(frontend.main()))
+        thread.start()
+
+        while not len(self.manager.free_players):
+            time.sleep(0.001)
+        self.manager.register_player(self.p2)
+        self.manager.accept_opponent(self.p2)
+        while self.manager.opponent_responded(self.p2) != (True, True):
+            time.sleep(0.001)
+        self.manager.deregister_player(self.p2)
+        thread.join()
+
+        self.assertTrue("Your opponent left the game." in output)
+        self.assertEqual(output[-1], "Congratulations you won!")
+
+    def testMaintenanceNotCallable(self):
+        for method in ["checkpoint", "restore", "recover", "init_game", "sweep"]:
+            self.assertRaises(Exception, self.manager._dispatch, method, ())
+        self.assertEqual(self.manager.online_players, {
+            p.online_id: p for p in [self.p1, self.p2, self.p3]})
+
+    def testStats(self):
+        p1 = {'name': "1", 'online_id': self.p1.online_id}
+        p2 = {'name': "2", 'online_id': self.p2.online_id}
+        self.manager._dispatch("register_player", (p1,))
+        self.manager._dispatch("register_player", (p2,))
+        report = self.manager.stats()
+        self.assertEqual(report['gauges'], {'online_players': 3, 'free_players': 0,
+                                            'longest_wait': 0, 'proposed_games': 1,
+                                            'online_games': 0})
+
+        for p in [p1, p2]:
+            self.manager._dispatch("accept_opponent", (p,))
+        self.assertRaises(OutOfTurnException, self.manager._dispatch,
+                          "incoming", (p1,))
+        self.assertRaises(KeyError, self.manager._dispatch, "fire",
+                          ({'name': "4", 'online_id': -1}, (0,0)))
+        self.manager._dispatch("fire", (p1, (0,0)))
+
+        report = self.manager.stats()
+        self.assertEqual(report['gauges']['online_games'], 1)
+        self.assertEqual(report['gauges']['proposed_games'], 0)
+        methods = report['methods']
+        self.assertEqual(sorted(methods), ["accept_opponent", "fire", "incoming",
+                                           "register_player"])
+        self.assertEqual(methods['register_player']['calls'], 2)
+        self.assertEqual(methods['fire']['errors'], {'KeyError': 1})
+        self.assertEqual(methods['incoming']['errors'], {'OutOfTurnException': 1})
+        for stats in methods.values():
+            self.assertEqual(sum(n for bound, n in stats['histogram']), stats['calls'])
+            self.assertTrue(0 <= stats['p50_ms'] <= stats['p99_ms'] <= stats['max_ms'])
+
+        # The report can be sent over XML-RPC, and dumped
+        dumps( (report,), methodresponse=True, allow_none=True )
+        output = io.StringIO()
+        metrics.dump(report, output)
+        self.assertTrue("OutOfTurnException 1" in output.getvalue())
+
+    def testConcurrentMatchmaking(self):
+        players = [OnlinePlayer(str(i)) for i in range(200)]
+        for i, p in enumerate(players):
+            p.online_id = i
+            self.manager.online_players[i] = p
+
+        def register(players):
+            for p in players:
+                self.manager.register_player(p)
+                if self.manager.opponent_found(p):
+                    self.manager.accept_opponent(p)
+
+        threads = [threading.Thread(target=register, args=(players[i::8],))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # Every player was paired once, the last one to register accepts
+        # for both
+        self.assertEqual(len(self.manager.free_players), 0)
+        for p in players:
+            if p.online_id in self.manager.proposed_games:
+                self.manager.accept_opponent(p)
+        self.assertEqual(len(self.manager.proposed_games), 0)
+        games = set(self.manager.online_games[p.online_id] for p in players)
+        self.assertEqual(len(games), 100)
+        for game in games:
+            self.assertTrue(game.player1 in players and game.player2 in players)
+
+    def testConcurrentGames(self):
+        self.manager = GameManager(journal.Journal())
+        games = []
+        for i in range(8):
+            game = Game( (10,10) )
+            self.manager.journal.attach(game)
+            game.init_game(OnlinePlayer("1"), OnlinePlayer("2"))
+            game.player1.online_id, game.player2.online_id = 2 * i, 2 * i + 1
+            self.manager.add_online_game(game)
+            games.append(game)
+
+        # Each player plays from a thread of its own, both firing on every
+        # cell of the grid in order
+        def play(player):
+            self.manager.add_ship(player, Ship("A", [(9,8), (9,9)]))
+            for x in range(10):
+                for y in range(10):
+                    while True:
+                        try:
+                            self.manager.fire(player, (x,y))
+                            break
+                        except OutOfTurnException:
+                            time.sleep(0.001)
+                    while not self.manager.incoming_ready(player):
+                        time.sleep(0.001)
+                    self.manager.incoming(player)
+                    while not self.manager.outgoing_ready(player):
+                        time.sleep(0.001)
+                    self.manager.outgoing(player)
+                    if self.manager.game_over(player):
+                        return
+
+        threads = [threading.Thread(target=play, args=(p,))
+                   for g in games for p in [g.player1, g.player2]]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        replayed = journal.replay(self.manager.journal.getvalue(),
+                                  player_class=OnlinePlayer)
+        for game in games:
+            self.assertTrue(game.game_over())
+            self.assertEqual(self.manager.winner(game.player1), None)
+            self.assertEqual(len(game.player1.firing_coordinates), 100)
+            copy = replayed[game.journal_id]
+            self.assertTrue(copy.game_over())
+            self.assertEqual(copy.player2.firing_coordinates,
+                             game.player2.firing_coordinates)
+
+class LobbyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.lobby = matchmaking.Lobby(ttl=10, clock=lambda: self.now)
+        self.players = [OnlinePlayer(str(i)) for i in range(6)]
+
+    def testPairsLongestWaiting(self):
+        p = self.players
+        self.assertEqual(self.lobby.add(p[0]), None)
+        self.now = 1
+        self.assertEqual(self.lobby.add(p[1]), p[0])
+        self.assertEqual(len(self.lobby), 0)
+
+        self.assertEqual(self.lobby.add(p[2], (8, 8, 0)), None)
+        self.assertEqual(self.lobby.add(p[3]), None)
+        self.assertEqual(self.lobby.add(p[4], (8, 8, 0)), p[2])
+        self.assertEqual(self.lobby.add(p[5]), p[3])
+
+    def testRulesets(self):
+        p = self.players
+        self.lobby.add(p[0], matchmaking.ruleset((8, 8)))
+        self.lobby.add(p[1], matchmaking.ruleset(salvo=3))
+        self.assertEqual(self.lobby.add(p[2]), None)
+        self.assertEqual(len(self.lobby), 3)
+        self.assertEqual(self.lobby.add(p[3], matchmaking.ruleset([8, 8], 0)), p[0])
+        self.assertEqual(self.lobby.add(p[4], (10, 10, 3)), p[1])
+        self.assertEqual(self.lobby.add(p[5]), p[2])
+        self.assertEqual(len(self.lobby), 0)
+        self.assertEqual(self.lobby.waiting, {})
+
+    def testRemove(self):
+        p = self.players
+        self.lobby.add(p[0])
+        self.assertTrue(self.lobby.remove(p[0].online_id))
+        self.assertFalse(self.lobby.remove(p[0].online_id))
+        self.assertEqual(self.lobby.add(p[1]), None)
+
+        # Registering again replaces the player's ruleset
+        self.lobby.add(p[1], (5, 5, 0))
+        self.assertEqual(self.lobby.get(p[1].online_id), p[1])
+        self.assertEqual(self.lobby.add(p[2]), None)
+        self.assertEqual(self.lobby.add(p[3], (5, 5, 0)), p[1])
+
+    def testExpire(self):
+        p = self.players
+        self.lobby.add(p[0], (5, 5, 0))
+        self.now = 5
+        self.lobby.add(p[1], (6, 6, 0))
+        self.assertEqual(self.lobby.longest_wait(), 5)
+        self.now = 9
+        self.lobby.touch(p[0].online_id)
+
+        self.assertEqual(self.lobby.expire(15), [p[1]])
+        self.assertEqual(self.lobby.expire(18), [])
+        self.assertEqual(self.lobby.longest_wait(18), 18)
+        self.now = 19
+        self.assertEqual(self.lobby.add(p[2], (5, 5, 0)), None)
+        self.assertEqual(len(self.lobby), 1)
+        self.assertEqual(self.lobby.longest_wait(), 0)
+
+    def testAlive(self):
+        connected = {self.players[0].online_id}
+        self.lobby.alive = lambda player: player.online_id in connected
+        self.lobby.add(self.players[0])
+        self.lobby.add(self.players[1], (5, 5, 0))
+        self.now = 100
+        self.assertEqual(self.lobby.expire(), [self.players[1]])
+        connected.clear()
+        self.assertEqual(self.lobby.expire(), [])
+        self.now = 110
+        self.assertEqual(self.lobby.expire(), [self.players[0]])
+
+    def testCompaction(self):
+        # The players that leave are not searched for, but they are not
+        # kept for long either
+        first = OnlinePlayer("First")
+        self.lobby.add(first)
+        for player in [OnlinePlayer(str(i)) for i in range(100)]:
+            self.lobby.add(player, (7, 7, 0))
+            self.lobby.remove(player.online_id)
+        self.assertEqual(len(self.lobby), 1)
+        self.assertTrue(len(self.lobby.arrivals) <= 2 + 16)
+        self.assertTrue(len(self.lobby.expiries) <= 2 + 16)
+        self.assertEqual(self.lobby.add(self.players[0]), first)
+
+class AsyncServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = async_server.PushServer()
+        self.port, self.stop = async_server.run_in_thread(self.server)
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.stop()
+
+    def connect(self):
+        client = async_server.Client("127.0.0.1", self.port, timeout=10)
+        self.clients.append(client)
+        return client
+
+    # A result as the JSON clients get it
+    def plain(self, value):
+        return json.loads(async_server.dumps(value))
+
+    def testPushedGame(self):
+        c1, c2 = self.connect(), self.connect()
+        p1, p2 = OnlinePlayer("1"), OnlinePlayer("2")
+        p2.online_id = p1.online_id + 1
+
+        c1.register_player(p1)
+        self.assertEqual(c1.opponent_found(p1), False)
+        c2.register_player(p2)
+        self.assertEqual(c1.wait_event("opponent_found")["opponent"]["name"], "2")
+        self.assertEqual(c2.wait_event("opponent_found")["opponent"]["name"], "1")
+
+        c1.accept_opponent(p1)
+        c2.accept_opponent(p2)
+        self.assertTrue(c1.wait_event("opponent_responded")["accepted"])
+        self.assertTrue(c2.wait_event("opponent_responded")["accepted"])
+
+        for c, p in [(c1, p1), (c2, p2)]:
+            c.add_ship(p, Ship("A", [(0,0), (0,1)]))
+            c.add_ship(p, Ship("B", [(1,0), (1,1)]))
+        c1.wait_event("game_ready")
+        c2.wait_event("game_ready")
+
+        self.assertRaises(OutsideGridException, c1.fire, p1, (10,0))
+        c1.fire(p1, (0,0))
+        self.assertEqual(list(c1.events), [])
+        c2.fire(p2, (5,5))
+        self.assertEqual(self.plain(c1.wait_event("incoming")["result"]),
+                         [[5,5], None, False])
+        outgoing = self.plain(c1.wait_event("outgoing")["result"])
+        self.assertEqual(outgoing[0], [0,0])
+        self.assertEqual(outgoing[1]["id"], "A")
+        self.assertEqual(self.plain(c2.wait_event("incoming")["result"])[:2],
+                         outgoing[:2])
+        self.assertRaises(RepeatFireException, c1.fire, p1, (0,0))
+
+        for i, c in enumerate([(0,1), (1,0), (1,1)]):
+            c1.fire(p1, c)
+            c2.fire(p2, (6,i))
+        self.assertEqual(c2.wait_event("game_over")["winner"], p1.online_id)
+        self.assertEqual(c1.winner(p1), p1.online_id)
+
+        methods = self.server.manager.stats()['methods']
+        self.assertEqual(methods['fire']['calls'], 10)
+        self.assertEqual(methods['fire']['errors'], {'OutsideGridException': 1,
+                                                     'RepeatFireException': 1})
+
+    def testDeregister(self):
+        c1, c2 = self.connect(), self.connect()
+        p1, p2 = OnlinePlayer("1"), OnlinePlayer("2")
+        p2.online_id = p1.online_id + 1
+
+        c1.register_player(p1)
+        c2.register_player(p2)
+        c2.wait_event("opponent_found")
+        c1.deregister_player(p1)
+        self.assertFalse(c2.wait_event("opponent_responded")["accepted"])
+        self.assertEqual(list(self.server.manager.online_players), [p2.online_id])
+
+        # The opponent of a player that leaves mid-game wins it
+        c1.register_player(p1)
+        c2.register_player(p2)
+        for c, p in [(c1, p1), (c2, p2)]:
+            c.accept_opponent(p)
+        c2.wait_event("opponent_responded")
+        c1.deregister_player(p1)
+        self.assertEqual(c2.wait_event("game_over")["winner"], p2.online_id)
+        self.assertRaises(OpponentLeftException, c2.fire, p2, (0,0))
+
+    def testBadRequests(self):
+        client = self.connect()
+        client.socket.sendall(b"not json\n")
+        self.assertTrue("error" in client.receive())
+        self.assertRaises(async_server.RemoteError, client.call, "no_such_method")
+        self.assertRaises(async_server.RemoteError, client.call, "_dispatch", "fire", [])
+        # Maintenance methods are not calls
+        for method in ["checkpoint", "restore", "init_game"]:
+            self.assertRaises(async_server.RemoteError, client.call, method)
+        self.assertRaises(async_server.RemoteError, client.wait_opponent,
+                          OnlinePlayer("1"), 1)
+        # The connection still works
+        self.assertEqual(client.opponent_found(OnlinePlayer("1")), False)
+
+    def testLongWait(self):
+        self.now = 0
+        self.server.manager = GameManager(clock=lambda: self.now)
+        self.server.manager.keep_alive = self.server.connected
+        c1, c2 = self.connect(), self.connect()
+        p1, p2 = OnlinePlayer("1"), OnlinePlayer("2")
+        p2.online_id = p1.online_id + 1
+
+        # Waiting for the event is not a call, but the connection is open
+        c1.register_player(p1)
+        self.now = 121
+        self.server.manager.sweep()
+        self.now = 700
+        self.server.manager.sweep()
+        c2.register_player(p2)
+        self.assertEqual(c1.wait_event("opponent_found")["opponent"]["name"], "2")
+
+        # Once the player is gone they are not kept
+        c1.deregister_player(p1)
+        c2.register_player(p2)
+        c2.close()
+        self.clients.remove(c2)
+        while self.server.connected(p2):
+            time.sleep(0.001)
+        self.now = 1000
+        self.server.manager.sweep()
+        self.assertTrue(p2.online_id not in self.server.manager.free_players)
+
+    def testUnexpectedErrors(self):
+        class Manager(GameManager):
+            rpc_methods = GameManager.rpc_methods | {'raw'}
+            def raw(self, player):
+                return object()
+            # As if the sweeper evicted the game as soon as the shot landed
+            def fire(self, player, coordinates):
+                del self.online_games[player.online_id]
+        self.server.manager = Manager()
+
+        client = self.connect()
+        player = OnlinePlayer("1")
+        if isinstance(client.codec, wire.Codec):
+            self.assertRaises(wire.WireError, client.raw, player)
+        else:
+            self.assertRaises(async_server.RemoteError, client.raw, player)
+        self.server.manager.online_games[player.online_id] = Game( (10,10) )
+        with self.assertLogs('async_server', 'ERROR'):
+            client.fire(player, (0,0))
+            # The connection still works. Its answer also comes after the
+            # events of the shot were pushed, and the failure logged
+            self.assertEqual(client.opponent_found(player), False)
+
+    def testPushTextGame(self):
+        connect = self.connect
+        class LocalPushTextGame(PushTextGame):
+            def connect(self):
+                return connect()
+
+        shots = ["{0},{1}".format(x, y) for x in range(1, 11) for y in range(1, 11)]
+        winners = []
+        def play(name, seed):
+            frontend = LocalPushTextGame(script_runner.ScriptInput([name, "random"] + shots),
+                                         lambda *args, **kwargs: None,
+                                         clear=False, rng=random.Random(seed))
+            winners.append(frontend.main())
+
+        threads = [threading.Thread(target=play, args=args)
+                   for args in [("J", 1), ("K", 2)]]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(winners), 2)
+        self.assertEqual(winners[0], winners[1])
+        game = list(self.server.manager.online_games.values())[0]
+        self.assertTrue(game.game_over())
+
+class WireServerTestCase(AsyncServerTestCase):
+
+    def connect(self):
+        client = async_server.Client("127.0.0.1", self.port, timeout=10,
+                                     codec=wire.Codec())
+        self.clients.append(client)
+        return client
+
+    def testBadRequests(self):
+        client = self.connect()
+        # A fire request cut short
+        frame = wire.Codec().request(7, "fire", [OnlinePlayer("1"), (1,1)])
+        frame = wire.length_header.pack(len(frame) - 6) + frame[4:-2]
+        client.socket.sendall(frame)
+        self.assertEqual(client.receive()["id"], 7)
+        self.assertRaises(wire.WireError, client.call, "no_such_method")
+        # Cells no grid has fail like the server would fail them
+        player = OnlinePlayer("1")
+        self.assertRaises(OutsideGridException, client.fire, player, (-1,0))
+        self.assertRaises(OutsideGridException, client.add_ship, player,
+                          Ship("A", [(0,0), (70000,0)]))
+        self.assertEqual(client.opponent_found(player), False)
+
+    def testCodec(self):
+        client, server = wire.Codec(), wire.Codec()
+        player = OnlinePlayer("Ann")
+        ship = Ship("B", [(1,0), (1,1), (1,2)])
+        frame = client.request(3, "add_ship", [player, ship])
+        request_id, method, (name, decoded) = server.decode_request(frame[4:])
+        self.assertEqual((request_id, method), (3, "add_ship"))
+        self.assertEqual(name, {'name': "Ann", 'online_id': player.online_id})
+        self.assertEqual((decoded.id, decoded.coordinates), ("B", ship.coordinates))
+
+        client.request(4, "incoming", [player])
+        shot = ((1,2), ship, True)
+        message = client.read_message(io.BytesIO(server.result(4, "incoming", shot)))
+        (coordinates, decoded, sunk), = [message["result"]]
+        self.assertEqual((message["id"], coordinates, decoded.id, sunk), (4, (1,2), "B", True))
+
+        message = client.read_message(io.BytesIO(
+            server.error(5, RepeatFireException("Again"))))
+        self.assertEqual(message, {'id': 5, 'error': {'type': "RepeatFireException",
+                                                      'message': "Again"}})
+
+        message = client.read_message(io.BytesIO(
+            server.event("game_over", {'winner': None})))
+        self.assertEqual(message, {'event': "game_over", 'winner': None})
+
+        for cut in range(5, len(frame) - 4):
+            self.assertRaises(wire.RequestError, server.decode_request, frame[4:cut])
+
+
+class ShardTestCase(unittest.TestCase):
+
+    # The workers run on threads here, rather than processes
+    def setUp(self):
+        self.servers = [async_server.PushServer() for i in range(3)]
+        self.stops = []
+        addresses = []
+        for push_server in self.servers:
+            port, stop = async_server.run_in_thread(push_server)
+            addresses.append( ("127.0.0.1", port) )
+            self.stops.append(stop)
+        self.router = shard.Router(addresses)
+        self.port, stop = async_server.run_in_thread(self.router)
+        self.stops.insert(0, stop)
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        for stop in self.stops:
+            stop()
+
+    def connect(self, codec=None):
+        client = async_server.Client("127.0.0.1", self.port, timeout=10, codec=codec)
+        self.clients.append(client)
+        return client
+
+    # Two players owned by different workers
+    def players(self):
+        p1, p2 = OnlinePlayer("1"), OnlinePlayer("2")
+        while self.router.ring.node(p1.online_id) == self.router.ring.node(p2.online_id):
+            p2 = OnlinePlayer("2")
+        return p1, p2
+
+    def testRing(self):
+        ring = shard.HashRing(range(3))
+        owners = [ring.node(i) for i in range(3000)]
+        for node in range(3):
+            self.assertTrue(owners.count(node) > 600)
+
+        # Only the keys taken by the new node move
+        bigger = shard.HashRing(range(4))
+        moved = [i for i in range(3000) if bigger.node(i) != owners[i]]
+        self.assertTrue(0 < len(moved) < 1200)
+        self.assertTrue(all(bigger.node(i) == 3 for i in moved))
+
+    def testPlacements(self):
+        self.now = 0
+        placements = shard.Placements(10, clock=lambda: self.now)
+        placements.set(1, 2)
+        placements.set(3, 4)
+        self.now = 10
+        self.assertEqual(placements.get(1), 2)
+        self.now = 20
+        self.assertEqual(placements.get(1), 2)
+        self.assertEqual(placements.get(3), None)
+        self.now = 45
+        self.assertEqual(placements.get(1), None)
+        self.assertEqual(len(placements), 0)
+
+    def testShardedGame(self):
+        for codec in [None, wire.Codec()]:
+            c1, c2 = self.connect(codec), self.connect(type(codec)() if codec else None)
+            p1, p2 = self.players()
+
+            c1.register_player(p1)
+            c2.register_player(p2)
+            self.assertEqual(c1.wait_event("opponent_found")["opponent"]["name"], "2")
+            c2.wait_event("opponent_found")
+
+            # The game is on the worker of the player that waited
+            home = self.servers[self.router.ring.node(p1.online_id)]
+            self.assertEqual(self.router.home(p2.online_id), self.servers.index(home))
+            for c, p in [(c1, p1), (c2, p2)]:
+                c.accept_opponent(p)
+            for c, p in [(c1, p1), (c2, p2)]:
+                self.assertTrue(c.wait_event("opponent_responded")["accepted"])
+                c.add_ship(p, Ship("A", [(0,0), (0,1)]))
+                c.add_ship(p, Ship("B", [(1,0), (1,1)]))
+            c1.wait_event("game_ready")
+            games = home.manager.online_games
+            self.assertTrue(games[p1.online_id] is games[p2.online_id])
+
+            for i, c in enumerate([(0,0), (0,1), (1,0), (1,1)]):
+                c1.fire(p1, c)
+                c2.fire(p2, (6,i))
+            self.assertEqual(c2.wait_event("game_over")["winner"], p1.online_id)
+            self.assertEqual(c2.winner(p2), p1.online_id)
+
+    def testDeregister(self):
+        c1, c2 = self.connect(), self.connect()
+        p1, p2 = self.players()
+        c1.register_player(p1)
+        c2.register_player(p2)
+        c1.wait_event("opponent_found")
+        c2.deregister_player(p2)
+        self.assertFalse(c1.wait_event("opponent_responded")["accepted"])
+        self.assertEqual(len(self.router.placements), 0)
+        self.assertEqual(len(self.router.lobby), 0)
+
+    def testLongWait(self):
+        self.now = 0
+        clock = lambda: self.now
+        self.router.lobby.clock = clock
+        for push_server in self.servers:
+            push_server.manager.free_players.clock = clock
+        c1, c2 = self.connect(), self.connect()
+        p1, p2 = self.players()
+
+        c1.register_player(p1)
+        c1.opponent_found(p1)
+        self.now = 121
+        for push_server in self.servers:
+            push_server.manager.sweep()
+        c2.register_player(p2)
+        self.assertEqual(c1.wait_event("opponent_found")["opponent"]["name"], "2")
+        self.assertEqual(self.router.home(p2.online_id), self.router.ring.node(p1.online_id))
+
+    def testBadRequests(self):
+        client = self.connect()
+        client.socket.sendall(b"not json\n")
+        self.assertEqual(client.receive()['error']['type'], "JSONDecodeError")
+        client.socket.sendall(b'{"id": 2, "method": "fire", "params": [{"online_id": [1]}]}\n')
+        self.assertEqual(client.receive()['id'], 2)
+        # Calls without a player go to the first worker
+        self.assertEqual(client.stats()['gauges']['online_players'], 0)
+        self.assertRaises(async_server.RemoteError, client.fire,
+                          {'name': "", 'online_id': 5}, (0,0))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,5 +1,6 @@
 #! /usr/bin/env python3
-import battleship, os, server, time, random
+import battleship, os, server, async_server, sys, random, ai, placement
+from board import SparseBoard
 
 shipInfo = [ ("Patrol Boat", 2), ("Destroyer", 3) ]
 
@@ -11,19 +12,39 @@ class FrontEndPlayer( battleship.Player ):
         self.board = []
         self.opponentsBoard = []
         self.initBoards()
-        self.shipSunkCount = 0
 
+    # Only the cells with ships, hits and misses are stored, so large grids
+    # don't cost memory until they are played on
     def initBoards(self):
-        cols = range( self.grid[0] )
-        rows = range( self.grid[1] )
-        
-        self.board = [["~" for c in cols] for r in rows]
-        self.opponentsBoard = [["~" for c in cols] for r in rows]
+        cols = self.grid[0]
+        rows = self.grid[1]
+
+        self.board = SparseBoard(rows, cols)
+        self.opponentsBoard = SparseBoard(rows, cols)
+
+class ComputerPlayer( FrontEndPlayer ):
+    '''A player whose ships are placed at random and whose shots are picked
+    by ai.ProbabilityStrategy'''
+
+    def __init__(self, name, grid, rng=None):
+        super(ComputerPlayer, self).__init__(name, grid)
+        fleet = [length for name, length in shipInfo]
+        self.strategy = ai.ProbabilityStrategy(grid, fleet, rng)
 
 class TextGame:
-    
+
+    # inputFunc and printFunc are used like input and print, so the game can
+    # be played without a terminal. The screen is only cleared if clear is
+    # set. rng places the random fleets and seeds the computer's shots
+    def __init__(self, inputFunc=input, printFunc=print, clear=True, rng=random):
+        self.input = inputFunc
+        self.print = printFunc
+        self.clear = clear
+        self.rng = rng
+
     def clearScreen(self):
-        os.system('cls' if os.name=='nt' else 'clear')
+        if self.clear:
+            os.system('cls' if os.name=='nt' else 'clear')
 
     def addShipToBoard(self, ship, board):
         '''Function to ste the board with the ship's coordinates
@@ -37,17 +58,17 @@ class TextGame:
         '''Function to print the board object to the terminal
         Input: boardObj
         Output: Printing the board to the terminal'''
-        print("  ", end="")
+        self.print("  ", end="")
         for i in range(len(boardObj)):
-            print(str(i+1).zfill(2), end=" ")
-        print()
+            self.print(str(i+1).zfill(2), end=" ")
+        self.print()
         for i in range(len(boardObj)):
-            print(str(i+1).zfill(2), end=" ")
+            self.print(str(i+1).zfill(2), end=" ")
             row = boardObj[i]
             for elem in row:
-                print(elem, end="  ")
-            print()
-        print()
+                self.print(elem, end="  ")
+            self.print()
+        self.print()
 
     def coordConstructor(self, startCord, endCord):
         '''Fills in the missing coordinates between startCord and endCord
@@ -86,15 +107,21 @@ class TextGame:
 
 
     def getShipEnds(self):
+        '''Returns the ends of the ship the user typed in, or None if they
+        asked for a random fleet'''
 
         while True:
             try:
-                prompt = "In 'row,column row,column' form: "
-                userInput = input( prompt )
+                prompt = "In 'row,column row,column' form (or 'random' for a random fleet): "
+                userInput = self.input( prompt )
+                if userInput.strip() == "random":
+                    return None
                 start, end = [eval(t) for t in userInput.split()]
                 break
+            except EOFError:
+                raise
             except Exception:
-                print("The input was incorrect, try again..")
+                self.print("The input was incorrect, try again..")
 
         start = (start[0] - 1, start[1] - 1)
         end = (end[0] - 1, end[1] - 1)
@@ -105,6 +132,10 @@ class TextGame:
         Input: Game object
         Output: Lists of ship objects'''
 
+        if isinstance(player, ComputerPlayer):
+            self.placeRandomFleet(game, player, shipInfo)
+            return
+
         shipIDs = map(chr, range(ord('A'), ord('A') + len(shipInfo)))
 
         for name, length in shipInfo:
@@ -117,12 +148,19 @@ class TextGame:
                 self.printBoard(player.board)
 
                 if errorMesg:
-                    print("\n" + errorMesg + "\n")
+                    self.print("\n" + errorMesg + "\n")
                     errorMesg = None
 
                 shipPrompt = "Where do you want your {0}, which should be {1} long?"
-                print( shipPrompt.format(name, length) )
-                startPos, endPos = self.getShipEnds()
+                self.print( shipPrompt.format(name, length) )
+                shipEnds = self.getShipEnds()
+
+                if not shipEnds:
+                    remaining = shipInfo[ shipInfo.index((name, length)): ]
+                    self.placeRandomFleet(game, player, remaining)
+                    return
+
+                startPos, endPos = shipEnds
 
                 if any( not game.point_inside_grid(p) for p in [startPos, endPos] ):
                     errorMesg = "A point was not inside the grid!"
@@ -150,20 +188,38 @@ class TextGame:
                 break # Success! 
 
 
+    def placeRandomFleet(self, game, player, ships):
+        '''Places the ships, given as (name, length) pairs, at random around
+        the player's other ships'''
+
+        shipCount = len(player.ships)
+        placement.place_fleet(game, player, [length for name, length in ships], self.rng)
+        for ship in player.ships[shipCount:]:
+            self.addShipToBoard(ship, player.board)
+
+
 class PVPTextGame(TextGame):
 
     def main(self):
         """Text-based UI for two players at the same console."""
         #--------------Game Setup-------------------------------------
 
-        player1Name = input("What is player 1's name? ")
-        player2Name = input("What is player 2's name? ")
+        computerOpponent = self.input("Do you want to play against the computer? (y/n) ") == "y"
+
+        player1Name = self.input("What is player 1's name? ")
+        if computerOpponent:
+            player2Name = "The computer"
+        else:
+            player2Name = self.input("What is player 2's name? ")
 
-        gridSize = eval(input("What did you want the square grid size to be?(IE 10x10=>10) "))
+        gridSize = eval(self.input("What did you want the square grid size to be?(IE 10x10=>10) "))
         grid = (gridSize, gridSize)
 
         player1 = FrontEndPlayer(player1Name, grid)
-        player2 = FrontEndPlayer(player2Name, grid)
+        if computerOpponent:
+            player2 = ComputerPlayer(player2Name, grid, self.rng)
+        else:
+            player2 = FrontEndPlayer(player2Name, grid)
 
         game = battleship.Game( grid )
         game.init_game( player1, player2 )
@@ -176,25 +232,28 @@ class PVPTextGame(TextGame):
         if not game.game_ready():
             raise Exception("The game is unexpectedly not ready")
 
-        winner = None
-        while not winner:
+        while not game.game_over():
 
             for p in [player1, player2]:
+                if isinstance(p, ComputerPlayer):
+                    game.fire(p, p.strategy.next_shot())
+                    continue
+
                 errorMesg = ""
                 while True:
                                     
                     self.clearScreen()
-                    print(p.name, "'s boards\n")
-                    print("Miss/Hit Board")
+                    self.print(p.name, "'s boards\n")
+                    self.print("Miss/Hit Board")
                     self.printBoard(p.opponentsBoard)
-                    print("Your board")
+                    self.print("Your board")
                     self.printBoard(p.board)
 
                     if errorMesg:
-                        print(errorMesg + "\n")
+                        self.print(errorMesg + "\n")
 
                     try:
-                        fireCoordinate = eval(input("Where do you want to fire? (x,y) format: "))
+                        fireCoordinate = eval(self.input("Where do you want to fire? (x,y) format: "))
                         fireCoordinate = (fireCoordinate[0] - 1, fireCoordinate[1] - 1)
                         game.fire(p, fireCoordinate)
                     except battleship.RepeatFireException:
@@ -203,6 +262,8 @@ class PVPTextGame(TextGame):
                     except battleship.OutsideGridException:
                         errorMesg = "Those coordinates are outside of the grid!"
                         continue
+                    except EOFError:
+                        raise
                     except Exception:
                         errorMesg = "The input was incorrect, try again..."
                         continue
@@ -221,17 +282,17 @@ class PVPTextGame(TextGame):
                 else:
                     p.opponentsBoard[ outgoingHit[0] ][ outgoingHit[1] ] = "M"
 
-                other_p = game.other_player(p)
-
-                if shipSunk:
-                    other_p.shipSunkCount += 1
-
-                if other_p.shipSunkCount == len(shipInfo):
-                    winner = p
+                if isinstance(p, ComputerPlayer):
+                    p.strategy.record(outgoingHit, ship, shipSunk)
 
             self.clearScreen()
 
-        print("Congratulations " + winner.name + ". You won!")
+        winner = game.winner()
+        if winner:
+            self.print("Congratulations " + winner.name + ". You won!")
+        else:
+            self.print("Both fleets were sunk in the same round. It's a draw!")
+        return winner
 
 
 class OnlineFrontEndPlayer( FrontEndPlayer ):
@@ -251,111 +312,182 @@ class OnlineTextGame(TextGame):
         def __init__(self, serverProxy, gridSize):
             self.proxy = serverProxy
             self.game = battleship.Game(gridSize)
+            self.grid = gridSize
         
         def point_inside_grid(self, point):
             return self.game.point_inside_grid(point)
 
+        # The ships are also kept on the local player, so a random fleet
+        # can be placed around them
         def add_ship(self, player, ship):
-            return self.proxy.add_ship(player, ship)
-
-    def main(self):
-        s = server.getProxy()
-        p = OnlineFrontEndPlayer(input("What is your name? "), (10,10))
-
-        s.register_player(p)
-
-        print("Waiting for opponent!...")
-        while not s.opponent_found(p):
-            time.sleep(.5)
-        
-        s.accept_opponent(p);
-
-        print("Waiting for opponent to accept!");
-        while not s.opponent_responded(p):
-            time.sleep(.5)
-
+            self.proxy.add_ship(player, ship)
+            player.ships.append(ship)
+
+    def connect(self):
+        return server.getProxy()
+
+    # The waits block on the server until the step is done. The server
+    # returns false every waitTimeout seconds, and they ask again
+    waitTimeout = 30
+
+    def waitForOpponent(self, s, p):
+        while not s.wait_opponent(p, self.waitTimeout):
+            pass
+
+    def waitForResponse(self, s, p):
+        while not s.wait_response(p, self.waitTimeout):
+            pass
+
+    def waitForGame(self, s, p):
+        while not s.wait_game(p, self.waitTimeout):
+            pass
+
+    # Returns the result of outgoing
+    def waitForOutgoing(self, s, p):
+        while not s.wait_outgoing(p, self.waitTimeout):
+            pass
+        return s.outgoing(p)
+
+    # Fires, and returns what finishTurn needs to finish the round. The
+    # server answers once the round is over, so a turn is one request
+    def fireShot(self, s, p, coordinates):
+        return s.take_turn(p, coordinates, self.waitTimeout)
+
+    # Returns the results of incoming and outgoing for the round
+    def finishTurn(self, s, p, turn):
+        while turn is None:
+            turn = s.take_turn(p, None, self.waitTimeout)
+        incoming, outgoing = turn
+        if outgoing is None:
+            outgoing = self.waitForOutgoing(s, p)
+        return incoming, outgoing
+
+    # Places the fleet and plays the rounds until the game is over. Raises
+    # OpponentLeftException if the opponent leaves first
+    def playGame(self, s, p):
         dummy_game = self.DummyGame(s, (10,10))
         self.setUpPlayerShips(dummy_game, p)
 
-        while not s.game_ready(p):
-            time.sleep(.5)
+        self.waitForGame(s, p)
             
-        print("Game Ready!")
+        self.print("Game Ready!")
         
-        mySunkShips = 0
-        othersSunkShips = 0
-
-        winner = False
         while True:
 
             errorMesg = None
             while True:
                 try:
 
-                    print("Miss/Hit Board")
+                    self.print("Miss/Hit Board")
                     self.printBoard(p.opponentsBoard)
-                    print("Your board")
+                    self.print("Your board")
                     self.printBoard(p.board)
 
                     if errorMesg:
-                        print(errorMesg + "\n")
+                        self.print(errorMesg + "\n")
 
-                    fireCoordinate = eval(input("Where do you want to fire? (x,y) format: "))
+                    fireCoordinate = eval(self.input("Where do you want to fire? (x,y) format: "))
                     fireCoordinate = (fireCoordinate[0] - 1, fireCoordinate[1] - 1)
-                    s.fire(p, fireCoordinate)
+                    self.print("Waiting for opponent to fire...")
+                    turn = self.fireShot(s, p, fireCoordinate)
                 except battleship.RepeatFireException:
                     errorMesg = "You already fired in that spot!"
                     continue
                 except battleship.OutsideGridException:
                     errorMesg = "Those coordinates are outside of the grid!"
                     continue
+                except (EOFError, battleship.OpponentLeftException):
+                    raise
                 except Exception:
                     errorMesg = "The input was incorrect, try again..."
                     continue
 
                 break
             
+            incoming, outgoing = self.finishTurn(s, p, turn)
 
-            print("Waiting for opponent to fire...")
-            while not s.incoming_ready(p):
-                time.sleep(.5)
-
-            incomingHit, ship, shipSunk = s.incoming(p)
+            incomingHit, ship, shipSunk = incoming
 
             if ship:
                 p.board[ incomingHit[0] ][ incomingHit[1] ] = "H"
                 
-            if shipSunk:
-                mySunkShips += 1
-                
-            if mySunkShips == len(shipInfo):
-                winner = False
-                break
-
-            while not s.outgoing_ready(p):
-                time.sleep(.5)
-
-            outgoingHit, ship, shipSunk = s.outgoing(p)
+            outgoingHit, ship, shipSunk = outgoing
 
             if ship:
                 p.opponentsBoard[ outgoingHit[0] ][ outgoingHit[1] ] = "X"
             else:
                 p.opponentsBoard[ outgoingHit[0] ][ outgoingHit[1] ] = "M"
 
-            if shipSunk:
-                othersSunkShips += 1
-
-            if othersSunkShips == len(shipInfo):
-                winner = True
+            if s.game_over(p):
                 break
 
-        if winner:
-            print("Congratulations you won!")
+    def main(self):
+        s = self.connect()
+        p = OnlineFrontEndPlayer(self.input("What is your name? "), (10,10))
+
+        s.register_player(p)
+
+        self.print("Waiting for opponent!...")
+        self.waitForOpponent(s, p)
+        
+        s.accept_opponent(p);
+
+        self.print("Waiting for opponent to accept!");
+        self.waitForResponse(s, p)
+
+        try:
+            self.playGame(s, p)
+        except battleship.OpponentLeftException:
+            self.print("Your opponent left the game.")
+
+        winner = s.winner(p)
+        if winner == p.online_id:
+            self.print("Congratulations you won!")
+        elif winner is None:
+            self.print("Both fleets were sunk in the same round. It's a draw!")
         else:
-            print("Regretably you lost")
+            self.print("Regretably you lost")
+        return winner
+
+class PushTextGame(OnlineTextGame):
+    '''Plays on the asyncio server, which pushes every step to the client
+    instead of being polled'''
+
+    def connect(self):
+        return async_server.getClient()
+
+    def waitForOpponent(self, s, p):
+        s.wait_event("opponent_found")
+
+    def waitForResponse(self, s, p):
+        s.wait_event("opponent_responded")
+
+    # Returns the game's next event with the name. A game only ends before
+    # its rounds do when the opponent leaves
+    def waitForGameEvent(self, s, name):
+        event = s.wait_event(name, "game_over")
+        if event["event"] == "game_over":
+            raise battleship.OpponentLeftException("Your opponent left the game")
+        return event
+
+    def waitForGame(self, s, p):
+        self.waitForGameEvent(s, "game_ready")
+
+    def waitForOutgoing(self, s, p):
+        return self.waitForGameEvent(s, "outgoing")["result"]
+
+    def fireShot(self, s, p, coordinates):
+        s.fire(p, coordinates)
+
+    def finishTurn(self, s, p, turn):
+        return (self.waitForGameEvent(s, "incoming")["result"],
+                self.waitForGameEvent(s, "outgoing")["result"])
 
 if __name__ == "__main__":
 
-    game = OnlineTextGame();
+    if "--push" in sys.argv:
+        game = PushTextGame()
+    else:
+        game = OnlineTextGame();
     game.main();
 
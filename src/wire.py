@@ -0,0 +1,368 @@
+'''A compact binary encoding of the game calls, for async_server.
+
+A connection to async_server speaks JSON lines unless its first line is
+MAGIC, then every message after it is a frame:
+
+    length    uint32, of the rest of the frame
+    kind      uint8, REQUEST, RESULT, ERROR or EVENT
+    ID        uint32, the request ID, or the event number for events
+    body
+
+A REQUEST body is the method number, then the parameters. A RESULT body
+is the method's result, an ERROR body is the exception's name and
+message, and an EVENT body is the event's fields. What is in a body is
+known from the method or the event, see methods and events, so no type
+tags or field names are sent. Coordinates are two uint16, players are
+their online ID and name, ships are their ID and cells.
+
+Numbers are little endian. Methods and events are numbered from 1 in the
+order of the lists, so new ones go at the end.
+'''
+
+import struct
+from array import array
+from battleship import Ship, OutsideGridException
+
+MAGIC = b"\x00wire1\n"
+
+REQUEST = 0
+RESULT = 1
+ERROR = 2
+EVENT = 3
+
+length_header = struct.Struct("<I")
+frame_header = struct.Struct("<IBI") # length, kind, ID
+# The start of a frame after its length, and of a request
+frame_start = struct.Struct("<BI")
+request_start = struct.Struct("<BIB")
+
+# The longest frame the server reads
+max_frame = 1 << 16
+
+
+class WireError(Exception):
+    pass
+
+class RequestError(Exception):
+    '''A request that could not be decoded. error is why, and request_id
+    is None if the ID could not be read either'''
+
+    def __init__(self, request_id, error):
+        super(RequestError, self).__init__(str(error))
+        self.request_id = request_id
+        self.error = error
+
+
+# Every type has encode(value, out), which appends the bytes of the value
+# to the list out, and decode(data, offset, load), which returns the value
+# and the offset after it. load(online_id, name) makes the decoded players
+
+class Scalar:
+
+    __slots__ = ('pack', 'unpack_from', 'size')
+
+    def __init__(self, fmt):
+        s = struct.Struct("<" + fmt)
+        self.pack = s.pack
+        self.unpack_from = s.unpack_from
+        self.size = s.size
+
+    def encode(self, value, out):
+        out.append(self.pack(value))
+
+    def decode(self, data, offset, load):
+        return self.unpack_from(data, offset)[0], offset + self.size
+
+class Nothing:
+
+    def encode(self, value, out):
+        pass
+
+    def decode(self, data, offset, load):
+        return None, offset
+
+class String:
+
+    length = struct.Struct("<H")
+
+    def encode(self, value, out):
+        value = str(value).encode('utf-8')
+        out.append(self.length.pack(len(value)))
+        out.append(value)
+
+    def decode(self, data, offset, load):
+        length, = self.length.unpack_from(data, offset)
+        offset += self.length.size
+        return read(data, offset, length).decode('utf-8'), offset + length
+
+class Coordinates:
+
+    cell = struct.Struct("<HH")
+
+    def encode(self, value, out):
+        check_cells([value])
+        out.append(self.cell.pack(value[0], value[1]))
+
+    def decode(self, data, offset, load):
+        return self.cell.unpack_from(data, offset), offset + 4
+
+class PlayerType:
+
+    header = struct.Struct("<IH") # online ID, name length
+
+    def encode(self, value, out):
+        if isinstance(value, dict):
+            online_id, name = value['online_id'], value['name']
+        else:
+            online_id, name = value.online_id, value.name
+        name = name.encode('utf-8')
+        out.append(self.header.pack(online_id, len(name)))
+        out.append(name)
+
+    def decode(self, data, offset, load):
+        online_id, length = self.header.unpack_from(data, offset)
+        offset += self.header.size
+        name = read(data, offset, length).decode('utf-8')
+        return load(online_id, name), offset + length
+
+class ShipType:
+
+    header = struct.Struct("<BH") # ID length, cell count
+
+    def encode(self, value, out):
+        ship_id = str(value.id).encode('utf-8')
+        check_cells(value.coordinates)
+        out.append(self.header.pack(len(ship_id), len(value.coordinates)))
+        out.append(ship_id)
+        out.append(array('H', [n for c in value.coordinates for n in c]).tobytes())
+
+    def decode(self, data, offset, load):
+        id_length, count = self.header.unpack_from(data, offset)
+        offset += self.header.size
+        ship_id = read(data, offset, id_length).decode('utf-8')
+        offset += id_length
+        cells = array('H')
+        cells.frombytes(read(data, offset, 4 * count))
+        coordinates = [ (cells[i], cells[i + 1]) for i in range(0, 2 * count, 2) ]
+        return Ship(ship_id, coordinates), offset + 4 * count
+
+class Optional:
+    '''The value or None, after a flag'''
+
+    def __init__(self, value_type):
+        self.value_type = value_type
+
+    def encode(self, value, out):
+        if value is None:
+            out.append(b"\x00")
+        else:
+            out.append(b"\x01")
+            self.value_type.encode(value, out)
+
+    def decode(self, data, offset, load):
+        if read(data, offset, 1) == b"\x00":
+            return None, offset + 1
+        return self.value_type.decode(data, offset + 1, load)
+
+class List:
+    '''A uint16 count, then the items'''
+
+    count = struct.Struct("<H")
+
+    def __init__(self, item_type):
+        self.item_type = item_type
+
+    def encode(self, value, out):
+        out.append(self.count.pack(len(value)))
+        for item in value:
+            self.item_type.encode(item, out)
+
+    def decode(self, data, offset, load):
+        count, = self.count.unpack_from(data, offset)
+        offset += self.count.size
+        items = []
+        for i in range(count):
+            item, offset = self.item_type.decode(data, offset, load)
+            items.append(item)
+        return items, offset
+
+class Tuple:
+
+    def __init__(self, *item_types):
+        self.item_types = item_types
+
+    def encode(self, value, out):
+        for item_type, item in zip(self.item_types, value):
+            item_type.encode(item, out)
+
+    def decode(self, data, offset, load):
+        items = []
+        for item_type in self.item_types:
+            item, offset = item_type.decode(data, offset, load)
+            items.append(item)
+        return tuple(items), offset
+
+# Cells that don't fit a uint16 are outside any grid, so they raise what the
+# server would
+def check_cells(cells):
+    for c in cells:
+        if not (0 <= c[0] <= 0xffff and 0 <= c[1] <= 0xffff):
+            raise OutsideGridException("The coordinates {0} are outside the grid".format(tuple(c)))
+
+# Slices that are cut short are corrupt data, not short values
+def read(data, offset, length):
+    if offset + length > len(data):
+        raise WireError("The frame is cut short")
+    return data[offset:offset + length]
+
+
+Bool = Scalar("?")
+UInt32 = Scalar("I")
+Player = PlayerType()
+ShipValue = ShipType()
+Cell = Coordinates()
+# The result of incoming and outgoing
+Shot = Tuple(Cell, Optional(ShipValue), Bool)
+
+# (name, parameter types, result type)
+methods = [
+    ('register_player', Tuple(Player), Nothing()),
+    ('deregister_player', Tuple(Player), Nothing()),
+    ('opponent_found', Tuple(Player), Bool),
+    ('accept_opponent', Tuple(Player), Nothing()),
+    ('reject_opponent', Tuple(Player), Nothing()),
+    ('opponent_responded', Tuple(Player), Tuple(Bool, Optional(Bool))),
+    ('add_ship', Tuple(Player, ShipValue), Nothing()),
+    ('game_ready', Tuple(Player), Bool),
+    ('fire', Tuple(Player, Cell), Nothing()),
+    ('incoming_ready', Tuple(Player), Bool),
+    ('incoming', Tuple(Player), Shot),
+    ('outgoing_ready', Tuple(Player), Bool),
+    ('outgoing', Tuple(Player), Shot),
+    ('fire_salvo', Tuple(Player, List(Cell)), Nothing()),
+    ('incoming_salvo', Tuple(Player), List(Shot)),
+    ('outgoing_salvo', Tuple(Player), List(Shot)),
+    ('game_over', Tuple(Player), Bool),
+    ('winner', Tuple(Player), Optional(UInt32)),
+]
+
+# (name, field names, field types)
+events = [
+    ('opponent_found', ['opponent'], Tuple(Player)),
+    ('opponent_responded', ['accepted'], Tuple(Bool)),
+    ('game_ready', [], Tuple()),
+    ('incoming', ['result'], Tuple(Shot)),
+    ('outgoing', ['result'], Tuple(Shot)),
+    ('incoming_salvo', ['result'], Tuple(List(Shot))),
+    ('outgoing_salvo', ['result'], Tuple(List(Shot))),
+    ('game_over', ['winner'], Tuple(Optional(UInt32))),
+]
+
+method_numbers = dict( (m[0], i + 1) for i, m in enumerate(methods) )
+event_numbers = dict( (e[0], i + 1) for i, e in enumerate(events) )
+error_body = Tuple(String(), String())
+
+# Decoded players are sent to the client as async_server sends them
+def player_dict(online_id, name):
+    return {'name': name, 'online_id': online_id}
+
+
+class Codec:
+    '''The frames of one connection, for either end of it. The server reads
+    requests and writes results, errors and events, the client writes
+    requests and reads the rest. load_player(online_id, name) makes the
+    players the server decodes.'''
+
+    greeting = MAGIC
+
+    def __init__(self, load_player=player_dict):
+        self.load = load_player
+        # Request ID -> method, of the requests sent and not answered
+        self.sent = dict()
+
+    async def read_request(self, reader):
+        '''Returns the next frame, without its length, or b"" at the end of
+        the stream. Raises ValueError if it is longer than max_frame.'''
+        try:
+            length, = length_header.unpack(await reader.readexactly(4))
+            if length > max_frame:
+                raise ValueError("The frame is too long")
+            return await reader.readexactly(length)
+        except EOFError:
+            return b""
+
+    def decode_request(self, frame):
+        request_id = None
+        try:
+            # The ID first, to answer with, even if the rest is corrupt
+            kind, request_id = frame_start.unpack_from(frame)
+            kind, request_id, number = request_start.unpack_from(frame)
+            if kind != REQUEST or not 0 < number <= len(methods):
+                raise WireError("Not a request")
+            name, params, result = methods[number - 1]
+            values, offset = params.decode(frame, 6, self.load)
+            if offset != len(frame):
+                raise WireError("The request has bytes left over")
+            return request_id, name, values
+        except (struct.error, UnicodeDecodeError):
+            raise RequestError(request_id, WireError("The request is cut short or corrupt"))
+        except WireError as e:
+            raise RequestError(request_id, e)
+
+    def frame(self, kind, frame_id, body):
+        body = b"".join(body)
+        return frame_header.pack(len(body) + 5, kind, frame_id) + body
+
+    def result(self, request_id, method, value):
+        body = []
+        methods[method_numbers[method] - 1][2].encode(value, body)
+        return self.frame(RESULT, request_id, body)
+
+    def error(self, request_id, e):
+        body = []
+        error_body.encode( (type(e).__name__, str(e)), body )
+        return self.frame(ERROR, request_id or 0, body)
+
+    def event(self, name, fields):
+        number = event_numbers[name]
+        name, field_names, field_types = events[number - 1]
+        body = []
+        field_types.encode([fields[f] for f in field_names], body)
+        return self.frame(EVENT, number, body)
+
+    def request(self, request_id, method, params):
+        number = method_numbers.get(method)
+        if number is None:
+            raise WireError("There is no wire encoding for " + method)
+        body = [bytes([number])]
+        methods[number - 1][1].encode(params, body)
+        self.sent[request_id] = method
+        return self.frame(REQUEST, request_id, body)
+
+    def read_message(self, file):
+        '''Reads a frame from the server and returns it as async_server's
+        JSON messages read'''
+        head = file.read(4)
+        if len(head) < 4:
+            raise ConnectionError("The server closed the connection")
+        length, = length_header.unpack(head)
+        frame = file.read(length)
+        if len(frame) < length:
+            raise ConnectionError("The server closed the connection")
+        kind, frame_id = frame_start.unpack_from(frame)
+
+        if kind == EVENT:
+            name, field_names, field_types = events[frame_id - 1]
+            values, offset = field_types.decode(frame, 5, self.load)
+            message = dict(zip(field_names, values))
+            message['event'] = name
+            return message
+
+        method = self.sent.pop(frame_id, None)
+        if kind == ERROR:
+            (error_type, error_message), offset = error_body.decode(frame, 5, self.load)
+            return {'id': frame_id, 'error': {'type': error_type, 'message': error_message}}
+        if method is None:
+            return {'id': frame_id} # An answer to a call that was given up on
+        value, offset = methods[method_numbers[method] - 1][2].decode(frame, 5, self.load)
+        return {'id': frame_id, 'result': value}